@@ -1,43 +1,97 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response
 import threading
 import time
 import json
 import uuid
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 import os
 import sys
 import subprocess
 import platform
 from io import StringIO
-os.environ['WEBVIEW_BACKEND'] = 'qt'
-import webview
-from PyQt5.QtWidgets import QApplication
-from PyQt5.QtGui import QClipboard
 from video_downloader import (
-    get_formats, download_video, get_default_download_dir,
-    CustomLogger, check_ffmpeg, download_thumbnail, format_format_label,
-    get_video_id, open_file_path, open_folder_path, safe_delete_thumbnail
+    download_video, get_default_download_dir,
+    CustomLogger, check_ffmpeg, fetch_thumbnail, format_format_label,
+    open_file_path, open_folder_path, safe_delete_thumbnail, THUMBNAIL_NAME_RE,
+    find_original_thumbnail,
+    info_cache, trim_info, normalize_url, DownloadPaused, find_partial_files, run_postprocessing
 )
-from logger import log_frontend_error, log_info, log_error, log_warning, log_debug
+from logger import clear_log_file, log_frontend_error, log_info, log_error, log_warning, log_debug
 from database import Database
+from event_broker import EventBroker, DEFAULT_EVENT_RATE
+from history_reconciler import HistoryReconciler
+from extraction_pool import ExtractionPool, ExtractionCancelled, DEFAULT_EXTRACTION_WORKERS
+from download_process import DownloadProcessPool
+from thumbnail_janitor import ThumbnailJanitor, DEFAULT_THUMBNAIL_CACHE_LIMIT_MB
+from download_scheduler import (
+    DownloadScheduler, AdaptiveConcurrency, BandwidthLimiter, PostProcessPool, ThumbnailPool, normalize_host_limits,
+    DEFAULT_MAX_WORKERS, DEFAULT_PER_HOST_LIMIT
+)
 
 app = Flask(__name__)
 
-# Хранилище активных задач (только для форматов)
+# Хранилище активных задач (только для форматов); каждое изменение задачи
+# увеличивает ее version и будит ожидающих в wait_task
 tasks = {}
-tasks_lock = threading.Lock()
+tasks_lock = threading.Condition()
+
+# Максимальное время ожидания изменений задачи в одном запросе (long polling)
+TASK_WAIT_MAX = 25  # секунды
+
+# Номер по порядку завершения задачи (finished_seq) - по нему пакетный
+# запрос отдает результаты по мере готовности
+task_finish_seq = 0
+
+# База данных (открывается в init_app)
+db = None
+
+# Рассылка изменений очереди через /api/events
+event_broker = EventBroker()
+
+
+def publish_queue_changed():
+    """Сообщает клиентам, что состав или статусы очереди изменились"""
+    event_broker.publish('queue')
+
 
-# База данных
-db = Database()
+def publish_history_changed():
+    """Сообщает клиентам, что в истории появились записи"""
+    event_broker.publish('history')
+
+
+def publish_thumbnails_changed():
+    """Сообщает клиентам, что у записей очереди или истории убран thumbnail"""
+    publish_queue_changed()
+    publish_history_changed()
+
+
+def get_task_progress(task):
+    """Прогресс активной загрузки для API (вызывать под active_tasks_lock)"""
+    return {
+        'progress': task['progress'],
+        'downloaded_bytes': task['downloaded_bytes'],
+        'total_bytes': task['total_bytes'],
+        'speed': task['speed'],
+        'eta': task['eta'],
+        'paused': task['paused'],
+        'retry_status': task.get('retry_status')
+    }
+
+
+def publish_task_progress(task):
+    """Отправляет прогресс активной загрузки (вызывать под active_tasks_lock)"""
+    event_broker.publish('progress', dict(get_task_progress(task), queue_id=task['queue_id']),
+                         key=f"progress:{task['queue_id']}")
 
 # Папка загрузки по умолчанию
 DOWNLOAD_FOLDER = get_default_download_dir()
 
-# Папка для thumbnails
+# Папка для thumbnails (создается в init_app)
 THUMBNAILS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'thumbnails')
-os.makedirs(THUMBNAILS_FOLDER, exist_ok=True)
 
 # Определение системной темы
 def get_system_theme():
@@ -129,11 +183,42 @@ def get_task(task_id):
         return tasks.get(task_id)
 
 
+def apply_task_update(task, kwargs):
+    """Обновляет задачу и отмечает ее завершение (вызывать под tasks_lock)"""
+    global task_finish_seq
+    task.update(kwargs)
+    task['version'] += 1
+    finished = task['status'] in ('error', 'cancelled') or (task['status'] == 'idle' and 'formats' in task)
+    if finished and not task.get('finished_seq'):
+        task_finish_seq += 1
+        task['finished_seq'] = task_finish_seq
+
+
 def update_task(task_id, **kwargs):
     """Безопасное обновление задачи"""
     with tasks_lock:
         if task_id in tasks:
-            tasks[task_id].update(kwargs)
+            apply_task_update(tasks[task_id], kwargs)
+            tasks_lock.notify_all()
+
+
+def wait_task(task_id, since_version, timeout):
+    """
+    Ждет, пока version задачи станет больше since_version (не дольше timeout)
+    
+    Returns:
+        Копия задачи или None, если задачи нет
+    """
+    deadline = time.monotonic() + timeout
+    with tasks_lock:
+        while True:
+            task = tasks.get(task_id)
+            if task is None:
+                return None
+            remaining = deadline - time.monotonic()
+            if task['version'] > since_version or remaining <= 0:
+                return dict(task)
+            tasks_lock.wait(remaining)
 
 
 def create_task():
@@ -142,6 +227,8 @@ def create_task():
     with tasks_lock:
         tasks[task_id] = {
             'status': 'idle',  # idle, fetching, downloading, paused, cancelled, finished, error
+            'stage': None,  # fetching: metadata -> formats; thumbnail приходит отдельно (thumbnail_pending)
+            'version': 0,
             'progress': 0,
             'final_file': None,
             'url': '',
@@ -161,6 +248,124 @@ def index():
     return render_template('index.html')
 
 
+# Выполняющиеся получения форматов: нормализованный URL -> общая задача
+# {'state': последнее состояние, 'task_ids': подписанные задачи, 'cancel_event'}.
+# Повторный запрос того же URL подписывается на уже идущее извлечение
+format_fetches = {}
+
+
+def update_fetch(fetch, **kwargs):
+    """Обновляет общее получение форматов и все неотмененные задачи, подписанные на него"""
+    with tasks_lock:
+        fetch['state'].update(kwargs)
+        for task_id in fetch['task_ids']:
+            task = tasks.get(task_id)
+            if task and not task.get('cancelled'):
+                apply_task_update(task, kwargs)
+        tasks_lock.notify_all()
+
+
+def has_fetch_subscribers(fetch):
+    with tasks_lock:
+        return any(task_id in tasks and not tasks[task_id].get('cancelled') for task_id in fetch['task_ids'])
+
+
+def cancel_fetch_task(task_id):
+    """
+    Отменяет задачу получения форматов
+    
+    Если у ее извлечения не осталось других подписчиков, оно прерывается:
+    процесс извлечения завершается, а повторный запрос того же URL начнет новое.
+    """
+    with tasks_lock:
+        task = tasks.get(task_id)
+        if not task:
+            return
+        apply_task_update(task, {'cancelled': True, 'status': 'cancelled'})
+        key = normalize_url(task.get('url') or '')
+        fetch = format_fetches.get(key)
+        if fetch and task_id in fetch['task_ids'] and not has_fetch_subscribers(fetch):
+            fetch['cancel_event'].set()
+            del format_fetches[key]
+        tasks_lock.notify_all()
+
+
+def start_format_fetch(url, executor=None):
+    """
+    Создает задачу получения форматов для url; возвращает ее ID
+    
+    Если для того же (нормализованного) URL извлечение уже идет, задача
+    подписывается на него и получает его текущее состояние, а не запускает
+    второе извлечение. Каждая задача отменяется независимо.
+    
+    Args:
+        url: URL видео
+        executor: Пул, в котором выполнить извлечение (по умолчанию - отдельный поток)
+    """
+    task_id = create_task()
+    key = normalize_url(url)
+    with tasks_lock:
+        fetch = format_fetches.get(key)
+        if fetch is not None:
+            fetch['task_ids'].add(task_id)
+            apply_task_update(tasks[task_id], dict(fetch['state'], url=url))
+            log_debug(f"Fetch formats for {url} joined a running extraction")
+            return task_id
+        fetch = format_fetches[key] = {
+            'state': {'status': 'fetching'},
+            'task_ids': {task_id},
+            'cancel_event': threading.Event()
+        }
+        tasks[task_id].update(status='fetching', url=url)
+    thumbnail_requested = []
+    
+    def start_thumbnail(thumbnail_url):
+        """Thumbnail скачивается в фоне, как только известен его адрес"""
+        if not thumbnail_url or thumbnail_requested:
+            return
+        thumbnail_requested.append(thumbnail_url)
+        update_fetch(fetch, thumbnail_url=thumbnail_url, thumbnail_pending=True)
+        if not request_thumbnail(
+            url, thumbnail_url,
+            lambda path: update_fetch(fetch, thumbnail_path=path, thumbnail_pending=False)
+        ):
+            update_fetch(fetch, thumbnail_pending=False)
+    
+    def on_metadata(metadata):
+        # Название показывается, пока yt-dlp еще разбирает форматы
+        update_fetch(fetch, stage='metadata', title=metadata.get('title') or '',
+                     duration=metadata.get('duration'), uploader=metadata.get('uploader'))
+        start_thumbnail(metadata.get('thumbnail_url'))
+    
+    def finish(**kwargs):
+        # Следующие запросы этого URL начнут новое извлечение (info_cache уже заполнен)
+        with tasks_lock:
+            if format_fetches.get(key) is fetch:
+                del format_fetches[key]
+        update_fetch(fetch, **kwargs)
+    
+    def worker():
+        try:
+            # Thumbnail скачивается в фоне, форматы отдаются сразу
+            result = extraction_pool.get_formats(url, on_metadata=on_metadata, cancel_event=fetch['cancel_event'])
+            finish(status='idle', stage='formats', formats=result['formats'], title=result['title'])
+            start_thumbnail(result.get('thumbnail_url'))
+        except ExtractionCancelled:
+            log_debug(f"Fetch formats for {url} cancelled")
+            finish(status='cancelled')
+        except Exception as e:
+            log_error(f"Error fetching formats for {url}: {e}")
+            finish(status='error', error=str(e))
+    
+    if executor is not None:
+        executor.submit(worker)
+    else:
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        update_fetch(fetch, thread=thread)
+    return task_id
+
+
 @app.route('/api/fetch-formats', methods=['POST'])
 def fetch_formats():
     """Получение списка форматов для URL"""
@@ -170,62 +375,180 @@ def fetch_formats():
     if not url:
         return jsonify({'error': 'URL не указан'}), 400
     
-    task_id = create_task()
-    update_task(task_id, status='fetching', url=url)
+    return jsonify({'task_id': start_format_fetch(url)})
+
+
+# Пакетное получение форматов: ограниченный пул вместо потока на каждый URL
+FETCH_BATCH_WORKERS = 4
+FETCH_BATCH_MAX_URLS = 500
+FETCH_BATCH_TTL = 60 * 60  # секунды, после которых пакет и его задачи забываются
+
+# Пул потоков пакетного получения форматов (создается в init_app)
+format_fetch_executor = None
+
+# batch_id -> {'task_ids': [...], 'created_at': time.monotonic()}
+format_batches = {}
+
+
+def prune_format_batches():
+    """Забывает старые пакеты вместе с их задачами (вызывать под tasks_lock)"""
+    now = time.monotonic()
+    for batch_id, batch in list(format_batches.items()):
+        if now - batch['created_at'] > FETCH_BATCH_TTL:
+            for task_id in batch['task_ids']:
+                tasks.pop(task_id, None)
+            del format_batches[batch_id]
+
+
+def format_task_result(task):
+    """Результат одной задачи пакета для API"""
+    result = {
+        'task_id': task['task_id'],
+        'url': task.get('url', ''),
+        'status': task['status'],
+        'title': task.get('title'),
+        'thumbnail_path': task.get('thumbnail_path'),
+        'thumbnail_url': task.get('thumbnail_url')
+    }
+    if task['status'] == 'error':
+        result['error'] = task.get('error') or 'Неизвестная ошибка'
+    if task['status'] == 'idle' and 'formats' in task:
+        result['formats'] = task['formats']
+    return result
+
+
+def wait_batch(batch, since, timeout):
+    """
+    Ждет задачи пакета, завершившиеся после since (по finished_seq), не дольше timeout
     
-    def worker():
-        try:
-            # Проверяем отмену перед началом
-            task = get_task(task_id)
-            if task and task.get('cancelled'):
-                update_task(task_id, status='cancelled')
-                return
-            
-            result = get_formats(url, THUMBNAILS_FOLDER)
-            
-            # Проверяем отмену после получения форматов
-            task = get_task(task_id)
-            if task and task.get('cancelled'):
-                update_task(task_id, status='cancelled')
-                return
-            
-            update_task(task_id, status='idle', formats=result['formats'], title=result['title'], thumbnail_path=result.get('thumbnail_path'))
-        except Exception as e:
-            task = get_task(task_id)
-            if task and task.get('cancelled'):
-                update_task(task_id, status='cancelled')
-                return
-            log_error(f"Error fetching formats for task {task_id}: {e}")
-            update_task(task_id, status='error', error=str(e))
+    Returns:
+        (завершившиеся задачи по порядку завершения, все задачи пакета) - копии
+    """
+    deadline = time.monotonic() + timeout
+    with tasks_lock:
+        while True:
+            items = [dict(tasks[task_id], task_id=task_id) for task_id in batch['task_ids'] if task_id in tasks]
+            finished = [task for task in items if task.get('finished_seq', 0) > since]
+            all_done = all(task.get('finished_seq') for task in items)
+            remaining = deadline - time.monotonic()
+            if finished or all_done or remaining <= 0:
+                finished.sort(key=lambda task: task['finished_seq'])
+                return finished, items
+            tasks_lock.wait(remaining)
+
+
+@app.route('/api/fetch-formats/batch', methods=['POST'])
+def fetch_formats_batch():
+    """
+    Получение форматов для списка URL
     
-    thread = threading.Thread(target=worker, daemon=True)
-    thread.start()
-    update_task(task_id, thread=thread)
+    Извлечение идет в пуле из FETCH_BATCH_WORKERS потоков; результаты
+    забираются по мере готовности через /api/fetch-formats/batch/<batch_id>.
+    """
+    data = request.get_json(silent=True)
+    raw_urls = data.get('urls') if isinstance(data, dict) else None
+    if not isinstance(raw_urls, list) or not all(isinstance(url, str) for url in raw_urls):
+        return jsonify({'error': 'Ожидается объект со списком строк urls'}), 400
+    if len(raw_urls) > FETCH_BATCH_MAX_URLS:
+        return jsonify({'error': f'Не больше {FETCH_BATCH_MAX_URLS} URL за раз'}), 400
+    urls = []
+    for url in raw_urls:
+        url = url.strip()
+        if url and url not in urls:
+            urls.append(url)
+    if not urls:
+        return jsonify({'error': 'URL не указан'}), 400
     
-    return jsonify({'task_id': task_id})
+    with tasks_lock:
+        prune_format_batches()
+    task_ids = [start_format_fetch(url, format_fetch_executor) for url in urls]
+    batch_id = str(uuid.uuid4())
+    with tasks_lock:
+        format_batches[batch_id] = {'task_ids': task_ids, 'created_at': time.monotonic()}
+    log_info(f"Fetch formats batch {batch_id}: {len(urls)} URL(s)")
+    return jsonify({
+        'batch_id': batch_id,
+        'tasks': [{'url': url, 'task_id': task_id} for url, task_id in zip(urls, task_ids)]
+    })
+
+
+@app.route('/api/fetch-formats/batch/<batch_id>', methods=['GET'])
+def fetch_formats_batch_result(batch_id):
+    """
+    Результаты пакета, завершившиеся после cursor, и общий прогресс
+    
+    Query параметры:
+        cursor: cursor из предыдущего ответа (0 - с начала)
+        wait: Сколько секунд ждать новых результатов (не больше TASK_WAIT_MAX)
+    """
+    with tasks_lock:
+        batch = format_batches.get(batch_id)
+    if not batch:
+        return jsonify({'error': 'Пакет не найден'}), 404
+    cursor = request.args.get('cursor', 0, type=int)
+    wait = max(0.0, min(TASK_WAIT_MAX, request.args.get('wait', 0, type=float)))
+    finished, items = wait_batch(batch, cursor, wait)
+    return jsonify({
+        'batch_id': batch_id,
+        'total': len(items),
+        'done': sum(1 for task in items if task.get('finished_seq')),
+        'failed': sum(1 for task in items if task['status'] == 'error'),
+        'cursor': max([cursor] + [task['finished_seq'] for task in finished]),
+        'results': [format_task_result(task) for task in finished]
+    })
+
+
+@app.route('/api/fetch-formats/batch/<batch_id>/cancel', methods=['POST'])
+def cancel_fetch_formats_batch(batch_id):
+    """Отмена незавершенных задач пакета"""
+    with tasks_lock:
+        batch = format_batches.get(batch_id)
+        if not batch:
+            return jsonify({'error': 'Пакет не найден'}), 404
+        for task_id in batch['task_ids']:
+            task = tasks.get(task_id)
+            if task and not task.get('finished_seq'):
+                cancel_fetch_task(task_id)
+    return jsonify({'status': 'cancelled'})
 
 
 @app.route('/api/get-formats/<task_id>', methods=['GET'])
 def get_formats_result(task_id):
-    """Получение результата получения форматов"""
-    task = get_task(task_id)
+    """
+    Получение результата получения форматов
+    
+    Результат собирается по мере готовности: сначала название (stage=metadata),
+    затем форматы (stage=formats), thumbnail_path - когда скачается картинка.
+    
+    Query параметры:
+        since: version из предыдущего ответа - ответ вернется, когда задача изменится
+        wait: Сколько секунд ждать изменений (по умолчанию 0, не больше TASK_WAIT_MAX)
+    """
+    since = request.args.get('since', -1, type=int)
+    wait = max(0.0, min(TASK_WAIT_MAX, request.args.get('wait', 0, type=float)))
+    task = wait_task(task_id, since, wait)
     if not task:
         return jsonify({'error': 'Задача не найдена'}), 404
     
     if task['status'] == 'error':
-        return jsonify({'error': task.get('error', 'Неизвестная ошибка')}), 500
+        return jsonify({'error': task.get('error', 'Неизвестная ошибка'), 'version': task['version']}), 500
     
     if task['status'] == 'cancelled':
-        return jsonify({'status': 'cancelled'})
+        return jsonify({'status': 'cancelled', 'version': task['version']})
     
+    result = {
+        'status': task['status'],
+        'stage': task.get('stage'),
+        'version': task['version'],
+        'thumbnail_path': task.get('thumbnail_path'),
+        'thumbnail_url': task.get('thumbnail_url'),
+        'thumbnail_pending': task.get('thumbnail_pending', False)
+    }
+    if task.get('stage'):
+        result.update(title=task.get('title', ''), duration=task.get('duration'), uploader=task.get('uploader'))
     if task['status'] == 'idle' and 'formats' in task:
-        return jsonify({
-            'formats': task['formats'],
-            'title': task.get('title', ''),
-            'thumbnail_path': task.get('thumbnail_path')
-        })
-    
-    return jsonify({'status': task['status']})
+        result['formats'] = task['formats']
+    return jsonify(result)
 
 
 @app.route('/api/cancel-fetch-formats/<task_id>', methods=['POST'])
@@ -235,32 +558,21 @@ def cancel_fetch_formats(task_id):
     if not task:
         return jsonify({'error': 'Задача не найдена'}), 404
     
-    update_task(task_id, cancelled=True)
-    
-    # Пытаемся остановить поток, если он еще работает
-    thread = task.get('thread')
-    if thread and thread.is_alive():
-        # Поток daemon, так что он завершится сам, но мы помечаем задачу как отмененную
-        pass
+    # Отменяется только эта задача: другие подписчики того же извлечения
+    # продолжают получать результат, без подписчиков извлечение прерывается
+    cancel_fetch_task(task_id)
     
     return jsonify({'status': 'cancelled'})
 
 
-def start_queue_download(queue_id, queue_item):
-    """Запуск загрузки из очереди"""
+def run_queue_download(queue_id, queue_item, task_id):
+    """Загрузка элемента очереди (выполняется в воркере планировщика)"""
     url = queue_item['url']
     format_id = queue_item['format_id']
     audio_only = bool(queue_item['audio_only'])
     download_folder = queue_item['download_folder']
     title = queue_item.get('title', '')
     
-    if not title:
-        result = get_formats(url)
-        title = result.get('title', '')
-    
-    task_id = str(uuid.uuid4())
-    db.update_queue_item(queue_id, status='downloading', task_id=task_id)
-    
     paused_flag = {'value': False}
     cancelled_flag = {'value': False}
     final_file = ['']
@@ -273,15 +585,30 @@ def start_queue_download(queue_id, queue_item):
             'format_id': format_id,
             'audio_only': audio_only,
             'progress': 0,
+            'downloaded_bytes': 0,
+            'total_bytes': None,
+            'speed': None,
+            'eta': None,
             'paused': False,
             'paused_flag': paused_flag,
             'cancelled_flag': cancelled_flag,
             'retry_status': None  # Статус повторных попыток
         }
+    publish_queue_changed()
     
-    def progress_callback(percent):
+    def progress_callback(progress):
+        # Вызывается не чаще PROGRESS_UPDATE_INTERVAL, скорость заодно уходит регулятору параллельности
+        adaptive_concurrency.report_progress(task_id, progress['speed'] or 0)
         with active_tasks_lock:
-            active_tasks[task_id]['progress'] = percent
+            task = active_tasks.get(task_id)
+            if task:
+                if progress['percent'] is not None:
+                    task['progress'] = progress['percent']
+                task['downloaded_bytes'] = progress['downloaded_bytes']
+                task['total_bytes'] = progress['total_bytes']
+                task['speed'] = progress['speed']
+                task['eta'] = progress['eta']
+                publish_task_progress(task)
     
     def final_file_callback(filename):
         final_file[0] = filename
@@ -289,66 +616,298 @@ def start_queue_download(queue_id, queue_item):
     def retry_status_callback(status):
         """Обновляет статус повторных попыток"""
         with active_tasks_lock:
-            if task_id in active_tasks:
-                active_tasks[task_id]['retry_status'] = status
+            task = active_tasks.get(task_id)
+            if task and task.get('retry_status') != status:
+                task['retry_status'] = status
+                publish_task_progress(task)
+    
+    def error_callback(error):
+        adaptive_concurrency.report_error()
     
     logger = CustomLogger(final_file_callback=final_file_callback)
     
-    def worker():
-        try:
-            download_video(
-                url=url,
-                format_id=format_id,
-                download_folder=download_folder,
-                audio_only=audio_only,
+    try:
+        # Сокращенный info_dict, сохраненный при добавлении в очередь
+        info = None
+        if queue_item.get('info_json'):
+            try:
+                info = json.loads(queue_item['info_json'])
+            except ValueError as e:
+                log_warning(f"Invalid info_json for queue item {queue_id}: {e}")
+        
+        if not title:
+            # Извлечение - в процессе пула; info_dict попадет в общий info_cache и пригодится загрузке
+            title = info.get('title', '') if info else extraction_pool.get_formats(url).get('title', '')
+        
+        download_kwargs = {
+            'url': url,
+            'format_id': format_id,
+            'download_folder': download_folder,
+            'audio_only': audio_only,
+            'info': info,
+            'postprocess': False
+        }
+        if db.get_all_ui_state().get('process_isolation') == 'true':
+            # Загрузка в отдельном процессе: сбой экстрактора не задевает приложение, отмена - kill
+            postprocess_plan = download_process_pool.download(
+                download_kwargs,
+                progress_callback=progress_callback,
+                final_file_callback=final_file_callback,
+                retry_status_callback=retry_status_callback,
+                error_callback=error_callback,
+                paused_flag=paused_flag,
+                cancelled_flag=cancelled_flag,
+                rate_limiter=bandwidth_limiter,
+                usage_callback=lambda usage: db.update_queue_item(queue_id, usage_json=json.dumps(usage)),
+                label=f"for queue item {queue_id}"
+            )
+        else:
+            postprocess_plan = download_video(
                 progress_callback=progress_callback,
                 logger=logger,
                 paused_flag=paused_flag,
                 cancelled_flag=cancelled_flag,
                 final_file_callback=final_file_callback,
-                retry_status_callback=retry_status_callback
+                retry_status_callback=retry_status_callback,
+                error_callback=error_callback,
+                rate_limiter=bandwidth_limiter,
+                **download_kwargs
             )
-            with active_tasks_lock:
-                del active_tasks[task_id]
-            
-            # Используем существующий thumbnail из очереди или скачиваем новый
-            thumbnail_path = queue_item.get('thumbnail_path')
-            if not thumbnail_path:
-                try:
-                    video_id = get_video_id(url=url)
-                    if video_id:
-                        video_id = video_id[:16]  # Обрезаем до 16 символов для совместимости
-                    thumbnail_path = download_thumbnail(url, THUMBNAILS_FOLDER, video_id)
-                except Exception as e:
-                    log_error(f"Error downloading thumbnail: {e}")
-            
-            # Получаем format_label из очереди
-            format_label = queue_item.get('format_label')
-            db.add_to_history(url, title, format_id, audio_only, 'finished', final_file[0], thumbnail_path, format_label)
-            db.delete_queue_item(queue_id)
-            start_next_queue_item()
-        except Exception as e:
-            with active_tasks_lock:
-                if task_id in active_tasks:
-                    del active_tasks[task_id]
-            status = 'cancelled' if 'cancelled' in str(e).lower() else 'error'
-            # Получаем format_label из очереди
-            format_label = queue_item.get('format_label')
-            db.add_to_history(url, title, format_id, audio_only, status, '', None, format_label)
-            db.delete_queue_item(queue_id)
-            start_next_queue_item()
-    
-    threading.Thread(target=worker, daemon=True).start()
-
-def start_next_queue_item():
-    """Запуск следующего элемента из очереди если есть место"""
-    if db.count_active_downloads() >= 3:
+        with active_tasks_lock:
+            active_tasks.pop(task_id, None)
+        
+        if postprocess_plan:
+            # Данные уже на диске: сетевой слот освобождается, ffmpeg выполнится в пуле постобработки
+            db.update_queue_item(queue_id, status='postprocessing', title=title,
+                                 postprocess_json=json.dumps(postprocess_plan))
+            postprocess_pool.submit(queue_id)
+            publish_queue_changed()
+            return
+        
+        finish_queue_item(queue_item, title, final_file[0])
+    except DownloadPaused:
+        # Загрузка оборвана паузой: слот воркера освобождается, .part файл остается
+        with active_tasks_lock:
+            active_tasks.pop(task_id, None)
+            resumed = not paused_flag['value']
+        if shutting_down.is_set():
+            # Приложение закрывается - элемент продолжится при следующем запуске
+            db.release_queue_item(queue_id, task_id, 'interrupted')
+        elif resumed:
+            # Возобновление пришло, пока загрузка останавливалась - ставим обратно в очередь
+            db.release_queue_item(queue_id, task_id, 'pending')
+            scheduler.submit(queue_id, url, start=True)
+        else:
+            db.release_queue_item(queue_id, task_id, 'paused')
+        publish_queue_changed()
+    except Exception as e:
+        with active_tasks_lock:
+            active_tasks.pop(task_id, None)
+        status = 'cancelled' if 'cancelled' in str(e).lower() else 'error'
+        # Получаем format_label из очереди
+        format_label = queue_item.get('format_label')
+        db.add_to_history(url, title, format_id, audio_only, status, '', None, format_label)
+        db.delete_queue_item(queue_id)
+        publish_queue_changed()
+        publish_history_changed()
+    finally:
+        adaptive_concurrency.finish(task_id)
+        event_broker.discard(f"progress:{queue_id}")
+
+
+def finish_queue_item(queue_item, title, file_path):
+    """Переносит завершенный элемент очереди в историю"""
+    url = queue_item['url']
+    
+    # Используем существующий thumbnail из очереди, иначе скачиваем его в фоне
+    thumbnail_path = queue_item.get('thumbnail_path')
+    
+    # Получаем format_label из очереди
+    format_label = queue_item.get('format_label')
+    db.add_to_history(url, title, queue_item['format_id'], bool(queue_item['audio_only']), 'finished',
+                      file_path, thumbnail_path, format_label)
+    db.delete_queue_item(queue_item['id'])
+    publish_queue_changed()
+    publish_history_changed()
+    
+    if not thumbnail_path:
+        def on_thumbnail(path):
+            if path:
+                db.set_history_thumbnail(url, path)
+                publish_history_changed()
+        request_thumbnail(url, get_thumbnail_url(queue_item), on_thumbnail)
+
+
+def get_thumbnail_url(queue_item):
+    """URL картинки из сохраненной в очереди информации о видео (без обращения к сети)"""
+    info = None
+    if queue_item.get('info_json'):
+        try:
+            info = json.loads(queue_item['info_json'])
+        except ValueError:
+            info = None
+    if info is None:
+        info = info_cache.get(queue_item['url'])
+    return (info or {}).get('thumbnail')
+
+
+def run_queue_postprocess(queue_id):
+    """Постобработка элемента очереди (выполняется в пуле постобработки)"""
+    queue_item = db.get_queue_item(queue_id)
+    if not queue_item or queue_item['status'] != 'postprocessing':
+        # Элемент удален из очереди, пока ждал постобработки
         return
+    title = queue_item.get('title', '')
+    try:
+        file_path = run_postprocessing(json.loads(queue_item['postprocess_json']))
+        finish_queue_item(queue_item, title, file_path)
+    except Exception as e:
+        log_error(f"Post-processing failed for queue item {queue_id}: {e}")
+        db.add_to_history(queue_item['url'], title, queue_item['format_id'], bool(queue_item['audio_only']),
+                          'error', '', None, queue_item.get('format_label'))
+        db.delete_queue_item(queue_id)
+        publish_queue_changed()
+        publish_history_changed()
+
+
+def load_int_setting(key, default):
+    """Целочисленная настройка из ui_state"""
+    try:
+        return int(db.get_all_ui_state().get(key, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def load_host_limits():
+    """Индивидуальные лимиты загрузок на хост из ui_state"""
+    try:
+        return json.loads(db.get_all_ui_state().get('host_limits') or '{}')
+    except ValueError:
+        return {}
+
+
+# Планировщик очереди загрузок, пулы и фоновое обслуживание создаются в init_app
+scheduler = None
+# Пул постобработки (ffmpeg), отдельный от сетевых слотов планировщика
+postprocess_pool = None
+# Процессы получения форматов и загрузок в отдельных процессах
+extraction_pool = None
+download_process_pool = None
+# Фоновая загрузка thumbnails: ответы API и перенос в историю ее не ждут
+thumbnail_pool = None
+# Общее ограничение скорости для всех загрузок (0 - без ограничения)
+bandwidth_limiter = None
+# Фоновая сверка истории с файлами на диске и обслуживание папки thumbnails
+history_reconciler = None
+thumbnail_janitor = None
+# Адаптивный регулятор параллельности (включается настройкой adaptive_concurrency)
+adaptive_concurrency = None
+
+
+def request_thumbnail(url, thumbnail_url, callback):
+    """
+    Ставит скачивание thumbnail в пул; callback(path) вызывается по готовности
+    
+    Если thumbnail_url неизвестен, адрес картинки извлекается из страницы url
+    (тоже в пуле). Возвращает False, если пул переполнен.
+    """
+    keep_original = bool(load_int_setting('thumbnail_keep_original', 0))
+    
+    def job():
+        # Страница разбирается в процессе пула извлечения, а не в потоке приложения
+        source_url = thumbnail_url or extraction_pool.get_formats(url).get('thumbnail_url')
+        if not source_url:
+            return None
+        return fetch_thumbnail(source_url, THUMBNAILS_FOLDER, db, keep_original)
     
-    pending = db.get_pending_queue()
-    if pending:
-        item = pending[0]
-        start_queue_download(item['id'], item)
+    return thumbnail_pool.submit(thumbnail_url or url, job, callback)
+
+
+def init_app():
+    """
+    Открывает БД и создает планировщик, пулы и фоновые службы
+    
+    Вызывается только из __main__: процессы пулов (spawn) импортируют этот
+    модуль заново, и импорт не должен открывать БД и запускать потоки.
+    """
+    global db, scheduler, postprocess_pool, extraction_pool, download_process_pool, thumbnail_pool, format_fetch_executor
+    global bandwidth_limiter, history_reconciler, thumbnail_janitor, adaptive_concurrency
+    
+    os.makedirs(THUMBNAILS_FOLDER, exist_ok=True)
+    db = Database()
+    
+    scheduler = DownloadScheduler(
+        db, run_queue_download,
+        max_workers=load_int_setting('max_concurrent_downloads', DEFAULT_MAX_WORKERS),
+        per_host_limit=load_int_setting('per_host_limit', DEFAULT_PER_HOST_LIMIT),
+        host_limits=load_host_limits()
+    )
+    postprocess_pool = PostProcessPool(run_queue_postprocess)
+    extraction_pool = ExtractionPool(load_int_setting('extraction_workers', DEFAULT_EXTRACTION_WORKERS))
+    download_process_pool = DownloadProcessPool(lambda: scheduler.max_workers)
+    thumbnail_pool = ThumbnailPool()
+    format_fetch_executor = ThreadPoolExecutor(max_workers=FETCH_BATCH_WORKERS, thread_name_prefix='fetch-formats')
+    bandwidth_limiter = BandwidthLimiter(load_int_setting('bandwidth_limit', 0))
+    
+    history_reconciler = HistoryReconciler(db, on_change=publish_history_changed)
+    thumbnail_janitor = ThumbnailJanitor(
+        db, THUMBNAILS_FOLDER,
+        get_max_bytes=lambda: max(0, load_int_setting('thumbnail_cache_limit_mb', DEFAULT_THUMBNAIL_CACHE_LIMIT_MB)) * 1024 * 1024,
+        on_change=publish_thumbnails_changed
+    )
+    
+    # Частота отправки событий клиентам
+    event_broker.set_max_rate(load_int_setting('event_max_rate', DEFAULT_EVENT_RATE))
+    
+    adaptive_concurrency = AdaptiveConcurrency(scheduler)
+
+# Выставляется при закрытии приложения: оборванные загрузки помечаются как interrupted
+shutting_down = threading.Event()
+
+# Сколько ждать остановки активных загрузок при закрытии
+SHUTDOWN_TIMEOUT = 5  # секунды
+
+
+def recover_interrupted_downloads():
+    """
+    Восстановление очереди после падения или закрытия приложения
+    
+    Элементы в статусе downloading (процесс умер посреди загрузки) и interrupted
+    (загрузка остановлена при закрытии) возвращаются в pending. yt-dlp
+    продолжит их с места остановки по .part/.ytdl файлам в папке загрузки.
+    Элементы, ожидавшие постобработки, снова ставятся в пул постобработки.
+    """
+    for item in db.get_queue_by_status('postprocessing'):
+        log_info(f"Queue item {item['id']} resumes post-processing")
+        postprocess_pool.submit(item['id'])
+    
+    recovered = db.requeue_interrupted()
+    for item in recovered:
+        partial_files = find_partial_files(item['download_folder'], item.get('title'))
+        if partial_files:
+            log_info(f"Queue item {item['id']} will resume from {len(partial_files)} partial file(s): "
+                     f"{', '.join(os.path.basename(path) for path in partial_files)}")
+        else:
+            log_info(f"Queue item {item['id']} has no partial files, it will restart from the beginning")
+    if recovered:
+        log_info(f"Recovered {len(recovered)} interrupted download(s)")
+        scheduler.start()
+        publish_queue_changed()
+    return len(recovered)
+
+
+def shutdown_downloads():
+    """Останавливает активные загрузки при закрытии, сохраняя .part файлы для продолжения"""
+    shutting_down.set()
+    scheduler.stop()
+    with active_tasks_lock:
+        for task_id, task in active_tasks.items():
+            task['paused_flag']['value'] = True
+            db.update_queue_item(task['queue_id'], status='interrupted')
+    # Даем воркерам закрыть соединения и дописать состояние фрагментов
+    deadline = time.time() + SHUTDOWN_TIMEOUT
+    while scheduler.active_count() and time.time() < deadline:
+        time.sleep(0.1)
 
 @app.route('/api/config', methods=['GET'])
 def get_config():
@@ -359,6 +918,12 @@ def get_config():
     })
 
 
+@app.route('/api/info-cache/stats', methods=['GET'])
+def get_info_cache_stats():
+    """Статистика кэша информации о видео"""
+    return jsonify(info_cache.stats())
+
+
 @app.route('/api/log-error', methods=['POST'])
 def log_frontend_error_endpoint():
     """Логирование ошибок с фронтенда"""
@@ -390,7 +955,7 @@ def queue_add():
             # Fallback: получаем форматы только если format_label не был передан
             # (это может произойти при прямом вызове API или старом фронтенде)
             try:
-                result = get_formats(url)
+                result = extraction_pool.get_formats(url)
                 formats = result.get('formats', [])
                 for fmt in formats:
                     if fmt.get('format_id') == format_id:
@@ -406,59 +971,172 @@ def queue_add():
         else:
             format_label = format_id if format_id else 'Unknown format'
     
-    queue_id = db.add_to_queue(url, title, format_id, audio_only, download_folder, thumbnail_path, format_label)
+    # Сохраняем уже полученную информацию о видео, чтобы воркер не извлекал страницу повторно
+    info_json = None
+    cached_info = info_cache.get(url)
+    if cached_info is not None:
+        info_json = json.dumps(trim_info(cached_info, format_id, audio_only))
+    
+    queue_id = db.add_to_queue(url, title, format_id, audio_only, download_folder, thumbnail_path, format_label, info_json)
+    # Если очередь уже скачивается, элемент будет подхвачен свободным воркером
+    scheduler.submit(queue_id, url)
+    publish_queue_changed()
+    
+    # Thumbnail еще скачивается (или не скачивался) - подставим его, когда будет готов
+    thumbnail_url = data.get('thumbnail_url') or (cached_info or {}).get('thumbnail')
+    if not thumbnail_path and thumbnail_url:
+        def on_thumbnail(path):
+            if path:
+                db.set_queue_thumbnail(queue_id, path)
+                publish_queue_changed()
+        request_thumbnail(url, thumbnail_url, on_thumbnail)
     return jsonify({'queue_id': queue_id})
 
+@app.route('/api/events')
+def events():
+    """Поток изменений очереди (Server-Sent Events): progress, queue, history"""
+    return Response(event_broker.stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
 @app.route('/api/queue/list', methods=['GET'])
 def queue_list():
     """Список очереди"""
     queue = db.get_queue()
     with active_tasks_lock:
         for item in queue:
+            item.pop('info_json', None)
+            item.pop('postprocess_json', None)
+            # Учет ресурсов последней загрузки в отдельном процессе (см. JobUsage)
+            usage_json = item.pop('usage_json', None)
+            item['usage'] = json.loads(usage_json) if usage_json else None
             if item['task_id'] and item['task_id'] in active_tasks:
-                task = active_tasks[item['task_id']]
-                item['progress'] = task['progress']
-                item['paused'] = task['paused']
-                item['retry_status'] = task.get('retry_status')
-    return jsonify({'queue': queue})
+                item.update(get_task_progress(active_tasks[item['task_id']]))
+    return jsonify({'queue': queue, 'running': scheduler.running})
 
 @app.route('/api/queue/start', methods=['POST'])
 def queue_start():
     """Запуск загрузки очереди"""
-    while db.count_active_downloads() < 3:
-        pending = db.get_pending_queue()
-        if not pending:
-            break
-        item = pending[0]
-        start_queue_download(item['id'], item)
+    scheduler.start()
     return jsonify({'status': 'started'})
 
+
+@app.route('/api/queue/concurrency', methods=['GET', 'POST'])
+def queue_concurrency():
+    """Получение и изменение количества параллельных загрузок"""
+    if request.method == 'POST':
+        data = request.json or {}
+        if 'max_workers' in data:
+            try:
+                max_workers = int(data.get('max_workers'))
+            except (TypeError, ValueError):
+                return jsonify({'error': 'max_workers должен быть числом'}), 400
+            max_workers = scheduler.set_max_workers(max_workers)
+            db.save_ui_state('max_concurrent_downloads', max_workers)
+        if 'adaptive' in data:
+            adaptive = bool(data.get('adaptive'))
+            adaptive_concurrency.set_enabled(adaptive)
+            db.save_ui_state('adaptive_concurrency', 'true' if adaptive else 'false')
+    return jsonify({
+        'max_workers': scheduler.max_workers,
+        'adaptive': adaptive_concurrency.enabled,
+        'active': scheduler.active_count()
+    })
+
+@app.route('/api/queue/limits', methods=['GET', 'POST'])
+def queue_limits():
+    """Получение и изменение лимитов: общая скорость (байт/с) и загрузки на хост"""
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        if not isinstance(data, dict):
+            return jsonify({'error': 'Ожидается объект с лимитами'}), 400
+        host_limits = data.get('host_limits')
+        if host_limits is not None and not isinstance(host_limits, dict):
+            return jsonify({'error': 'host_limits должен быть объектом {host: limit}'}), 400
+        # Сначала проверяются все поля: неверный запрос не должен применить лимиты частично
+        try:
+            bandwidth_limit = max(0, int(data.get('bandwidth_limit') or 0))
+            per_host_limit = max(0, int(data.get('per_host_limit', scheduler.per_host_limit) or 0))
+            if host_limits is not None:
+                host_limits = normalize_host_limits(host_limits)
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Лимиты должны быть числами'}), 400
+        
+        if 'bandwidth_limit' in data:
+            bandwidth_limiter.set_rate(bandwidth_limit)
+            db.save_ui_state('bandwidth_limit', bandwidth_limit)
+        if 'per_host_limit' in data or 'host_limits' in data:
+            scheduler.set_host_limits(per_host_limit, host_limits)
+            db.save_ui_states({
+                'per_host_limit': scheduler.per_host_limit,
+                'host_limits': json.dumps(scheduler.host_limits)
+            })
+    return jsonify({
+        'bandwidth_limit': bandwidth_limiter.rate,
+        'per_host_limit': scheduler.per_host_limit,
+        'host_limits': scheduler.host_limits
+    })
+
 @app.route('/api/queue/pause', methods=['POST'])
 def queue_pause():
-    """Пауза всех загрузок"""
+    """Пауза всех загрузок: соединения закрываются, .part файлы сохраняются"""
+    scheduler.stop()
     with active_tasks_lock:
         for task_id, task in active_tasks.items():
             task['paused_flag']['value'] = True
             task['paused'] = True
             queue_id = task['queue_id']
             db.update_queue_item(queue_id, status='paused')
+    publish_queue_changed()
     return jsonify({'status': 'paused'})
 
-@app.route('/api/queue/resume', methods=['POST'])
-def queue_resume():
-    """Возобновление всех загрузок"""
+@app.route('/api/queue/pause/<int:queue_id>', methods=['POST'])
+def queue_pause_item(queue_id):
+    """Пауза одного элемента: его слот достается следующему элементу очереди"""
+    scheduler.discard(queue_id)
+    with active_tasks_lock:
+        for task_id, task in active_tasks.items():
+            if task['queue_id'] == queue_id:
+                task['paused_flag']['value'] = True
+                task['paused'] = True
+        db.update_queue_item(queue_id, status='paused')
+    publish_queue_changed()
+    return jsonify({'status': 'paused'})
+
+def resume_queue_items(queue_id=None):
+    """Снимает паузу со всех элементов (или с одного) и возвращает их в очередь"""
     with active_tasks_lock:
         for task_id, task in active_tasks.items():
-            if task['paused']:
+            if task['paused'] and (queue_id is None or task['queue_id'] == queue_id):
+                # Загрузка еще не успела остановиться - просто продолжаем её
                 task['paused_flag']['value'] = False
                 task['paused'] = False
-                queue_id = task['queue_id']
-                db.update_queue_item(queue_id, status='downloading')
+                db.update_queue_item(task['queue_id'], status='downloading')
+        active_queue_ids = {task['queue_id'] for task in active_tasks.values()}
+        db.resume_paused_queue(queue_id, exclude_ids=active_queue_ids)
+    publish_queue_changed()
+
+@app.route('/api/queue/resume', methods=['POST'])
+def queue_resume():
+    """Возобновление всех загрузок (продолжаются с места остановки)"""
+    resume_queue_items()
+    scheduler.start()
+    return jsonify({'status': 'resumed'})
+
+@app.route('/api/queue/resume/<int:queue_id>', methods=['POST'])
+def queue_resume_item(queue_id):
+    """Возобновление одного элемента"""
+    resume_queue_items(queue_id)
+    queue_item = db.get_queue_item(queue_id)
+    if queue_item:
+        scheduler.submit(queue_id, queue_item['url'], start=True)
     return jsonify({'status': 'resumed'})
 
 @app.route('/api/queue/stop', methods=['POST'])
 def queue_stop():
     """Остановка всех загрузок"""
+    scheduler.stop()
     with active_tasks_lock:
         for task_id, task in list(active_tasks.items()):
             task['cancelled_flag']['value'] = True
@@ -466,41 +1144,96 @@ def queue_stop():
             db.update_queue_item(queue_id, status='cancelled')
             del active_tasks[task_id]
     db.clear_queue()
+    publish_queue_changed()
     return jsonify({'status': 'stopped'})
 
+# Размер страницы истории по умолчанию и максимальный
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+
+
+def encode_history_cursor(item):
+    """Курсор следующей страницы истории по последней записи текущей"""
+    return f"{item['created_at']}|{item['id']}"
+
+
+def decode_history_cursor(cursor):
+    """Разбирает курсор страницы истории; возвращает (created_at, id) или None"""
+    if not cursor:
+        return None
+    created_at, _, history_id = cursor.rpartition('|')
+    try:
+        return created_at, int(history_id)
+    except ValueError:
+        return None
+
+
 @app.route('/api/history', methods=['GET'])
 def get_history():
-    """Получение истории скачиваний"""
-    history = db.get_history()
+    """
+    Получение истории скачиваний (постранично)
     
-    # Получаем все URL из очереди для проверки
-    queue = db.get_queue()
-    queue_urls = {item.get('url') for item in queue if item.get('url')}
-    
-    # Проверяем существование файлов и удаляем несуществующие
-    valid_history = []
-    for item in history:
-        file_path = item.get('file_path', '')
-        
-        # Если есть путь к файлу, проверяем его существование
-        if file_path and file_path.strip():
-            if not os.path.exists(file_path) or not os.path.isfile(file_path):
-                # Файл не существует, проверяем, есть ли этот URL в очереди
-                item_url = item.get('url', '')
-                if item_url not in queue_urls:
-                    # Удаляем из истории, если файла нет и его нет в очереди
-                    db.delete_history_item(item['id'])
-                    continue
-        
-        valid_history.append(item)
+    Параметры: limit - размер страницы, cursor - next_cursor из предыдущего ответа
+    """
+    limit = max(1, min(HISTORY_MAX_PAGE_SIZE, request.args.get('limit', HISTORY_PAGE_SIZE, type=int)))
+    # Записи с удаленными файлами отсеивает HistoryReconciler (колонка file_missing)
+    history = db.get_history(limit, decode_history_cursor(request.args.get('cursor')))
+    next_cursor = encode_history_cursor(history[-1]) if len(history) == limit else None
+    return jsonify({'history': history, 'next_cursor': next_cursor})
+
+@app.route('/api/history/search', methods=['GET'])
+def search_history():
+    """
+    Поиск по истории (название, URL, формат), результаты по релевантности
     
-    return jsonify({'history': valid_history})
+    Параметры: q - строка поиска, limit - размер страницы, cursor - next_cursor из предыдущего ответа
+    """
+    text = request.args.get('q', '').strip()
+    if not text:
+        return jsonify({'history': [], 'next_cursor': None})
+    limit = max(1, min(HISTORY_MAX_PAGE_SIZE, request.args.get('limit', HISTORY_PAGE_SIZE, type=int)))
+    offset = max(0, request.args.get('cursor', 0, type=int))
+    history = db.search_history(text, limit, offset)
+    next_cursor = str(offset + limit) if len(history) == limit else None
+    return jsonify({'history': history, 'next_cursor': next_cursor})
+
+# Имя файла в хранилище thumbnails - хэш содержимого, поэтому он никогда не меняется
+THUMBNAIL_CACHE_MAX_AGE = 365 * 24 * 60 * 60  # секунды
 
 @app.route('/api/thumbnail/<path:filename>')
 def get_thumbnail(filename):
-    """Отдача thumbnail файла"""
+    """
+    Отдача thumbnail файла
+    
+    Query параметры:
+        variant: list (по умолчанию) - уменьшенный вариант для списков,
+            original - оригинал, если он сохранен
+    """
     from flask import send_from_directory
-    return send_from_directory(THUMBNAILS_FOLDER, filename)
+    if request.args.get('variant') == 'original':
+        filename = find_original_thumbnail(THUMBNAILS_FOLDER, filename)
+    thumbnail_janitor.touch(filename)
+    match = THUMBNAIL_NAME_RE.match(filename)
+    if not match:
+        # Старые thumbnails (<video_id>.<ext>) могут быть перезаписаны - без долгого кэширования
+        return send_from_directory(THUMBNAILS_FOLDER, filename)
+    response = send_from_directory(THUMBNAILS_FOLDER, filename, etag=False, max_age=THUMBNAIL_CACHE_MAX_AGE)
+    response.set_etag(filename.split('.', 1)[0])
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response.make_conditional(request)
+
+def release_thumbnail(thumbnail_path):
+    """Удаляет файл thumbnail, если на него больше не ссылается ни одна запись очереди или истории"""
+    if not thumbnail_path or db.count_thumbnail_references(thumbnail_path):
+        return
+    safe_delete_thumbnail(thumbnail_path)
+    # Вместе с уменьшенным вариантом удаляем и сохраненный оригинал
+    filename = os.path.basename(thumbnail_path)
+    original = find_original_thumbnail(THUMBNAILS_FOLDER, filename)
+    if original != filename:
+        safe_delete_thumbnail(os.path.join(THUMBNAILS_FOLDER, original))
+    db.delete_thumbnail_records(os.path.basename(thumbnail_path))
 
 @app.route('/api/history/delete/<int:history_id>', methods=['POST'])
 def delete_history_item(history_id):
@@ -519,11 +1252,11 @@ def delete_history_item(history_id):
                 except Exception as e:
                     log_error(f"Error deleting file {file_path}: {e}")
     
-    # Удаляем thumbnail файл если он существует
-    if history_item and history_item.get('thumbnail_path'):
-        safe_delete_thumbnail(history_item['thumbnail_path'])
-    
     db.delete_history_item(history_id)
+    
+    # Удаляем thumbnail файл, если он больше никем не используется
+    if history_item:
+        release_thumbnail(history_item.get('thumbnail_path'))
     return jsonify({'status': 'deleted'})
 
 @app.route('/api/history/file/<int:history_id>', methods=['GET'])
@@ -548,6 +1281,7 @@ def open_file():
 def get_clipboard():
     """Получение текста из буфера обмена"""
     try:
+        from PyQt5.QtWidgets import QApplication
         app_qt = QApplication.instance()
         if app_qt is None:
             app_qt = QApplication([])
@@ -659,6 +1393,7 @@ def open_folder():
 @app.route('/api/queue/delete/<int:queue_id>', methods=['POST'])
 def delete_queue_item(queue_id):
     """Удаление элемента из очереди"""
+    scheduler.discard(queue_id)
     queue_item = db.get_queue_item(queue_id)
     if queue_item and queue_item.get('task_id'):
         task_id = queue_item['task_id']
@@ -667,20 +1402,19 @@ def delete_queue_item(queue_id):
                 active_tasks[task_id]['cancelled_flag']['value'] = True
                 del active_tasks[task_id]
     
-    # Удаляем thumbnail файл если он существует
-    if queue_item and queue_item.get('thumbnail_path'):
-        safe_delete_thumbnail(queue_item['thumbnail_path'])
-    
     db.delete_queue_item(queue_id)
+    
+    # Удаляем thumbnail файл, если он больше никем не используется
+    if queue_item:
+        release_thumbnail(queue_item.get('thumbnail_path'))
+    publish_queue_changed()
     return jsonify({'status': 'deleted'})
 
 @app.route('/api/ui-state', methods=['GET', 'POST'])
 def ui_state():
     """Сохранение и загрузка UI состояния"""
     if request.method == 'POST':
-        data = request.json
-        for key, value in data.items():
-            db.save_ui_state(key, value)
+        db.save_ui_states(request.json or {})
         return jsonify({'status': 'saved'})
     else:
         state = db.get_all_ui_state()
@@ -692,10 +1426,32 @@ def start_flask():
 
 
 if __name__ == '__main__':
+    # В собранном приложении процессы пула извлечения запускают этот же exe
+    multiprocessing.freeze_support()
+    
+    os.environ['WEBVIEW_BACKEND'] = 'qt'
+    import webview
+    
+    clear_log_file()
     log_info("=" * 80)
     log_info("Video Downloader - Starting application")
     log_info("=" * 80)
     
+    init_app()
+    
+    if db.get_all_ui_state().get('adaptive_concurrency') == 'true':
+        adaptive_concurrency.set_enabled(True)
+    
+    # Процессы извлечения импортируют yt_dlp, пока запускается интерфейс
+    extraction_pool.start()
+    if db.get_all_ui_state().get('process_isolation') == 'true':
+        download_process_pool.start()
+    
+    # Продолжаем загрузки, оборванные прошлым запуском
+    recover_interrupted_downloads()
+    history_reconciler.start()
+    thumbnail_janitor.start()
+    
     # Запускаем Flask в отдельном потоке
     threading.Thread(target=start_flask, daemon=True).start()
     
@@ -722,4 +1478,10 @@ if __name__ == '__main__':
     except Exception as e:
         log_error(f"Failed to start webview: {e}")
         raise
+    finally:
+        log_info("Shutting down: saving state of active downloads")
+        shutdown_downloads()
+        extraction_pool.close()
+        download_process_pool.close()
+        db.close()
 
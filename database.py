@@ -1,178 +1,633 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import queue
 import sqlite3
+import threading
+from contextlib import contextmanager
+
+from logger import log_info, log_error, log_warning
 
 DB_PATH = 'downloads.db'
 
-class Database:
-    def __init__(self):
-        self.conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-        self.init_db()
+# Сколько ждать освобождения блокировки БД другим соединением
+DB_BUSY_TIMEOUT = 5.0  # секунды
+
+# Сколько простаивающих соединений держать в пуле
+DB_POOL_SIZE = 8
+
+# Отложенная запись (write-behind): изменения копятся и фиксируются одной транзакцией
+WRITE_BEHIND_INTERVAL = 0.2  # секунды между сбросами журнала
+WRITE_BEHIND_BATCH = 100  # при таком количестве изменений журнал сбрасывается сразу
+
+
+def rows_to_dicts(cursor):
+    """Преобразует результат запроса в список dict"""
+    rows = cursor.fetchall()
+    columns = [desc[0] for desc in cursor.description]
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def add_column(cursor, table, column, definition):
+    """Добавляет колонку, если её еще нет"""
+    cursor.execute(f'PRAGMA table_info({table})')
+    if column not in {row[1] for row in cursor.fetchall()}:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+
+def migrate_base_schema(cursor):
+    """1: исходные таблицы и колонки, которые раньше добавлялись через ALTER TABLE"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS download_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            url TEXT,
+            title TEXT,
+            format_id TEXT,
+            audio_only INTEGER,
+            status TEXT,
+            file_path TEXT,
+            thumbnail_path TEXT,
+            format_label TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # БД, созданные до появления колонок
+    add_column(cursor, 'download_history', 'thumbnail_path', 'TEXT')
+    add_column(cursor, 'download_history', 'format_label', 'TEXT')
     
-    def init_db(self):
-        cursor = self.conn.cursor()
-        
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS download_queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            url TEXT,
+            title TEXT,
+            format_id TEXT,
+            audio_only INTEGER,
+            download_folder TEXT,
+            status TEXT DEFAULT 'pending',
+            task_id TEXT,
+            thumbnail_path TEXT,
+            format_label TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    add_column(cursor, 'download_queue', 'thumbnail_path', 'TEXT')
+    add_column(cursor, 'download_queue', 'format_label', 'TEXT')
+    # Сокращенный info_dict для скачивания без повторного извлечения
+    add_column(cursor, 'download_queue', 'info_json', 'TEXT')
+    # План отложенной постобработки
+    add_column(cursor, 'download_queue', 'postprocess_json', 'TEXT')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ui_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+
+
+def migrate_indexes(cursor):
+    """2: индексы для выборки очереди по статусу и постраничной истории"""
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_download_queue_status ON download_queue (status, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_download_history_created_at ON download_history (created_at, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_download_history_url ON download_history (url)')
+
+
+def create_history_fts_update_trigger(cursor):
+    """
+    Триггер обновления FTS-индекса истории
+    
+    Срабатывает только при изменении индексируемых колонок: отметки
+    file_missing и замена thumbnail_path индекс не трогают.
+    """
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS download_history_fts_update
+        AFTER UPDATE OF title, url, format_label ON download_history BEGIN
+            INSERT INTO download_history_fts (download_history_fts, rowid, title, url, format_label)
+            VALUES ('delete', old.id, old.title, old.url, old.format_label);
+            INSERT INTO download_history_fts (rowid, title, url, format_label)
+            VALUES (new.id, new.title, new.url, new.format_label);
+        END
+    ''')
+
+
+def migrate_history_fts(cursor):
+    """3: полнотекстовый индекс истории (FTS5), синхронизируемый триггерами"""
+    try:
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS download_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                url TEXT,
-                title TEXT,
-                format_id TEXT,
-                audio_only INTEGER,
-                status TEXT,
-                file_path TEXT,
-                thumbnail_path TEXT,
-                format_label TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            CREATE VIRTUAL TABLE IF NOT EXISTS download_history_fts USING fts5(
+                title, url, format_label,
+                content='download_history', content_rowid='id'
             )
         ''')
-        
-        # Добавляем колонку thumbnail_path если её нет (для существующих БД)
+    except sqlite3.OperationalError as e:
+        # SQLite собран без FTS5 - поиск будет работать через LIKE
+        log_warning(f"FTS5 is not available, history search falls back to LIKE: {e}")
+        return
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS download_history_fts_insert AFTER INSERT ON download_history BEGIN
+            INSERT INTO download_history_fts (rowid, title, url, format_label)
+            VALUES (new.id, new.title, new.url, new.format_label);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS download_history_fts_delete AFTER DELETE ON download_history BEGIN
+            INSERT INTO download_history_fts (download_history_fts, rowid, title, url, format_label)
+            VALUES ('delete', old.id, old.title, old.url, old.format_label);
+        END
+    ''')
+    create_history_fts_update_trigger(cursor)
+    # Индексируем уже существующую историю
+    cursor.execute("INSERT INTO download_history_fts (download_history_fts) VALUES ('rebuild')")
+
+
+def migrate_file_missing(cursor):
+    """4: отметка об отсутствующем файле (ставит HistoryReconciler) и индекс видимой истории"""
+    add_column(cursor, 'download_history', 'file_missing', 'INTEGER NOT NULL DEFAULT 0')
+    cursor.execute(
+        'CREATE INDEX IF NOT EXISTS idx_download_history_visible ON download_history (file_missing, created_at, id)'
+    )
+
+
+def migrate_thumbnails(cursor):
+    """5: индекс скачанных thumbnails (файлы <sha256>.<ext>) и индексы ссылок на них"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS thumbnails (
+            source_url TEXT PRIMARY KEY,
+            filename TEXT NOT NULL,
+            sha256 TEXT NOT NULL,
+            size INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            accessed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_thumbnails_filename ON thumbnails (filename)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_download_history_thumbnail ON download_history (thumbnail_path)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_download_queue_thumbnail ON download_queue (thumbnail_path)')
+
+
+def migrate_history_fts_update_trigger(cursor):
+    """6: триггер обновления FTS-индекса только для индексируемых колонок"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'download_history_fts'")
+    if cursor.fetchone() is None:
+        return
+    cursor.execute('DROP TRIGGER IF EXISTS download_history_fts_update')
+    create_history_fts_update_trigger(cursor)
+
+
+def migrate_queue_usage(cursor):
+    """7: учет CPU и памяти последней загрузки элемента в отдельном процессе"""
+    add_column(cursor, 'download_queue', 'usage_json', 'TEXT')
+
+
+# Миграции схемы по порядку: i-я миграция переводит БД на версию i
+MIGRATIONS = [
+    migrate_base_schema,
+    migrate_indexes,
+    migrate_history_fts,
+    migrate_file_missing,
+    migrate_thumbnails,
+    migrate_history_fts_update_trigger,
+    migrate_queue_usage,
+]
+
+# Сколько id передавать в одном запросе IN (...)
+ID_BATCH_SIZE = 500
+
+
+def build_fts_query(text):
+    """Запрос FTS5 из пользовательского ввода: все слова, последнее - как префикс"""
+    words = [word.replace('"', '""') for word in text.split()]
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words[:-1]]
+    # Поиск по мере ввода: недописанное последнее слово ищем по префиксу
+    terms.append(f'"{words[-1]}"*')
+    return ' '.join(terms)
+
+
+class Database:
+    """
+    Доступ к БД загрузок из Flask-запросов и воркеров загрузки
+    
+    Соединения берутся из пула (каждый поток работает со своим соединением,
+    курсоры не перемешиваются). БД работает в режиме WAL: чтения идут
+    параллельно и не ждут записи, а записи сериализуются одной блокировкой,
+    поэтому воркеры не получают "database is locked".
+    
+    Изменения, результат которых не нужен вызывающему (обновление и удаление
+    элементов очереди, история, ui_state), попадают в журнал и фиксируются
+    пачкой раз в WRITE_BEHIND_INTERVAL - один commit (и fsync) на пачку.
+    Любое чтение и любая синхронная запись сначала сбрасывают журнал, поэтому
+    API всегда видит собственные изменения. При закрытии журнал сбрасывается в close().
+    """
+    def __init__(self, path=DB_PATH, busy_timeout=DB_BUSY_TIMEOUT, pool_size=DB_POOL_SIZE):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.pool_size = pool_size
+        self._pool = queue.LifoQueue()
+        self._write_lock = threading.RLock()
+        self._journal = []
+        self._journal_cond = threading.Condition()
+        # Пачки, изъятые из журнала, но еще не зафиксированные
+        self._in_flight = 0
+        self._flusher = None
+        self.init_db()
+        self.fts_enabled = self._has_table('download_history_fts')
+    
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        # В режиме WAL NORMAL безопасен: при сбое питания теряется только последняя транзакция
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout * 1000)}')
+        return conn
+    
+    @contextmanager
+    def _connection(self):
+        """Соединение из пула (создается, если свободных нет)"""
         try:
-            cursor.execute('ALTER TABLE download_history ADD COLUMN thumbnail_path TEXT')
-        except sqlite3.OperationalError:
-            pass  # Колонка уже существует
-        
-        # Добавляем колонку format_label если её нет (для существующих БД)
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
         try:
-            cursor.execute('ALTER TABLE download_history ADD COLUMN format_label TEXT')
-        except sqlite3.OperationalError:
-            pass  # Колонка уже существует
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS download_queue (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                url TEXT,
-                title TEXT,
-                format_id TEXT,
-                audio_only INTEGER,
-                download_folder TEXT,
-                status TEXT DEFAULT 'pending',
-                task_id TEXT,
-                thumbnail_path TEXT,
-                format_label TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Добавляем колонку thumbnail_path если её нет (для существующих БД)
+            yield conn
+        finally:
+            if self._pool.qsize() < self.pool_size:
+                self._pool.put(conn)
+            else:
+                conn.close()
+    
+    @contextmanager
+    def _read(self):
+        """Курсор для чтения (после сброса отложенных изменений)"""
+        self.flush()
+        with self._connection() as conn:
+            yield conn.cursor()
+    
+    @contextmanager
+    def _write(self):
+        """Курсор для записи: одна транзакция, записи выполняются по очереди"""
+        with self._write_lock, self._connection() as conn:
+            # Отложенные изменения должны попасть в БД раньше этой записи
+            self._flush_journal(conn)
+            try:
+                yield conn.cursor()
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+    
+    def _defer(self, query, params=()):
+        """Добавляет изменение в журнал отложенной записи"""
+        with self._journal_cond:
+            self._journal.append((query, params))
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+                self._flusher.start()
+            # Первое изменение запускает отсчет интервала, полная пачка сбрасывается сразу
+            if len(self._journal) == 1 or len(self._journal) >= WRITE_BEHIND_BATCH:
+                self._journal_cond.notify()
+    
+    def _flush_loop(self):
+        while True:
+            with self._journal_cond:
+                while not self._journal:
+                    self._journal_cond.wait()
+                if len(self._journal) < WRITE_BEHIND_BATCH:
+                    self._journal_cond.wait(WRITE_BEHIND_INTERVAL)
+            self.flush()
+    
+    def _flush_journal(self, conn):
+        """Фиксирует журнал одной транзакцией (вызывать под self._write_lock)"""
+        with self._journal_cond:
+            journal, self._journal = self._journal, []
+            if not journal:
+                return
+            self._in_flight += 1
         try:
-            cursor.execute('ALTER TABLE download_queue ADD COLUMN thumbnail_path TEXT')
-        except sqlite3.OperationalError:
-            pass  # Колонка уже существует
-        
-        # Добавляем колонку format_label если её нет (для существующих БД)
+            self._commit_journal(conn, journal)
+        finally:
+            with self._journal_cond:
+                self._in_flight -= 1
+    
+    def _commit_journal(self, conn, journal):
         try:
-            cursor.execute('ALTER TABLE download_queue ADD COLUMN format_label TEXT')
-        except sqlite3.OperationalError:
-            pass  # Колонка уже существует
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS ui_state (
-                key TEXT PRIMARY KEY,
-                value TEXT
-            )
-        ''')
-        
-        self.conn.commit()
+            for query, params in journal:
+                conn.execute(query, params)
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            # Одна ошибочная запись не должна потерять остальные - повторяем по одной
+            log_error(f"Write-behind batch failed ({e}), retrying {len(journal)} statements one by one")
+            for query, params in journal:
+                try:
+                    conn.execute(query, params)
+                    conn.commit()
+                except sqlite3.Error as e:
+                    conn.rollback()
+                    log_error(f"Write-behind statement failed: {query.strip()} ({e})")
+    
+    def flush(self):
+        """Сбрасывает отложенные изменения в БД"""
+        with self._journal_cond:
+            if not self._journal and not self._in_flight:
+                return
+        # Изъятая другим потоком пачка фиксируется под self._write_lock - дожидаемся ее
+        with self._write_lock, self._connection() as conn:
+            self._flush_journal(conn)
+    
+    def close(self):
+        """Сбрасывает отложенные изменения и закрывает простаивающие соединения пула"""
+        self.flush()
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+    
+    def init_db(self):
+        """Применяет недостающие миграции схемы (версия хранится в PRAGMA user_version)"""
+        with self._write() as cursor:
+            version = cursor.execute('PRAGMA user_version').fetchone()[0]
+            for target_version, migration in enumerate(MIGRATIONS, start=1):
+                if target_version <= version:
+                    continue
+                # Каждая миграция - отдельная транзакция вместе с номером версии
+                cursor.execute('BEGIN')
+                migration(cursor)
+                cursor.execute(f'PRAGMA user_version = {target_version}')
+                cursor.connection.commit()
+                log_info(f"Database migrated to schema version {target_version}")
+    
+    def _has_table(self, name):
+        with self._read() as cursor:
+            cursor.execute('SELECT 1 FROM sqlite_master WHERE name = ?', (name,))
+            return cursor.fetchone() is not None
     
     def add_to_history(self, url, title, format_id, audio_only, status, file_path, thumbnail_path=None, format_label=None):
-        cursor = self.conn.cursor()
-        cursor.execute('''
+        self._defer('''
             INSERT INTO download_history (url, title, format_id, audio_only, status, file_path, thumbnail_path, format_label)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?)
         ''', (url, title, format_id, 1 if audio_only else 0, status, file_path, thumbnail_path, format_label))
-        self.conn.commit()
-        return cursor.lastrowid
     
-    def add_to_queue(self, url, title, format_id, audio_only, download_folder, thumbnail_path=None, format_label=None):
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            INSERT INTO download_queue (url, title, format_id, audio_only, download_folder, thumbnail_path, format_label)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (url, title, format_id, 1 if audio_only else 0, download_folder, thumbnail_path, format_label))
-        self.conn.commit()
-        return cursor.lastrowid
+    def add_to_queue(self, url, title, format_id, audio_only, download_folder, thumbnail_path=None, format_label=None, info_json=None):
+        with self._write() as cursor:
+            cursor.execute('''
+                INSERT INTO download_queue (url, title, format_id, audio_only, download_folder, thumbnail_path, format_label, info_json)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (url, title, format_id, 1 if audio_only else 0, download_folder, thumbnail_path, format_label, info_json))
+            return cursor.lastrowid
     
     def get_queue(self):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT * FROM download_queue ORDER BY id')
-        rows = cursor.fetchall()
-        columns = [desc[0] for desc in cursor.description]
-        return [dict(zip(columns, row)) for row in rows]
+        with self._read() as cursor:
+            cursor.execute('SELECT * FROM download_queue ORDER BY id')
+            return rows_to_dicts(cursor)
     
     def get_queue_item(self, queue_id):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT * FROM download_queue WHERE id = ?', (queue_id,))
-        row = cursor.fetchone()
-        if row:
-            columns = [desc[0] for desc in cursor.description]
-            return dict(zip(columns, row))
-        return None
+        with self._read() as cursor:
+            cursor.execute('SELECT * FROM download_queue WHERE id = ?', (queue_id,))
+            rows = rows_to_dicts(cursor)
+        return rows[0] if rows else None
     
     def get_pending_queue(self):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT * FROM download_queue WHERE status = ? ORDER BY id', ('pending',))
-        rows = cursor.fetchall()
-        columns = [desc[0] for desc in cursor.description]
-        return [dict(zip(columns, row)) for row in rows]
+        return self.get_queue_by_status('pending')
+    
+    def get_queue_by_status(self, status):
+        with self._read() as cursor:
+            cursor.execute('SELECT * FROM download_queue WHERE status = ? ORDER BY id', (status,))
+            return rows_to_dicts(cursor)
+    
+    def claim_queue_item(self, queue_id, task_id):
+        """Атомарно переводит pending-элемент в downloading; возвращает элемент или None, если он уже занят"""
+        with self._write() as cursor:
+            cursor.execute(
+                'UPDATE download_queue SET status = ?, task_id = ? WHERE id = ? AND status = ?',
+                ('downloading', task_id, queue_id, 'pending')
+            )
+            if cursor.rowcount != 1:
+                return None
+            cursor.execute('SELECT * FROM download_queue WHERE id = ?', (queue_id,))
+            rows = rows_to_dicts(cursor)
+        return rows[0] if rows else None
+    
+    def release_queue_item(self, queue_id, task_id, status):
+        """Освобождает элемент, если он все еще принадлежит задаче task_id"""
+        self._defer(
+            'UPDATE download_queue SET status = ?, task_id = NULL WHERE id = ? AND task_id = ?',
+            (status, queue_id, task_id)
+        )
+    
+    def resume_paused_queue(self, queue_id=None, exclude_ids=()):
+        """Переводит элементы на паузе (все или один) обратно в pending"""
+        query = 'UPDATE download_queue SET status = ?, task_id = NULL WHERE status = ?'
+        params = ['pending', 'paused']
+        if queue_id is not None:
+            query += ' AND id = ?'
+            params.append(queue_id)
+        exclude_ids = list(exclude_ids)
+        if exclude_ids:
+            query += f' AND id NOT IN ({", ".join("?" * len(exclude_ids))})'
+            params.extend(exclude_ids)
+        self._defer(query, params)
+    
+    def requeue_interrupted(self):
+        """Возвращает в pending элементы, оборванные падением или закрытием приложения; возвращает их список"""
+        with self._write() as cursor:
+            cursor.execute(
+                'SELECT * FROM download_queue WHERE status IN (?, ?) ORDER BY id',
+                ('downloading', 'interrupted')
+            )
+            items = rows_to_dicts(cursor)
+            if items:
+                cursor.execute(
+                    'UPDATE download_queue SET status = ?, task_id = NULL WHERE status IN (?, ?)',
+                    ('pending', 'downloading', 'interrupted')
+                )
+        return items
     
     def update_queue_item(self, queue_id, **kwargs):
-        cursor = self.conn.cursor()
         updates = []
         values = []
         for key, value in kwargs.items():
             updates.append(f'{key} = ?')
             values.append(value)
         values.append(queue_id)
-        cursor.execute(f'UPDATE download_queue SET {", ".join(updates)} WHERE id = ?', values)
-        self.conn.commit()
+        self._defer(f'UPDATE download_queue SET {", ".join(updates)} WHERE id = ?', values)
     
     def clear_queue(self):
-        cursor = self.conn.cursor()
-        cursor.execute('DELETE FROM download_queue')
-        self.conn.commit()
+        self._defer('DELETE FROM download_queue')
+    
+    def get_history(self, limit=50, before=None):
+        """
+        Страница истории (новые записи первыми, без записей с отсутствующими файлами)
+        
+        Args:
+            limit: Размер страницы
+            before: Курсор (created_at, id) последней записи предыдущей страницы
+        """
+        query = 'SELECT * FROM download_history WHERE file_missing = 0'
+        params = []
+        if before is not None:
+            query += ' AND (created_at, id) < (?, ?)'
+            params.extend(before)
+        query += ' ORDER BY created_at DESC, id DESC LIMIT ?'
+        params.append(limit)
+        with self._read() as cursor:
+            cursor.execute(query, params)
+            return rows_to_dicts(cursor)
     
-    def get_history(self, limit=50):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT * FROM download_history ORDER BY created_at DESC LIMIT ?', (limit,))
-        rows = cursor.fetchall()
-        columns = [desc[0] for desc in cursor.description]
-        return [dict(zip(columns, row)) for row in rows]
+    def search_history(self, text, limit=50, offset=0):
+        """
+        Поиск по названию, URL и формату в истории
+        
+        С FTS5 результаты отсортированы по релевантности (bm25), иначе -
+        подстрочный поиск LIKE, новые записи первыми.
+        """
+        if self.fts_enabled:
+            fts_query = build_fts_query(text)
+            if fts_query is None:
+                return []
+            query = '''
+                SELECT h.* FROM download_history_fts
+                JOIN download_history h ON h.id = download_history_fts.rowid
+                WHERE download_history_fts MATCH ? AND h.file_missing = 0
+                ORDER BY bm25(download_history_fts), h.id DESC
+                LIMIT ? OFFSET ?
+            '''
+            params = (fts_query, limit, offset)
+        else:
+            pattern = '%' + text.strip().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            query = '''
+                SELECT * FROM download_history
+                WHERE file_missing = 0
+                    AND (title LIKE ? ESCAPE '\\' OR url LIKE ? ESCAPE '\\' OR format_label LIKE ? ESCAPE '\\')
+                ORDER BY created_at DESC, id DESC
+                LIMIT ? OFFSET ?
+            '''
+            params = (pattern, pattern, pattern, limit, offset)
+        with self._read() as cursor:
+            cursor.execute(query, params)
+            return rows_to_dicts(cursor)
+    
+    def get_history_files(self):
+        """Записи истории с файлами (для сверки с диском)"""
+        with self._read() as cursor:
+            cursor.execute(
+                "SELECT id, url, file_path, file_missing FROM download_history WHERE file_path IS NOT NULL AND file_path != ''"
+            )
+            return rows_to_dicts(cursor)
+    
+    def set_history_file_missing(self, history_ids, missing):
+        history_ids = list(history_ids)
+        for i in range(0, len(history_ids), ID_BATCH_SIZE):
+            batch = history_ids[i:i + ID_BATCH_SIZE]
+            self._defer(
+                f'UPDATE download_history SET file_missing = ? WHERE id IN ({", ".join("?" * len(batch))})',
+                [1 if missing else 0] + batch
+            )
     
     def get_history_item(self, history_id):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT * FROM download_history WHERE id = ?', (history_id,))
-        row = cursor.fetchone()
-        if row:
-            columns = [desc[0] for desc in cursor.description]
-            return dict(zip(columns, row))
-        return None
+        with self._read() as cursor:
+            cursor.execute('SELECT * FROM download_history WHERE id = ?', (history_id,))
+            rows = rows_to_dicts(cursor)
+        return rows[0] if rows else None
     
     def save_ui_state(self, key, value):
-        cursor = self.conn.cursor()
-        cursor.execute('INSERT OR REPLACE INTO ui_state (key, value) VALUES (?, ?)', (key, value))
-        self.conn.commit()
+        self._defer('INSERT OR REPLACE INTO ui_state (key, value) VALUES (?, ?)', (key, value))
+    
+    def save_ui_states(self, values):
+        """Сохраняет несколько ключей ui_state (одной транзакцией при сбросе журнала)"""
+        for key, value in values.items():
+            self.save_ui_state(key, value)
     
     def get_all_ui_state(self):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT key, value FROM ui_state')
-        rows = cursor.fetchall()
+        with self._read() as cursor:
+            cursor.execute('SELECT key, value FROM ui_state')
+            rows = cursor.fetchall()
         return {row[0]: row[1] for row in rows}
     
-    def count_active_downloads(self):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM download_queue WHERE status = ?', ('downloading',))
-        return cursor.fetchone()[0]
-    
     def delete_queue_item(self, queue_id):
-        cursor = self.conn.cursor()
-        cursor.execute('DELETE FROM download_queue WHERE id = ?', (queue_id,))
-        self.conn.commit()
+        self._defer('DELETE FROM download_queue WHERE id = ?', (queue_id,))
     
     def delete_history_item(self, history_id):
-        cursor = self.conn.cursor()
-        cursor.execute('DELETE FROM download_history WHERE id = ?', (history_id,))
-        self.conn.commit()
-
+        self._defer('DELETE FROM download_history WHERE id = ?', (history_id,))
+    
+    def set_queue_thumbnail(self, queue_id, thumbnail_path):
+        """Подставляет thumbnail, скачанный в фоне (если у элемента его еще нет)"""
+        self._defer(
+            "UPDATE download_queue SET thumbnail_path = ? WHERE id = ? AND (thumbnail_path IS NULL OR thumbnail_path = '')",
+            (thumbnail_path, queue_id)
+        )
+    
+    def set_history_thumbnail(self, url, thumbnail_path):
+        """Подставляет thumbnail, скачанный в фоне, записям истории этого URL без thumbnail"""
+        self._defer(
+            "UPDATE download_history SET thumbnail_path = ? WHERE url = ? AND (thumbnail_path IS NULL OR thumbnail_path = '')",
+            (thumbnail_path, url)
+        )
+    
+    def get_thumbnail(self, source_url):
+        """Имя файла уже скачанного thumbnail с адреса source_url или None"""
+        with self._read() as cursor:
+            cursor.execute('SELECT filename FROM thumbnails WHERE source_url = ?', (source_url,))
+            row = cursor.fetchone()
+        return row[0] if row else None
+    
+    def add_thumbnail(self, source_url, filename, sha256, size):
+        self._defer(
+            'INSERT OR REPLACE INTO thumbnails (source_url, filename, sha256, size) VALUES (?, ?, ?, ?)',
+            (source_url, filename, sha256, size)
+        )
+    
+    def count_thumbnail_references(self, thumbnail_path):
+        """Сколько записей очереди и истории ссылаются на файл thumbnail"""
+        with self._read() as cursor:
+            cursor.execute(
+                '''SELECT (SELECT COUNT(*) FROM download_history WHERE thumbnail_path = ?)
+                        + (SELECT COUNT(*) FROM download_queue WHERE thumbnail_path = ?)''',
+                (thumbnail_path, thumbnail_path)
+            )
+            return cursor.fetchone()[0]
+    
+    def delete_thumbnail_records(self, filename):
+        self._defer('DELETE FROM thumbnails WHERE filename = ?', (filename,))
+    
+    def get_thumbnail_references(self):
+        """Пути thumbnails, на которые ссылаются очередь и история (в том числе скрытые записи)"""
+        with self._read() as cursor:
+            cursor.execute('''
+                SELECT thumbnail_path FROM download_history
+                WHERE thumbnail_path IS NOT NULL AND thumbnail_path != ''
+                UNION
+                SELECT thumbnail_path FROM download_queue
+                WHERE thumbnail_path IS NOT NULL AND thumbnail_path != ''
+            ''')
+            return [row[0] for row in cursor.fetchall()]
+    
+    def clear_thumbnail_files(self, filenames):
+        """
+        Убирает ссылки очереди и истории на удаленные файлы thumbnails
+        
+        Сравнивается имя файла в конце пути: ссылка могла появиться уже после
+        того, как файл был выбран для удаления.
+        """
+        for filename in filenames:
+            for table in ('download_history', 'download_queue'):
+                self._defer(
+                    f'UPDATE {table} SET thumbnail_path = NULL WHERE substr(thumbnail_path, -?) = ?',
+                    (len(filename), filename)
+                )
+    
+    def get_thumbnail_access_times(self):
+        """Время последнего обращения (unix time) для каждого файла из индекса thumbnails"""
+        with self._read() as cursor:
+            cursor.execute("SELECT filename, MAX(CAST(strftime('%s', accessed_at) AS INTEGER)) FROM thumbnails GROUP BY filename")
+            return {row[0]: row[1] or 0 for row in cursor.fetchall()}
+    
+    def touch_thumbnails(self, accessed):
+        """Обновляет accessed_at; accessed - словарь имя файла -> unix time"""
+        for filename, accessed_at in accessed.items():
+            self._defer(
+                "UPDATE thumbnails SET accessed_at = datetime(?, 'unixepoch') WHERE filename = ?",
+                (int(accessed_at), filename)
+            )
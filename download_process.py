@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+
+from logger import log_info, log_warning
+from video_downloader import DownloadPaused
+
+# resource (учет CPU и памяти дочернего процесса) есть только на Unix
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Как часто родитель проверяет команды паузы и отмены
+COMMAND_POLL_INTERVAL = 0.2  # секунды
+
+# Сколько скачанных байт процесс копит перед запросом к общему ограничителю скорости
+RATE_LIMIT_CHUNK = 256 * 1024
+
+# Сколько ждать завершения процесса после его последнего сообщения
+PROCESS_EXIT_TIMEOUT = 5  # секунды
+
+# После стольких загрузок процесс заменяется новым (память, накопленную
+# экстракторами и загрузкой фрагментов, освобождает ОС)
+DOWNLOAD_PROCESS_MAX_JOBS = 20
+
+# Процесс, чей пик памяти дорос до этого размера, заменяется сразу после
+# загрузки: следующие загрузки не должны начинать с раздутого процесса
+DOWNLOAD_PROCESS_MAX_RSS = 1024 * 1024 * 1024  # байты
+
+# Как часто замерять текущую память процесса во время загрузки
+RSS_SAMPLE_INTERVAL = 0.5  # секунды
+
+
+def get_process_usage():
+    """CPU и пиковая память текущего процесса или None, если учет недоступен"""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss - в килобайтах на Linux и в байтах на macOS
+    max_rss = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+    return {
+        'cpu_user': round(usage.ru_utime, 2),
+        'cpu_system': round(usage.ru_stime, 2),
+        'max_rss': max_rss
+    }
+
+
+def get_current_rss():
+    """Текущая память (RSS) процесса в байтах или None, если замер недоступен (есть только /proc на Linux)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class JobUsage:
+    """
+    Учет ресурсов одной загрузки в процессе пула
+
+    ru_maxrss - пик за всю жизнь процесса, а процесс выполняет много загрузок,
+    поэтому память загрузки - максимум текущего RSS, замеряемого в фоне
+    (None, если замер недоступен). CPU - разница с началом загрузки.
+    """
+    def __init__(self):
+        self._start = get_process_usage()
+        self._peak = get_current_rss()
+        self._stop = threading.Event()
+        if self._peak is not None:
+            threading.Thread(target=self._sample, daemon=True).start()
+
+    def _sample(self):
+        while not self._stop.wait(RSS_SAMPLE_INTERVAL):
+            rss = get_current_rss()
+            if rss is not None and rss > self._peak:
+                self._peak = rss
+
+    def finish(self):
+        """Останавливает замеры; возвращает учет загрузки или None"""
+        self._stop.set()
+        usage = get_process_usage()
+        if usage is None:
+            return None
+        rss = get_current_rss()
+        if rss is not None and self._peak is not None:
+            self._peak = max(self._peak, rss)
+        return {
+            'cpu_user': round(usage['cpu_user'] - self._start['cpu_user'], 2),
+            'cpu_system': round(usage['cpu_system'] - self._start['cpu_system'], 2),
+            'max_rss': self._peak,
+            'process_max_rss': usage['max_rss']
+        }
+
+
+def format_usage(usage):
+    if not usage:
+        return 'usage unavailable'
+    memory = f"process peak RSS {usage['process_max_rss'] / (1024 * 1024):.0f} MB"
+    if usage.get('max_rss') is not None:
+        memory = f"max RSS {usage['max_rss'] / (1024 * 1024):.0f} MB, {memory}"
+    return f"cpu {usage['cpu_user']:.1f}s user / {usage['cpu_system']:.1f}s system, {memory}"
+
+
+class RemoteRateLimiter:
+    """Ограничитель скорости в дочернем процессе: бюджет списывается у общего BandwidthLimiter родителя"""
+    def __init__(self, send, replies):
+        self.send = send
+        self.replies = replies
+        self._pending = 0
+
+    def consume(self, nbytes):
+        self._pending += nbytes
+        if self._pending < RATE_LIMIT_CHUNK:
+            return
+        nbytes, self._pending = self._pending, 0
+        self.send('consume', nbytes)
+        try:
+            wait = self.replies.get(timeout=PROCESS_EXIT_TIMEOUT)
+        except queue.Empty:
+            return
+        if wait > 0:
+            time.sleep(wait)
+
+
+def _worker_main(conn):
+    """
+    Цикл процесса загрузок
+
+    video_downloader (и yt_dlp) импортируется один раз при старте процесса.
+    Задание - ('job', kwargs, rate_limited), None - завершение. Сообщения
+    родителю - кортежи (вид, данные): progress, final_file, retry_status,
+    network_error, consume (запрос к ограничителю скорости) и в конце задания
+    done / paused / failed с учетом ресурсов третьим элементом. Во время
+    задания родитель шлет ('pause',) и ('wait', секунды) - ответ на consume.
+    """
+    from video_downloader import download_video, CustomLogger
+
+    send_lock = threading.Lock()
+    jobs = queue.Queue()
+    replies = queue.Queue()
+    flags = {'paused': {'value': False}, 'cancelled': {'value': False}}
+
+    def send(*message):
+        with send_lock:
+            conn.send(message)
+
+    def listen():
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                message = None
+            if message is None:
+                # Родитель завершился или останавливает пул - обрываем загрузку
+                flags['cancelled']['value'] = True
+                jobs.put(None)
+                return
+            if message[0] == 'job':
+                # Флаги и ответы прошлого задания к новому не относятся
+                flags['paused'] = {'value': False}
+                flags['cancelled'] = {'value': False}
+                while not replies.empty():
+                    replies.get_nowait()
+                jobs.put((message[1], message[2], flags['paused'], flags['cancelled']))
+            elif message[0] == 'pause':
+                flags['paused']['value'] = True
+            elif message[0] == 'wait':
+                replies.put(message[1])
+
+    threading.Thread(target=listen, daemon=True).start()
+
+    def final_file_callback(filename):
+        send('final_file', filename)
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        kwargs, rate_limited, paused_flag, cancelled_flag = job
+        job_usage = JobUsage()
+        try:
+            plan = download_video(
+                progress_callback=lambda progress: send('progress', progress),
+                logger=CustomLogger(final_file_callback=final_file_callback),
+                paused_flag=paused_flag,
+                cancelled_flag=cancelled_flag,
+                final_file_callback=final_file_callback,
+                retry_status_callback=lambda status: send('retry_status', status),
+                error_callback=lambda error: send('network_error', str(error)),
+                rate_limiter=RemoteRateLimiter(send, replies) if rate_limited else None,
+                **kwargs
+            )
+            send('done', plan, job_usage.finish())
+        except DownloadPaused:
+            send('paused', None, job_usage.finish())
+        except Exception as e:
+            send('failed', str(e), job_usage.finish())
+
+
+class DownloadWorker:
+    """Процесс загрузок и его конец канала"""
+    def __init__(self, context):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.jobs = 0
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def kill(self):
+        """Немедленно завершает процесс (.part файлы остаются на диске)"""
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def close(self, timeout=PROCESS_EXIT_TIMEOUT):
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class DownloadProcessPool:
+    """
+    Заранее запущенные процессы для загрузок очереди
+
+    Зависший экстрактор или загрузка фрагментов, съевшая память, не задевают
+    приложение, а запуск процесса и импорт yt_dlp не ложатся на каждую
+    загрузку. Загрузка занимает свободный процесс (или запускает новый, если
+    свободных нет); после нее процесс возвращается в пул, пока простаивающих
+    меньше, чем параллельных загрузок. Процесс, отслуживший max_jobs загрузок,
+    упавший или завершенный отменой, заменяется новым.
+    """
+    def __init__(self, get_size, max_jobs=DOWNLOAD_PROCESS_MAX_JOBS):
+        """
+        Args:
+            get_size: Функция без аргументов, возвращающая, сколько процессов держать наготове
+                (количество параллельных загрузок меняется на лету)
+            max_jobs: Сколько загрузок выполняет процесс до замены
+        """
+        self.get_size = get_size
+        self.max_jobs = max(1, int(max_jobs))
+        self._context = multiprocessing.get_context('spawn')
+        self._idle = []
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _size(self):
+        return max(1, int(self.get_size()))
+
+    def start(self):
+        """Запускает процессы заранее (импорт yt_dlp в них идет в фоне)"""
+        size = self._size()
+        with self._lock:
+            self._closed = False
+            started = size - len(self._idle)
+            while len(self._idle) < size:
+                self._idle.append(DownloadWorker(self._context))
+        if started > 0:
+            log_info(f"Download process pool started: {started} process(es)")
+
+    def close(self):
+        """Останавливает простаивающие процессы; занятые закрываются по окончании загрузки"""
+        with self._lock:
+            self._closed = True
+            workers, self._idle = self._idle, []
+        for worker in workers:
+            worker.close()
+
+    def _acquire(self):
+        with self._lock:
+            while self._idle:
+                worker = self._idle.pop()
+                if worker.is_alive():
+                    return worker
+                worker.kill()
+        return DownloadWorker(self._context)
+
+    def _release(self, worker, reusable, recycle=False):
+        """
+        Возвращает процесс в пул или завершает его, запуская замену
+
+        Args:
+            reusable: Процесс завершил задание штатно (иначе он убивается)
+            recycle: Штатно завершить процесс, даже если он отслужил меньше max_jobs заданий
+        """
+        worker.jobs += 1
+        size = self._size()
+        with self._lock:
+            keep = not self._closed and len(self._idle) < size
+            if keep and reusable and not recycle and worker.jobs < self.max_jobs and worker.is_alive():
+                self._idle.append(worker)
+                return
+        if reusable:
+            worker.close()
+        else:
+            worker.kill()
+        if keep:
+            replacement = DownloadWorker(self._context)
+            with self._lock:
+                if not self._closed:
+                    self._idle.append(replacement)
+                    return
+            replacement.close()
+
+    def download(self, download_kwargs, progress_callback=None, final_file_callback=None,
+                 retry_status_callback=None, error_callback=None, paused_flag=None,
+                 cancelled_flag=None, rate_limiter=None, usage_callback=None, label=''):
+        """
+        Выполняет download_video в процессе пула
+
+        Колбэки вызываются в вызывающем потоке по сообщениям из канала.
+        Пауза передается процессу командой (он обрывает загрузку, сохраняя .part
+        файлы, и остается в пуле), отмена - немедленное завершение процесса.
+
+        Args:
+            download_kwargs: Аргументы download_video без колбэков и флагов (url, format_id,
+                download_folder, audio_only, info, postprocess)
+            usage_callback: Функция usage_callback(usage) с учетом CPU и памяти загрузки (см. JobUsage)
+            label: Подпись загрузки для лога
+            Остальные - как у download_video
+
+        Returns:
+            Результат download_video
+
+        Raises:
+            DownloadPaused: Загрузка остановлена паузой
+            Exception: Ошибка загрузки, отмена или аварийное завершение процесса
+        """
+        worker = self._acquire()
+        finished = False
+        recycle = False
+        pause_sent = False
+        try:
+            worker.conn.send(('job', download_kwargs, rate_limiter is not None))
+            while True:
+                if cancelled_flag and cancelled_flag['value']:
+                    raise Exception("Download cancelled by user.")
+                if paused_flag and paused_flag['value'] and not pause_sent:
+                    worker.conn.send(('pause',))
+                    pause_sent = True
+                if not worker.conn.poll(COMMAND_POLL_INTERVAL):
+                    if not worker.is_alive() and not worker.conn.poll():
+                        raise Exception(f"Download process exited unexpectedly (code {worker.process.exitcode})")
+                    continue
+                try:
+                    message = worker.conn.recv()
+                except EOFError:
+                    worker.process.join(PROCESS_EXIT_TIMEOUT)
+                    raise Exception(f"Download process exited unexpectedly (code {worker.process.exitcode})")
+
+                kind = message[0]
+                if kind == 'progress':
+                    if progress_callback:
+                        progress_callback(message[1])
+                elif kind == 'final_file':
+                    if final_file_callback:
+                        final_file_callback(message[1])
+                elif kind == 'retry_status':
+                    if retry_status_callback:
+                        retry_status_callback(message[1])
+                elif kind == 'network_error':
+                    if error_callback:
+                        error_callback(message[1])
+                elif kind == 'consume':
+                    worker.conn.send(('wait', rate_limiter.reserve(message[1]) if rate_limiter else 0))
+                elif kind in ('done', 'paused', 'failed'):
+                    finished = True
+                    usage = message[2]
+                    recycle = bool(usage) and usage['process_max_rss'] >= DOWNLOAD_PROCESS_MAX_RSS
+                    log_info(f"Download process {label} finished ({kind}): {format_usage(usage)}")
+                    if usage_callback:
+                        usage_callback(usage)
+                    if kind == 'done':
+                        return message[1]
+                    if kind == 'paused':
+                        raise DownloadPaused()
+                    raise Exception(message[1])
+        finally:
+            if not finished:
+                # Процесс, не завершивший задание (отмена, сбой), заменяется
+                log_info(f"Download process {label} aborted, replacing it")
+            elif recycle:
+                log_info(f"Download process {label} grew too large, replacing it")
+            self._release(worker, finished, recycle)
@@ -0,0 +1,493 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import deque, Counter
+from urllib.parse import urlsplit
+
+from logger import log_info, log_error
+
+# Количество параллельных загрузок по умолчанию и верхняя граница
+DEFAULT_MAX_WORKERS = 3
+MAX_WORKERS_LIMIT = 16
+
+# Ограничение одновременных загрузок с одного хоста (0 - без ограничения)
+DEFAULT_PER_HOST_LIMIT = 0
+
+# Пул постобработки (ffmpeg нагружает CPU, поэтому размер - по числу ядер)
+DEFAULT_POSTPROCESS_WORKERS = os.cpu_count() or 2
+
+# Пул фоновой загрузки thumbnails (мелкие сетевые запросы)
+DEFAULT_THUMBNAIL_WORKERS = 4
+THUMBNAIL_QUEUE_LIMIT = 256
+
+# Token bucket для общего ограничения скорости
+BANDWIDTH_BURST_SECONDS = 1.0  # емкость ведра в секундах трафика
+BANDWIDTH_MAX_WAIT = 2.0  # максимальная пауза за один вызов (остаток долга оплачивают следующие)
+
+# Параметры адаптивного (AIMD) регулятора параллельности
+ADAPTIVE_INTERVAL = 5.0  # секунды между решениями
+ADAPTIVE_MIN_WORKERS = 1
+ADAPTIVE_GAIN_THRESHOLD = 1.05  # рост суммарной скорости, при котором добавляем слот
+ADAPTIVE_COLLAPSE_RATIO = 0.5  # падение скорости на задачу, при котором уменьшаем параллельность
+ADAPTIVE_DECREASE_FACTOR = 0.5
+ADAPTIVE_ERROR_THRESHOLD = 2  # сетевых ошибок за интервал, при котором уменьшаем параллельность
+
+
+def get_host_key(url):
+    """Ключ хоста для ограничения параллельности (без www./m. и порта)"""
+    try:
+        host = (urlsplit(url).hostname or '').lower()
+    except ValueError:
+        return ''
+    for prefix in ('www.', 'm.'):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    if host == 'youtu.be':
+        host = 'youtube.com'
+    return host
+
+
+def normalize_host_limits(host_limits):
+    """Приводит ключи {host: limit} к виду get_host_key"""
+    return {get_host_key('//' + host) or host: max(0, int(limit)) for host, limit in host_limits.items()}
+
+
+class DownloadScheduler:
+    """
+    Планировщик очереди загрузок с ограниченным пулом воркеров
+
+    Готовые к запуску элементы хранятся в памяти (self._ready) и подгружаются
+    из download_queue при старте. Воркер забирает элемент через
+    db.claim_queue_item, поэтому один pending-элемент не может быть запущен дважды.
+    Размер пула можно менять на лету через set_max_workers, а лимиты
+    на один хост - через set_host_limits: элементы, чей хост уже занял
+    свой лимит, пропускаются до освобождения слота этого хоста.
+    """
+    def __init__(self, db, run_job, max_workers=DEFAULT_MAX_WORKERS,
+                 per_host_limit=DEFAULT_PER_HOST_LIMIT, host_limits=None):
+        """
+        Args:
+            db: Database
+            run_job: Функция run_job(queue_id, queue_item, task_id), выполняющая загрузку (блокирующая)
+            max_workers: Количество параллельных загрузок
+            per_host_limit: Лимит одновременных загрузок с одного хоста (0 - без ограничения)
+            host_limits: Индивидуальные лимиты {host: n}
+        """
+        self.db = db
+        self.run_job = run_job
+        self.max_workers = max(1, min(MAX_WORKERS_LIMIT, int(max_workers)))
+        self.per_host_limit = per_host_limit
+        self.host_limits = normalize_host_limits(host_limits or {})
+        self.running = False
+        self._ready = deque()
+        self._hosts = {}
+        self._active = set()
+        self._active_hosts = Counter()
+        self._workers = set()
+        self._cond = threading.Condition()
+
+    def start(self):
+        """Запускает обработку очереди: все pending-элементы становятся готовыми к запуску"""
+        pending = self.db.get_pending_queue()
+        with self._cond:
+            self.running = True
+            for item in pending:
+                if item['id'] not in self._ready and item['id'] not in self._active:
+                    self._ready.append(item['id'])
+                    self._hosts[item['id']] = get_host_key(item['url'])
+            self._spawn_workers()
+            self._cond.notify_all()
+
+    def stop(self):
+        """Останавливает запуск новых загрузок (текущие отменяются вызывающим кодом)"""
+        with self._cond:
+            self.running = False
+            self._ready.clear()
+            self._cond.notify_all()
+
+    def submit(self, queue_id, url, start=False):
+        """
+        Добавляет элемент в очередь готовых, если обработка очереди запущена
+
+        Args:
+            start: Запустить обработку, если она остановлена (возобновление
+                одного элемента); другие pending-элементы при этом не запускаются
+        """
+        with self._cond:
+            if queue_id in self._ready or queue_id in self._active:
+                return
+            if start:
+                self.running = True
+            elif not self.running:
+                return
+            self._ready.append(queue_id)
+            self._hosts[queue_id] = get_host_key(url)
+            self._spawn_workers()
+            self._cond.notify()
+
+    def discard(self, queue_id):
+        """Убирает элемент из очереди готовых (например, при удалении)"""
+        with self._cond:
+            try:
+                self._ready.remove(queue_id)
+            except ValueError:
+                pass
+            if queue_id not in self._active:
+                self._hosts.pop(queue_id, None)
+
+    def set_max_workers(self, max_workers):
+        """Меняет количество параллельных загрузок; возвращает установленное значение"""
+        max_workers = max(1, min(MAX_WORKERS_LIMIT, int(max_workers)))
+        with self._cond:
+            self.max_workers = max_workers
+            self._spawn_workers()
+            # Лишние воркеры завершатся после текущей загрузки
+            self._cond.notify_all()
+        log_info(f"Download concurrency set to {max_workers}")
+        return max_workers
+
+    def set_host_limits(self, per_host_limit, host_limits=None):
+        """Меняет лимиты одновременных загрузок на хост"""
+        # Значения проверяются до изменения: при ошибке лимиты остаются прежними
+        per_host_limit = max(0, int(per_host_limit))
+        if host_limits is not None:
+            host_limits = normalize_host_limits(host_limits)
+        with self._cond:
+            self.per_host_limit = per_host_limit
+            if host_limits is not None:
+                self.host_limits = host_limits
+            self._cond.notify_all()
+
+    def _host_limit(self, host):
+        return self.host_limits.get(host, self.per_host_limit)
+
+    def active_count(self):
+        """Количество выполняющихся загрузок"""
+        with self._cond:
+            return len(self._active)
+
+    def _spawn_workers(self):
+        """Добирает воркеров до max_workers (вызывать под self._cond)"""
+        if not self.running:
+            return
+        needed = min(self.max_workers, len(self._ready) + len(self._active))
+        while len(self._workers) < needed:
+            thread = threading.Thread(target=self._worker_loop, daemon=True)
+            self._workers.add(thread)
+            thread.start()
+
+    def _next_queue_id(self):
+        """Ждет следующий элемент; возвращает None, если воркеру пора завершиться (вызывать под self._cond)"""
+        while True:
+            if not self.running or len(self._workers) > self.max_workers:
+                return None
+            for queue_id in self._ready:
+                host = self._hosts.get(queue_id)
+                limit = self._host_limit(host)
+                if not limit or self._active_hosts[host] < limit:
+                    self._ready.remove(queue_id)
+                    return queue_id
+            if not self._active:
+                # Очередь опустела и ничего не выполняется - обработка завершена
+                self.running = False
+                self._cond.notify_all()
+                return None
+            self._cond.wait()
+
+    def _worker_loop(self):
+        me = threading.current_thread()
+        while True:
+            with self._cond:
+                queue_id = self._next_queue_id()
+                if queue_id is None:
+                    self._workers.discard(me)
+                    return
+                self._active.add(queue_id)
+                host = self._hosts.get(queue_id)
+                self._active_hosts[host] += 1
+            try:
+                self._run(queue_id)
+            finally:
+                with self._cond:
+                    self._active.discard(queue_id)
+                    self._hosts.pop(queue_id, None)
+                    self._active_hosts[host] -= 1
+                    if self._active_hosts[host] <= 0:
+                        del self._active_hosts[host]
+                    self._cond.notify_all()
+
+    def _run(self, queue_id):
+        task_id = str(uuid.uuid4())
+        queue_item = self.db.claim_queue_item(queue_id, task_id)
+        if queue_item is None:
+            # Элемент уже запущен другим воркером, удален или поставлен на паузу
+            return
+        try:
+            self.run_job(queue_id, queue_item, task_id)
+        except Exception as e:
+            log_error(f"Unhandled error in download job for queue item {queue_id}: {e}")
+
+
+class PostProcessPool:
+    """
+    Пул постобработки (слияние видео и аудио, конвертация в mp3)
+    
+    Загрузка занимает сетевой слот планировщика только до тех пор, пока
+    данные не оказались на диске; ffmpeg выполняется здесь, в отдельной
+    очереди с числом воркеров по количеству ядер.
+    """
+    def __init__(self, run_job, workers=DEFAULT_POSTPROCESS_WORKERS):
+        """
+        Args:
+            run_job: Функция run_job(queue_id), выполняющая постобработку элемента (блокирующая)
+            workers: Количество одновременных задач постобработки
+        """
+        self.run_job = run_job
+        self.workers = max(1, int(workers))
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, queue_id):
+        """Ставит элемент в очередь постобработки"""
+        with self._lock:
+            if queue_id in self._pending:
+                return
+            self._pending.add(queue_id)
+            # Воркеры создаются по мере надобности
+            if len(self._threads) < min(self.workers, len(self._pending)):
+                thread = threading.Thread(target=self._worker_loop, daemon=True)
+                self._threads.append(thread)
+                thread.start()
+        self._queue.put(queue_id)
+
+    def _worker_loop(self):
+        while True:
+            queue_id = self._queue.get()
+            try:
+                self.run_job(queue_id)
+            except Exception as e:
+                log_error(f"Unhandled error in post-processing job for queue item {queue_id}: {e}")
+            finally:
+                with self._lock:
+                    self._pending.discard(queue_id)
+
+
+class ThumbnailPool:
+    """
+    Ограниченный пул фоновой загрузки thumbnails
+    
+    Ответ с форматами и перенос загрузки в историю не ждут картинку: задача
+    ставится сюда, а результат приходит в callback. Задачи с одинаковым key
+    (например, одна и та же картинка из fetch-formats и queue/add) выполняются
+    один раз, результат получают все callbacks. Очередь ограничена - при
+    переполнении задача отклоняется, а не копится в памяти.
+    """
+    def __init__(self, workers=DEFAULT_THUMBNAIL_WORKERS, max_pending=THUMBNAIL_QUEUE_LIMIT):
+        self.workers = max(1, int(workers))
+        self.max_pending = max_pending
+        self._queue = queue.Queue()
+        self._callbacks = {}  # key -> список callbacks
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, key, job, callback=None):
+        """
+        Ставит задачу в очередь
+        
+        Args:
+            key: Ключ для объединения одинаковых задач
+            job: Функция без аргументов, возвращающая результат (блокирующая)
+            callback: Функция callback(result), вызывается в потоке пула (None при ошибке)
+        
+        Returns:
+            False, если очередь переполнена и задача отклонена
+        """
+        with self._lock:
+            if key in self._callbacks:
+                if callback:
+                    self._callbacks[key].append(callback)
+                return True
+            if len(self._callbacks) >= self.max_pending:
+                return False
+            self._callbacks[key] = [callback] if callback else []
+            # Воркеры создаются по мере надобности
+            if len(self._threads) < min(self.workers, len(self._callbacks)):
+                thread = threading.Thread(target=self._worker_loop, daemon=True)
+                self._threads.append(thread)
+                thread.start()
+        self._queue.put((key, job))
+        return True
+
+    def _worker_loop(self):
+        while True:
+            key, job = self._queue.get()
+            result = None
+            try:
+                result = job()
+            except Exception as e:
+                log_error(f"Unhandled error in thumbnail job {key}: {e}")
+            with self._lock:
+                callbacks = self._callbacks.pop(key, [])
+            for callback in callbacks:
+                try:
+                    callback(result)
+                except Exception as e:
+                    log_error(f"Error in thumbnail callback for {key}: {e}")
+
+
+class BandwidthLimiter:
+    """
+    Общее ограничение скорости для всех загрузок (token bucket)
+
+    Каждая загрузка списывает скачанные байты через consume. Если бюджет
+    исчерпан, вызывающий поток засыпает на время, за которое накопится долг;
+    следующие вызовы видят этот долг и ждут дольше, поэтому полоса делится
+    между загрузками пропорционально, а не по принципу "кто первый".
+    """
+    def __init__(self, rate=0):
+        """
+        Args:
+            rate: Лимит в байтах в секунду (0 - без ограничения)
+        """
+        self.rate = rate
+        self._tokens = 0.0
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate):
+        """Меняет лимит на лету (накопленный долг сбрасывается)"""
+        with self._lock:
+            self.rate = max(0, int(rate))
+            self._tokens = 0.0
+            self._last = time.monotonic()
+        log_info(f"Bandwidth limit set to {self.rate or 'unlimited'} B/s")
+
+    def reserve(self, nbytes):
+        """Списывает nbytes из общего бюджета; возвращает, сколько секунд вызывающему нужно подождать"""
+        if self.rate <= 0 or nbytes <= 0:
+            return 0
+        with self._lock:
+            rate = self.rate
+            if rate <= 0:
+                return 0
+            now = time.monotonic()
+            self._tokens = min(rate * BANDWIDTH_BURST_SECONDS, self._tokens + (now - self._last) * rate)
+            self._last = now
+            self._tokens -= nbytes
+            wait = -self._tokens / rate if self._tokens < 0 else 0
+        return min(wait, BANDWIDTH_MAX_WAIT)
+
+    def consume(self, nbytes):
+        """Списывает nbytes из общего бюджета, при необходимости блокирует поток"""
+        wait = self.reserve(nbytes)
+        if wait > 0:
+            time.sleep(wait)
+
+
+class AdaptiveConcurrency:
+    """
+    Адаптивный регулятор количества параллельных загрузок (AIMD)
+
+    Раз в interval секунд сравнивает суммарную скорость активных загрузок
+    с предыдущим интервалом: пока все слоты заняты и суммарная скорость растет,
+    добавляет один слот (аддитивное увеличение); если скорость на задачу
+    обвалилась без роста суммарной или участились сетевые ошибки,
+    умножает количество слотов на ADAPTIVE_DECREASE_FACTOR.
+    """
+    def __init__(self, scheduler, min_workers=ADAPTIVE_MIN_WORKERS, max_workers=MAX_WORKERS_LIMIT,
+                 interval=ADAPTIVE_INTERVAL):
+        self.scheduler = scheduler
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.interval = interval
+        self.enabled = False
+        self._speeds = {}
+        self._errors = 0
+        self._prev_total = None
+        self._prev_per_job = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def set_enabled(self, enabled):
+        """Включает или выключает регулятор"""
+        with self._lock:
+            self.enabled = bool(enabled)
+            self._prev_total = None
+            self._prev_per_job = None
+            if self.enabled and (self._thread is None or not self._thread.is_alive()):
+                self._thread = threading.Thread(target=self._loop, daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+        log_info(f"Adaptive download concurrency {'enabled' if enabled else 'disabled'}")
+
+    def report_progress(self, task_key, speed):
+        """Последняя измеренная скорость загрузки задачи (байт/с)"""
+        with self._lock:
+            self._speeds[task_key] = speed or 0
+
+    def report_error(self):
+        """Сетевая (повторяемая) ошибка в одной из загрузок"""
+        with self._lock:
+            self._errors += 1
+
+    def finish(self, task_key):
+        """Задача завершилась и больше не участвует в измерениях"""
+        with self._lock:
+            self._speeds.pop(task_key, None)
+
+    def _loop(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if not self.enabled:
+                return
+            try:
+                self._tick()
+            except Exception as e:
+                log_error(f"Adaptive concurrency error: {e}")
+
+    def _tick(self):
+        with self._lock:
+            speeds = list(self._speeds.values())
+            errors = self._errors
+            self._errors = 0
+        limit = self.scheduler.max_workers
+
+        if errors >= ADAPTIVE_ERROR_THRESHOLD:
+            self._decrease(limit, f"{errors} network errors")
+            return
+
+        active = len(speeds)
+        if active == 0:
+            return
+        total = sum(speeds)
+        per_job = total / active
+        prev_total = self._prev_total
+        prev_per_job = self._prev_per_job
+        self._prev_total = total
+        self._prev_per_job = per_job
+
+        if prev_total is None:
+            return
+        total_rising = total >= prev_total * ADAPTIVE_GAIN_THRESHOLD
+        if prev_per_job and per_job < prev_per_job * ADAPTIVE_COLLAPSE_RATIO and not total_rising:
+            self._decrease(limit, f"per-job speed dropped to {per_job:.0f} B/s")
+        elif total_rising and active >= limit and limit < self.max_workers:
+            self.scheduler.set_max_workers(limit + 1)
+
+    def _decrease(self, limit, reason):
+        new_limit = max(self.min_workers, int(limit * ADAPTIVE_DECREASE_FACTOR))
+        # Сбрасываем базовую линию - после уменьшения скорости сравнимы заново
+        self._prev_total = None
+        self._prev_per_job = None
+        if new_limit < limit:
+            log_info(f"Reducing download concurrency ({reason})")
+            self.scheduler.set_max_workers(new_limit)
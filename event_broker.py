@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import threading
+import time
+
+# Максимальная частота отправки пачек событий одному клиенту (в секунду)
+DEFAULT_EVENT_RATE = 4
+MAX_EVENT_RATE = 20
+
+# Комментарий-пинг, чтобы соединение не закрывалось по таймауту
+KEEPALIVE_INTERVAL = 15  # секунды
+
+
+def format_sse(event_type, data):
+    """Форматирует событие в виде Server-Sent Events"""
+    return f"event: {event_type}\ndata: {json.dumps(data)}\n\n"
+
+
+class EventBroker:
+    """
+    Рассылка изменений очереди клиентам через Server-Sent Events
+
+    Издатели вызывают publish(event_type, data, key): хранится только
+    последнее событие для каждого key, поэтому частые обновления прогресса
+    одной загрузки схлопываются в одно. Подписчик (stream) спит на условной
+    переменной, пока ничего не изменилось, и отправляет накопившиеся события
+    не чаще max_rate раз в секунду.
+    """
+    def __init__(self, max_rate=DEFAULT_EVENT_RATE):
+        self.max_rate = DEFAULT_EVENT_RATE
+        self.set_max_rate(max_rate)
+        self._version = 0
+        self._events = {}  # key -> (version, event_type, data)
+        self._cond = threading.Condition()
+
+    def set_max_rate(self, max_rate):
+        """Меняет максимальную частоту отправки событий; возвращает установленное значение"""
+        try:
+            self.max_rate = max(1, min(MAX_EVENT_RATE, int(max_rate)))
+        except (TypeError, ValueError):
+            self.max_rate = DEFAULT_EVENT_RATE
+        return self.max_rate
+
+    def publish(self, event_type, data=None, key=None):
+        """Публикует событие; предыдущее неотправленное событие с тем же key заменяется"""
+        with self._cond:
+            self._version += 1
+            self._events[key or event_type] = (self._version, event_type, data or {})
+            self._cond.notify_all()
+
+    def discard(self, key):
+        """Забывает последнее событие с key (например, прогресс завершенной загрузки)"""
+        with self._cond:
+            self._events.pop(key, None)
+
+    def _collect(self, since_version, timeout):
+        """Ждет событий новее since_version; возвращает (версия, события)"""
+        with self._cond:
+            if self._version == since_version:
+                self._cond.wait(timeout)
+            events = sorted(event for event in self._events.values() if event[0] > since_version)
+            return self._version, events
+
+    def stream(self):
+        """Генератор SSE-потока для одного клиента"""
+        with self._cond:
+            version = self._version
+        yield ': connected\n\n'
+        while True:
+            version, events = self._collect(version, KEEPALIVE_INTERVAL)
+            if not events:
+                yield ': keepalive\n\n'
+                continue
+            for _, event_type, data in events:
+                yield format_sse(event_type, data)
+            # Все, что придет за это время, уйдет одной пачкой
+            time.sleep(1.0 / self.max_rate)
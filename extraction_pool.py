@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+import os
+import queue
+import threading
+
+from logger import log_info, log_error, log_warning
+
+# Количество процессов извлечения (разбор страниц yt-dlp нагружает CPU)
+DEFAULT_EXTRACTION_WORKERS = max(1, min(4, (os.cpu_count() or 2) // 2))
+
+# Сколько ждать завершения процесса при остановке пула
+EXTRACTION_SHUTDOWN_TIMEOUT = 2  # секунды
+
+# Как часто ожидающий результата поток проверяет отмену
+CANCEL_POLL_INTERVAL = 0.1  # секунды
+
+
+class ExtractionCancelled(Exception):
+    """Получение форматов отменено; процесс, выполнявший его, завершен"""
+    def __init__(self, message="Extraction cancelled."):
+        super().__init__(message)
+
+
+def _worker_main(conn):
+    """
+    Цикл процесса извлечения
+
+    yt_dlp импортируется один раз при старте процесса. Запрос - кортеж
+    (method, args), ответ - ('metadata', data) для промежуточных результатов
+    и ('result', data) или ('error', текст) в конце; None - завершение.
+    """
+    from video_downloader import get_formats
+
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            return
+        if message is None:
+            return
+        method, args = message
+
+        def on_metadata(metadata):
+            conn.send(('metadata', metadata))
+
+        try:
+            if method != 'get_formats':
+                raise ValueError(f"Unknown extraction method: {method}")
+            result = get_formats(args['url'], on_metadata=on_metadata if args.get('metadata') else None)
+            conn.send(('result', result))
+        except Exception as e:
+            conn.send(('error', str(e)))
+
+
+class ExtractionWorker:
+    """Процесс извлечения и его конец канала"""
+    def __init__(self, context):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def kill(self):
+        """Немедленно завершает процесс (сокеты закрывает ОС)"""
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def close(self, timeout=EXTRACTION_SHUTDOWN_TIMEOUT):
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(timeout)
+        self.conn.close()
+
+
+class ExtractionPool:
+    """
+    Пул заранее запущенных процессов для получения форматов
+
+    Извлечение (разбор страниц, JSON, интерпретация JS) выполняется в
+    отдельных процессах и не конкурирует за GIL с Flask и хуками загрузок;
+    обратно по каналу приходят только отфильтрованные форматы (полный
+    info_dict процесс сохраняет в общий info_cache). Вызывающий поток занимает
+    свободный процесс на время запроса; упавший процесс перезапускается.
+    Отмена завершает процесс посреди извлечения и запускает ему замену.
+    Пока пул не запущен (start вызывается только из __main__), get_formats
+    выполняется в вызывающем потоке и отменяется только до начала.
+    """
+    def __init__(self, workers=DEFAULT_EXTRACTION_WORKERS):
+        self.workers = max(1, int(workers))
+        self._context = multiprocessing.get_context('spawn')
+        self._idle = queue.Queue()
+        self._all = []
+        self._lock = threading.Lock()
+        self._started = False
+
+    def start(self):
+        """Запускает процессы (импорт yt_dlp в них идет параллельно с запуском приложения)"""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            for _ in range(self.workers):
+                worker = ExtractionWorker(self._context)
+                self._all.append(worker)
+                self._idle.put(worker)
+        log_info(f"Extraction pool started: {self.workers} process(es)")
+
+    def close(self):
+        """Останавливает процессы"""
+        with self._lock:
+            workers, self._all = self._all, []
+            self._started = False
+        for worker in workers:
+            worker.close()
+
+    def _replace(self, worker):
+        """Завершает процесс (упавший или отмененный) и запускает ему замену"""
+        worker.kill()
+        replacement = ExtractionWorker(self._context)
+        with self._lock:
+            if worker in self._all:
+                self._all.remove(worker)
+            self._all.append(replacement)
+        return replacement
+
+    def _acquire(self, cancel_event):
+        """Ждет свободный процесс; отмена прерывает и ожидание"""
+        while True:
+            try:
+                worker = self._idle.get(timeout=CANCEL_POLL_INTERVAL)
+            except queue.Empty:
+                if cancel_event is not None and cancel_event.is_set():
+                    raise ExtractionCancelled()
+                continue
+            if not worker.is_alive():
+                worker = self._replace(worker)
+            return worker
+
+    def get_formats(self, url, on_metadata=None, cancel_event=None):
+        """
+        То же, что video_downloader.get_formats(url, on_metadata=...), но в процессе пула
+        
+        Args:
+            cancel_event: threading.Event; после его установки извлечение
+                прерывается (процесс завершается) и выбрасывается ExtractionCancelled
+        """
+        if cancel_event is not None and cancel_event.is_set():
+            raise ExtractionCancelled()
+        if not self._started:
+            from video_downloader import get_formats
+            return get_formats(url, on_metadata=on_metadata)
+
+        worker = self._acquire(cancel_event)
+        try:
+            worker.conn.send(('get_formats', {'url': url, 'metadata': on_metadata is not None}))
+            while True:
+                if cancel_event is not None and cancel_event.is_set():
+                    log_info(f"Extraction cancelled, restarting its process: {url}")
+                    worker = self._replace(worker)
+                    raise ExtractionCancelled()
+                if not worker.conn.poll(CANCEL_POLL_INTERVAL):
+                    continue
+                kind, data = worker.conn.recv()
+                if kind == 'metadata':
+                    try:
+                        on_metadata(data)
+                    except Exception as e:
+                        log_warning(f"Error in metadata callback for {url}: {e}")
+                elif kind == 'result':
+                    return data
+                elif kind == 'error':
+                    raise Exception(data)
+        except (EOFError, OSError) as e:
+            log_error(f"Extraction process died while fetching {url}: {e}")
+            worker = self._replace(worker)
+            raise Exception("Ошибка получения форматов: процесс извлечения завершился аварийно")
+        finally:
+            self._idle.put(worker)
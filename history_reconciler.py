@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import time
+
+from logger import log_info, log_warning
+
+# Как часто проверять наличие файлов из истории
+RECONCILE_INTERVAL = 60  # секунды
+
+
+class DirectoryCache:
+    """
+    Кэш содержимого папок, ключ - (путь, mtime папки)
+
+    Создание, удаление и переименование файла меняют mtime папки, поэтому
+    пока mtime не изменился, повторное чтение списка файлов не нужно:
+    проверка сотни файлов из одной папки стоит одного stat.
+    """
+    def __init__(self):
+        self._entries = {}  # путь -> (mtime, set имен)
+
+    def list(self, folder):
+        """Имена файлов в папке или None, если папка недоступна"""
+        try:
+            mtime = os.stat(folder).st_mtime_ns
+        except OSError:
+            self._entries.pop(folder, None)
+            return None
+        cached = self._entries.get(folder)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        try:
+            names = set(os.listdir(folder))
+        except OSError as e:
+            log_warning(f"Cannot list {folder}: {e}")
+            self._entries.pop(folder, None)
+            return None
+        self._entries[folder] = (mtime, names)
+        return names
+
+    def exists(self, file_path):
+        folder, name = os.path.split(os.path.abspath(file_path))
+        names = self.list(folder)
+        return names is not None and name in names
+
+
+class HistoryReconciler:
+    """
+    Фоновая сверка истории с файлами на диске
+
+    Периодически отмечает в download_history.file_missing записи, чьи файлы
+    удалены или перемещены (и снимает отметку, если файл вернулся, например
+    после подключения сетевого диска). /api/history читает только колонку
+    и не обращается к файловой системе.
+    """
+    def __init__(self, db, interval=RECONCILE_INTERVAL, on_change=None):
+        """
+        Args:
+            db: Database
+            interval: Секунды между сверками
+            on_change: Функция без аргументов, вызываемая, если видимая история изменилась
+        """
+        self.db = db
+        self.interval = interval
+        self.on_change = on_change
+        self.cache = DirectoryCache()
+        self._thread = None
+
+    def start(self):
+        """Запускает фоновую сверку (первая - сразу)"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        while True:
+            try:
+                self.reconcile()
+            except Exception as e:
+                log_warning(f"History reconciliation failed: {e}")
+            time.sleep(self.interval)
+
+    def reconcile(self):
+        """Одна сверка; возвращает количество записей, у которых изменился file_missing"""
+        # Файл записи, чей URL снова в очереди, может быть перезаписан - такие записи не скрываем
+        queue_urls = {item['url'] for item in self.db.get_queue() if item.get('url')}
+        missing_ids = []
+        found_ids = []
+        for item in self.db.get_history_files():
+            missing = not self.cache.exists(item['file_path']) and item['url'] not in queue_urls
+            if missing and not item['file_missing']:
+                missing_ids.append(item['id'])
+            elif not missing and item['file_missing']:
+                found_ids.append(item['id'])
+        if missing_ids:
+            self.db.set_history_file_missing(missing_ids, True)
+        if found_ids:
+            self.db.set_history_file_missing(found_ids, False)
+        if missing_ids or found_ids:
+            log_info(f"History reconciliation: {len(missing_ids)} file(s) missing, {len(found_ids)} restored")
+            if self.on_change:
+                self.on_change()
+        return len(missing_ids) + len(found_ids)
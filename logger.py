@@ -15,11 +15,6 @@ BACKUP_COUNT = 5
 logger = logging.getLogger('VideoDownloader')
 logger.setLevel(logging.DEBUG)
 
-# Очищаем файл при первом запуске
-if os.path.exists(LOG_FILE):
-    with open(LOG_FILE, 'w') as f:
-        f.write('')  # Очищаем файл
-
 # Создаем форматтер
 formatter = logging.Formatter(
     '%(asctime)s - %(levelname)s - [%(name)s] - %(message)s',
@@ -46,6 +41,18 @@ logger.addHandler(file_handler)
 logger.addHandler(console_handler)
 
 
+def clear_log_file():
+    """
+    Очищает файл лога при запуске приложения
+    
+    Не выполняется при импорте: процессы пулов тоже импортируют logger
+    и пишут в тот же файл.
+    """
+    if os.path.exists(LOG_FILE):
+        with open(LOG_FILE, 'w') as f:
+            f.write('')  # Очищаем файл
+
+
 def clean_ansi_codes(text):
     """Удаляет ANSI escape коды из текста"""
     if not text:
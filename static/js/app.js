@@ -2,6 +2,8 @@
 let currentFetchTaskId = null;
 let currentVideoTitle = null;
 let currentThumbnailPath = null;
+let currentThumbnailUrl = null; // Исходный URL картинки, пока thumbnail скачивается в фоне
+let thumbnailPollTaskId = null; // Задача fetch-formats, чей thumbnail ожидается
 let currentFormats = []; // Сохраняем список форматов для быстрого доступа к label
 const originalWindowTitle = document.title;
 let audioContext = null; // Глобальный аудиоконтекст для воспроизведения звуков
@@ -18,16 +20,25 @@ const formatsSelect = document.getElementById('formats-select');
 const addToQueueBtn = document.getElementById('add-to-queue-btn');
 const videoPreviewSection = document.getElementById('video-preview-section');
 const videoPreviewItem = document.getElementById('video-preview-item');
+const batchSection = document.getElementById('batch-section');
+const batchProgress = document.getElementById('batch-progress');
+const batchList = document.getElementById('batch-list');
+const batchCancelBtn = document.getElementById('batch-cancel-btn');
+const batchAddBtn = document.getElementById('batch-add-btn');
 const queueSection = document.getElementById('queue-section');
 const queueList = document.getElementById('queue-list');
 const queueStartBtn = document.getElementById('queue-start-btn');
 const queuePauseBtn = document.getElementById('queue-pause-btn');
 const queueStopBtn = document.getElementById('queue-stop-btn');
+const maxWorkersInput = document.getElementById('max-workers-input');
+const adaptiveConcurrencyCheckbox = document.getElementById('adaptive-concurrency');
 const progressBar = document.getElementById('progress-bar');
 const progressText = document.getElementById('progress-text');
 const progressSection = document.querySelector('.progress-section');
 const statusMessage = document.getElementById('status-message');
 const historyList = document.getElementById('history-list');
+const historyLoadMoreBtn = document.getElementById('history-load-more-btn');
+const historySearchInput = document.getElementById('history-search-input');
 const deleteModal = document.getElementById('delete-modal');
 const deleteHistoryOnlyBtn = document.getElementById('delete-history-only-btn');
 const deleteWithFileBtn = document.getElementById('delete-with-file-btn');
@@ -69,10 +80,16 @@ document.addEventListener('DOMContentLoaded', async () => {
     progressSection.style.display = 'none';
     await loadUIState();
     await loadConfig();
-    await Promise.all([
+    await loadConcurrency();
+    const [, queueData] = await Promise.all([
         loadHistory(),
         loadQueue()
     ]);
+    connectEvents();
+    if (queueData && queueData.running) {
+        // Очередь продолжает загрузки, прерванные прошлым запуском
+        startProgressUpdate();
+    }
     setupEventListeners();
     updateSoundIcon(); // Устанавливаем правильную иконку звука при загрузке
     hideLoading();
@@ -131,13 +148,18 @@ function extractFilename(path) {
 }
 
 // Создание thumbnail элемента
-function createThumbnailElement(thumbnailPath, altText, className) {
+// variant: 'list' (уменьшенная копия, по умолчанию) или 'original'
+function createThumbnailElement(thumbnailPath, altText, className, variant = 'list') {
     if (!thumbnailPath) return null;
     const thumbnail = document.createElement('img');
     thumbnail.className = className;
     const filename = extractFilename(thumbnailPath);
-    thumbnail.src = `/api/thumbnail/${filename}`;
+    thumbnail.src = variant === 'list'
+        ? `/api/thumbnail/${filename}`
+        : `/api/thumbnail/${filename}?variant=${encodeURIComponent(variant)}`;
     thumbnail.alt = altText || 'Thumbnail';
+    thumbnail.loading = 'lazy';
+    thumbnail.decoding = 'async';
     thumbnail.onerror = function() {
         this.style.display = 'none';
     };
@@ -276,9 +298,15 @@ function setupEventListeners() {
     selectFolderBtn.addEventListener('click', handleSelectFolder);
     fetchFormatsBtn.addEventListener('click', handleFetchFormats);
     addToQueueBtn.addEventListener('click', handleAddToQueue);
+    batchCancelBtn.addEventListener('click', handleBatchCancel);
+    batchAddBtn.addEventListener('click', handleBatchAddToQueue);
     queueStartBtn.addEventListener('click', handleQueueStart);
     queuePauseBtn.addEventListener('click', handleQueuePause);
     queueStopBtn.addEventListener('click', handleQueueStop);
+    historyLoadMoreBtn.addEventListener('click', loadMoreHistory);
+    historySearchInput.addEventListener('input', handleHistorySearchInput);
+    maxWorkersInput.addEventListener('change', handleMaxWorkersChange);
+    adaptiveConcurrencyCheckbox.addEventListener('change', handleAdaptiveConcurrencyChange);
     if (loadingCancelBtn) {
         loadingCancelBtn.addEventListener('click', handleLoadingCancel);
     }
@@ -306,6 +334,8 @@ function setupEventListeners() {
     urlInput.addEventListener('input', () => {
         currentVideoTitle = null;
         currentThumbnailPath = null;
+        currentThumbnailUrl = null;
+        thumbnailPollTaskId = null;
         hideVideoPreview();
     });
     downloadFolderInput.addEventListener('blur', saveUIState);
@@ -321,6 +351,8 @@ async function handlePasteUrl() {
             urlInput.focus();
             currentVideoTitle = null;
             currentThumbnailPath = null;
+            currentThumbnailUrl = null;
+            thumbnailPollTaskId = null;
             hideVideoPreview();
             saveUIState();
             showStatus('URL pasted from clipboard', 'success');
@@ -362,6 +394,9 @@ function handleAudioOnlyChange() {
     } else {
         formatsSection.style.display = 'block';
     }
+    batchResults.forEach(item => {
+        item.select.style.display = audioOnlyCheckbox.checked || !item.select.options.length ? 'none' : '';
+    });
 }
 
 // Получение форматов
@@ -372,16 +407,30 @@ async function handleFetchFormats() {
         return;
     }
 
+    // Несколько ссылок - пакетное получение форматов
+    const urls = parseUrls(url);
+    if (urls.length > 1) {
+        hideVideoPreview();
+        formatsSection.style.display = 'none';
+        startBatchFetch(urls);
+        return;
+    }
+    hideBatchSection();
+
     if (audioOnlyCheckbox.checked) {
         showStatus('Audio only mode selected. Formats not needed.', 'info');
         currentVideoTitle = null;
         currentThumbnailPath = null;
+        currentThumbnailUrl = null;
+        thumbnailPollTaskId = null;
         hideVideoPreview();
         return;
     }
     
     currentVideoTitle = null;
     currentThumbnailPath = null;
+    currentThumbnailUrl = null;
+    thumbnailPollTaskId = null;
     currentFormats = []; // Очищаем предыдущие форматы
     hideVideoPreview();
     fetchFormatsBtn.disabled = true;
@@ -404,7 +453,7 @@ async function handleFetchFormats() {
         const data = await response.json();
         currentFetchTaskId = data.task_id;
 
-        // Проверяем результат каждые 500мс
+        // Ждем результат по частям (long polling)
         checkFormatsResult();
     } catch (error) {
         hideLoadingOverlay();
@@ -414,13 +463,24 @@ async function handleFetchFormats() {
     }
 }
 
-// Проверка результата получения форматов
-async function checkFormatsResult() {
-    if (!currentFetchTaskId) return;
+// Сколько секунд сервер держит запрос результата, если ничего не изменилось
+const FORMATS_WAIT_SECONDS = 20;
+
+// Ожидание изменений задачи получения форматов (long polling)
+async function waitFormatsTask(taskId, version) {
+    const response = await fetch(`/api/get-formats/${taskId}?since=${version}&wait=${FORMATS_WAIT_SECONDS}`);
+    return response.json();
+}
+
+// Проверка результата получения форматов: название, затем форматы, затем thumbnail
+async function checkFormatsResult(version = -1) {
+    const taskId = currentFetchTaskId;
+    if (!taskId) return;
 
     try {
-        const response = await fetch(`/api/get-formats/${currentFetchTaskId}`);
-        const data = await response.json();
+        const data = await waitFormatsTask(taskId, version);
+        // Пока ждали ответа, запрос отменили или начали новый
+        if (taskId !== currentFetchTaskId) return;
 
         if (data.error) {
             throw new Error(data.error);
@@ -444,6 +504,7 @@ async function checkFormatsResult() {
             formatsSection.style.display = 'block';
             currentVideoTitle = data.title || null;
             currentThumbnailPath = data.thumbnail_path || null;
+            currentThumbnailUrl = data.thumbnail_url || null;
             
             // Показываем превью видео
             showVideoPreview(currentVideoTitle, currentThumbnailPath);
@@ -451,6 +512,12 @@ async function checkFormatsResult() {
             showStatus(`Formats fetched for: ${currentVideoTitle || 'video'}`, 'success');
             fetchFormatsBtn.disabled = false;
             currentFetchTaskId = null;
+
+            // Thumbnail скачивается в фоне - подставим его, когда будет готов
+            if (data.thumbnail_pending) {
+                thumbnailPollTaskId = taskId;
+                checkThumbnailResult(taskId, data.version);
+            }
         } else if (data.status === 'cancelled') {
             // Задача отменена
             hideLoadingOverlay();
@@ -458,10 +525,19 @@ async function checkFormatsResult() {
             fetchFormatsBtn.disabled = false;
             currentFetchTaskId = null;
         } else if (data.status === 'fetching') {
-            // Еще загружается
-            setTimeout(checkFormatsResult, 500);
+            // Название известно раньше форматов - показываем его сразу
+            if (data.stage === 'metadata' && data.title) {
+                currentVideoTitle = data.title;
+                currentThumbnailPath = data.thumbnail_path || null;
+                if (loadingTitle) {
+                    loadingTitle.textContent = `Getting formats: ${data.title}`;
+                }
+                showVideoPreview(currentVideoTitle, currentThumbnailPath);
+            }
+            checkFormatsResult(data.version);
         }
     } catch (error) {
+        if (taskId !== currentFetchTaskId) return;
         hideLoadingOverlay();
         showStatus('Error: ' + error.message, 'error');
         fetchFormatsBtn.disabled = false;
@@ -471,6 +547,212 @@ async function checkFormatsResult() {
     }
 }
 
+// Пакетное получение форматов
+let currentBatchId = null;
+let batchResults = []; // {url, title, formats, thumbnail_path, thumbnail_url, select}
+
+// Ссылки из введенного текста (разделены пробелами или переводами строк)
+function parseUrls(text) {
+    return text.split(/\s+/).filter(part => /^https?:\/\//i.test(part));
+}
+
+function hideBatchSection() {
+    currentBatchId = null;
+    batchResults = [];
+    if (batchSection) {
+        batchSection.style.display = 'none';
+    }
+    if (batchList) {
+        batchList.innerHTML = '';
+    }
+}
+
+async function startBatchFetch(urls) {
+    hideBatchSection();
+    fetchFormatsBtn.disabled = true;
+
+    try {
+        const response = await fetch('/api/fetch-formats/batch', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ urls })
+        });
+        const data = await response.json();
+        if (!response.ok) {
+            throw new Error(data.error || 'Error fetching formats');
+        }
+
+        currentBatchId = data.batch_id;
+        batchSection.style.display = 'block';
+        batchCancelBtn.style.display = 'inline-block';
+        batchAddBtn.disabled = true;
+        updateBatchProgress(0, data.tasks.length, 0);
+        checkBatchResult(currentBatchId, 0);
+    } catch (error) {
+        showStatus('Error: ' + error.message, 'error');
+        fetchFormatsBtn.disabled = false;
+        logErrorToBackend('startBatchFetch', error.message, error.stack, new Date().toISOString());
+    }
+}
+
+function updateBatchProgress(done, total, failed) {
+    let text = `Formats fetched: ${done} of ${total}`;
+    if (failed) {
+        text += ` (${failed} failed)`;
+    }
+    batchProgress.textContent = text;
+}
+
+// Ожидание результатов пакета: приходят по мере готовности (long polling)
+async function checkBatchResult(batchId, cursor) {
+    if (!batchId || batchId !== currentBatchId) return;
+
+    try {
+        const response = await fetch(`/api/fetch-formats/batch/${batchId}?cursor=${cursor}&wait=${FORMATS_WAIT_SECONDS}`);
+        const data = await response.json();
+        if (batchId !== currentBatchId) return;
+        if (!response.ok) {
+            throw new Error(data.error || 'Error fetching formats');
+        }
+
+        data.results.forEach(result => {
+            if (result.status !== 'cancelled') {
+                batchList.appendChild(createBatchItemElement(result));
+            }
+        });
+        updateBatchProgress(data.done, data.total, data.failed);
+        batchAddBtn.disabled = !batchResults.length;
+
+        if (data.done < data.total) {
+            checkBatchResult(batchId, data.cursor);
+        } else {
+            batchCancelBtn.style.display = 'none';
+            fetchFormatsBtn.disabled = false;
+            showStatus(`Formats fetched for ${data.total - data.failed} of ${data.total} videos`, data.failed ? 'info' : 'success');
+        }
+    } catch (error) {
+        fetchFormatsBtn.disabled = false;
+        showStatus('Error: ' + error.message, 'error');
+        logErrorToBackend('checkBatchResult', error.message, error.stack, new Date().toISOString());
+    }
+}
+
+function createBatchItemElement(result) {
+    const div = document.createElement('div');
+    div.className = 'batch-item';
+
+    const thumbnail = createThumbnailElement(result.thumbnail_path, result.title || 'Thumbnail', 'batch-item-thumbnail');
+    if (thumbnail) {
+        div.appendChild(thumbnail);
+    }
+
+    const info = document.createElement('div');
+    info.className = 'batch-item-info';
+    const title = document.createElement('div');
+    title.className = 'batch-item-title';
+    title.textContent = result.title || result.url;
+    title.title = result.url;
+    info.appendChild(title);
+    div.appendChild(info);
+
+    if (result.error) {
+        const error = document.createElement('div');
+        error.className = 'batch-item-error';
+        error.textContent = result.error;
+        info.appendChild(error);
+        return div;
+    }
+
+    // Форматы отсортированы по высоте - по умолчанию выбираем лучший
+    const select = document.createElement('select');
+    select.className = 'batch-item-format';
+    (result.formats || []).forEach(fmt => {
+        const option = document.createElement('option');
+        option.textContent = fmt.label || fmt.format_id;
+        option.value = fmt.format_id;
+        select.appendChild(option);
+    });
+    select.selectedIndex = select.options.length - 1;
+    select.style.display = audioOnlyCheckbox.checked || !select.options.length ? 'none' : '';
+    div.appendChild(select);
+
+    batchResults.push({ ...result, select });
+    return div;
+}
+
+async function handleBatchCancel() {
+    const batchId = currentBatchId;
+    if (!batchId) return;
+    try {
+        await fetch(`/api/fetch-formats/batch/${batchId}/cancel`, { method: 'POST' });
+        showStatus('Format fetching cancelled', 'info');
+    } catch (error) {
+        logErrorToBackend('handleBatchCancel', error.message, error.stack, new Date().toISOString());
+    }
+}
+
+async function handleBatchAddToQueue() {
+    const audioOnly = audioOnlyCheckbox.checked;
+    const items = batchResults.filter(item => audioOnly || item.select.value);
+    if (!items.length) {
+        showStatus('Nothing to add', 'error');
+        return;
+    }
+
+    batchAddBtn.disabled = true;
+    try {
+        for (const item of items) {
+            const formatId = audioOnly ? null : item.select.value;
+            const selectedFormat = (item.formats || []).find(fmt => fmt.format_id === formatId);
+            await fetch('/api/queue/add', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({
+                    url: item.url,
+                    title: item.title || '',
+                    format_id: formatId,
+                    audio_only: audioOnly,
+                    download_folder: downloadFolderInput.value,
+                    thumbnail_path: item.thumbnail_path || null,
+                    thumbnail_url: item.thumbnail_path ? null : item.thumbnail_url,
+                    format_label: audioOnly ? 'Audio only' : (selectedFormat ? selectedFormat.label || formatId : formatId)
+                })
+            });
+        }
+        showStatus(`Added to queue: ${items.length}`, 'success');
+        hideBatchSection();
+        loadQueue();
+        queueSection.style.display = 'block';
+    } catch (error) {
+        batchAddBtn.disabled = false;
+        showStatus('Error: ' + error.message, 'error');
+        logErrorToBackend('handleBatchAddToQueue', error.message, error.stack, new Date().toISOString());
+    }
+}
+
+// Ожидание thumbnail, который скачивается после получения форматов
+async function checkThumbnailResult(taskId, version) {
+    if (!taskId || taskId !== thumbnailPollTaskId) return;
+
+    try {
+        const data = await waitFormatsTask(taskId, version);
+        if (taskId !== thumbnailPollTaskId) return;
+
+        if (data.thumbnail_pending) {
+            checkThumbnailResult(taskId, data.version);
+            return;
+        }
+        thumbnailPollTaskId = null;
+        if (data.thumbnail_path) {
+            currentThumbnailPath = data.thumbnail_path;
+            showVideoPreview(currentVideoTitle, currentThumbnailPath);
+        }
+    } catch (error) {
+        thumbnailPollTaskId = null;
+        logErrorToBackend('checkThumbnailResult', error.message, error.stack, new Date().toISOString());
+    }
+}
+
 // Показ превью видео
 function showVideoPreview(title, thumbnailPath) {
     if (!videoPreviewSection || !videoPreviewItem) return;
@@ -689,28 +971,87 @@ async function handleAddToQueue() {
             audio_only: audioOnly,
             download_folder: downloadFolderInput.value,
             thumbnail_path: currentThumbnailPath || null,
+            thumbnail_url: currentThumbnailPath ? null : currentThumbnailUrl,
             format_label: formatLabel // Передаем format_label с фронтенда
         })
     });
 
     showStatus('Added to queue', 'success');
+    // Thumbnail, если он еще скачивается, сервер подставит в элемент очереди сам
+    thumbnailPollTaskId = null;
     hideVideoPreview();
     loadQueue();
     queueSection.style.display = 'block';
 }
 
+// Состояние очереди на клиенте (обновляется событиями /api/events)
+let queueState = [];
+
+const QUEUE_STATUS_TEXT = {
+    'pending': 'Pending',
+    'downloading': 'Downloading',
+    'paused': 'Paused',
+    'interrupted': 'Interrupted',
+    'postprocessing': 'Processing',
+    'finished': 'Completed',
+    'error': 'Error',
+    'cancelled': 'Cancelled'
+};
+
+function isQueueItemDownloading(item) {
+    return item.status === 'downloading' && !item.paused;
+}
+
+function formatBytes(bytes) {
+    const units = ['B', 'KB', 'MB', 'GB'];
+    let value = bytes;
+    let unit = 0;
+    while (value >= 1024 && unit < units.length - 1) {
+        value /= 1024;
+        unit++;
+    }
+    return `${value.toFixed(unit === 0 ? 0 : 1)} ${units[unit]}`;
+}
+
+function formatEta(seconds) {
+    const minutes = Math.floor(seconds / 60);
+    const secs = Math.floor(seconds % 60);
+    return `${minutes}:${String(secs).padStart(2, '0')}`;
+}
+
+function formatQueueStatus(item) {
+    let text = `Status: ${QUEUE_STATUS_TEXT[item.status] || item.status}`;
+    if (item.progress !== undefined && isQueueItemDownloading(item)) {
+        text += ` (${Math.round(item.progress)}%)`;
+        if (item.speed) {
+            text += ` · ${formatBytes(item.speed)}/s`;
+        }
+        if (item.eta) {
+            text += ` · ETA ${formatEta(item.eta)}`;
+        }
+    }
+    return text;
+}
+
 // Загрузка очереди
 async function loadQueue() {
     const response = await fetch('/api/queue/list');
     const data = await response.json();
+    queueState = data.queue;
+    renderQueue();
+    updateQueueSummary();
+    return data;
+}
 
+// Отрисовка списка очереди
+function renderQueue() {
     queueList.innerHTML = '';
 
-    let activeProgresses = [];
-    if (data.queue.length > 0) {
-        data.queue.forEach(item => {
+    if (queueState.length > 0) {
+        queueState.forEach(item => {
             const div = document.createElement('div');
             div.className = 'queue-item';
+            div.dataset.queueId = item.id;
             
             // Thumbnail
             if (item.thumbnail_path) {
@@ -729,19 +1070,7 @@ async function loadQueue() {
             
             const status = document.createElement('div');
             status.className = 'queue-item-status';
-            const statusText = {
-                'pending': 'Pending',
-                'downloading': 'Downloading',
-                'paused': 'Paused',
-                'finished': 'Completed',
-                'error': 'Error',
-                'cancelled': 'Cancelled'
-            }[item.status] || item.status;
-            status.textContent = `Status: ${statusText}`;
-            if (item.progress !== undefined && item.status === 'downloading' && !item.paused) {
-                status.textContent += ` (${Math.round(item.progress)}%)`;
-                activeProgresses.push(item.progress);
-            }
+            status.textContent = formatQueueStatus(item);
             
             info.appendChild(title);
             info.appendChild(status);
@@ -760,14 +1089,39 @@ async function loadQueue() {
     } else {
         queueSection.style.display = 'none';
     }
+}
+
+// Прогресс одной загрузки: обновляем только её строку статуса, без перестройки списка
+function applyProgressEvent(data) {
+    const item = queueState.find(queueItem => queueItem.id === data.queue_id);
+    if (!item) {
+        return;
+    }
+    const { queue_id, ...progress } = data;
+    Object.assign(item, progress);
     
-    const hasActiveDownloads = data.queue.some(item => item.status === 'downloading' && !item.paused);
+    const status = queueList.querySelector(`.queue-item[data-queue-id="${data.queue_id}"] .queue-item-status`);
+    if (status) {
+        status.textContent = formatQueueStatus(item);
+    }
+    updateQueueSummary();
+}
+
+// Общий прогресс, overlay и доступность формы по состоянию очереди
+function updateQueueSummary() {
+    const activeProgresses = queueState
+        .filter(item => item.progress !== undefined && isQueueItemDownloading(item))
+        .map(item => item.progress);
+    
+    const hasRunningDownloads = queueState.some(isQueueItemDownloading);
+    // Постобработка (ffmpeg) идет после загрузки - продолжаем следить за очередью
+    const hasActiveDownloads = hasRunningDownloads || queueState.some(item => item.status === 'postprocessing');
     
     // Проверяем, есть ли загрузки с прогрессом >= 1%
     const hasProgress = activeProgresses.length > 0 && activeProgresses.some(progress => progress >= 1);
     
     // Проверяем наличие retry_status для обновления overlay
-    const retryStatus = data.queue.find(item => item.retry_status && item.status === 'downloading')?.retry_status;
+    const retryStatus = queueState.find(item => item.retry_status && item.status === 'downloading')?.retry_status;
     
     // Управление overlay: проверяем независимо от блока прогресса
     if (hasProgress) {
@@ -776,15 +1130,15 @@ async function loadQueue() {
     } else if (retryStatus) {
         // Показываем overlay с retry_status если он есть (во время инициализации)
         showLoadingOverlay(retryStatus, true);
-    } else if (hasActiveDownloads && !hasProgress) {
+    } else if (hasRunningDownloads && !hasProgress) {
         // Показываем overlay при инициализации (есть активные загрузки, но нет прогресса)
         showLoadingOverlay('Initializing download...', true);
-    } else if (!hasActiveDownloads) {
+    } else if (!hasRunningDownloads) {
         // Скрываем overlay если нет активных загрузок
         hideLoadingOverlay();
     }
     
-    if (activeProgresses.length > 0 && hasActiveDownloads) {
+    if (activeProgresses.length > 0 && hasRunningDownloads) {
         const avgProgress = activeProgresses.reduce((a, b) => a + b, 0) / activeProgresses.length;
         updateProgress(avgProgress);
         updateWindowTitle(Math.round(avgProgress));
@@ -817,10 +1171,11 @@ async function loadQueue() {
     
     hadActiveDownloads = hasActiveDownloads;
     
-    if (data.queue.length < previousQueueLength) {
-        loadHistory();
+    // Без потока событий об изменениях истории узнаем по уменьшению очереди
+    if (!eventSource && queueState.length < previousQueueLength) {
+        refreshHistory();
     }
-    previousQueueLength = data.queue.length;
+    previousQueueLength = queueState.length;
 }
 
 // Запуск очереди
@@ -840,6 +1195,10 @@ async function handleQueuePause() {
     queuePauseBtn.textContent = isPaused ? '⏸️ Pause' : '▶️ Resume';
     showStatus(isPaused ? 'Download resumed' : 'Download paused', 'info');
     loadQueue();
+    if (isPaused) {
+        // Загрузки перезапускаются планировщиком и продолжаются с места остановки
+        startProgressUpdate();
+    }
 }
 
 // Остановка очереди
@@ -858,6 +1217,50 @@ async function handleQueueStop() {
     loadQueue();
 }
 
+// Загрузка количества параллельных загрузок
+async function loadConcurrency() {
+    try {
+        const response = await fetch('/api/queue/concurrency');
+        const data = await response.json();
+        maxWorkersInput.value = data.max_workers;
+        adaptiveConcurrencyCheckbox.checked = data.adaptive;
+    } catch (error) {
+        logErrorToBackend('loadConcurrency', error.message, error.stack, new Date().toISOString());
+    }
+}
+
+// Изменение количества параллельных загрузок
+async function handleMaxWorkersChange() {
+    const value = parseInt(maxWorkersInput.value, 10);
+    if (!value || value < 1) {
+        showStatus('Enter a number of parallel downloads!', 'error');
+        return;
+    }
+    const response = await fetch('/api/queue/concurrency', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ max_workers: value })
+    });
+    const data = await response.json();
+    if (data.error) {
+        showStatus('Error: ' + data.error, 'error');
+        return;
+    }
+    maxWorkersInput.value = data.max_workers;
+    showStatus(`Parallel downloads: ${data.max_workers}`, 'info');
+}
+
+// Включение/выключение автоматического подбора количества параллельных загрузок
+async function handleAdaptiveConcurrencyChange() {
+    const adaptive = adaptiveConcurrencyCheckbox.checked;
+    await fetch('/api/queue/concurrency', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ adaptive })
+    });
+    showStatus(adaptive ? 'Parallel downloads: auto' : 'Parallel downloads: fixed', 'info');
+}
+
 // Отмена инициализации загрузки или сбора форматов
 async function handleLoadingCancel() {
     // Проверяем, есть ли активная задача сбора форматов
@@ -881,9 +1284,24 @@ async function handleLoadingCancel() {
 let progressUpdateInterval = null;
 let previousQueueLength = 0;
 let hadActiveDownloads = false;
+let eventSource = null;
+
+// Поток изменений очереди: сервер присылает события только когда что-то изменилось
+function connectEvents() {
+    if (!window.EventSource) {
+        return;
+    }
+    eventSource = new EventSource('/api/events');
+    // После (пере)подключения синхронизируем состояние - события за время разрыва потеряны
+    eventSource.addEventListener('open', () => loadQueue());
+    eventSource.addEventListener('queue', () => loadQueue());
+    eventSource.addEventListener('progress', (event) => applyProgressEvent(JSON.parse(event.data)));
+    eventSource.addEventListener('history', () => refreshHistory());
+}
 
+// Опрос очереди раз в секунду - только если поток событий недоступен
 function startProgressUpdate() {
-    if (progressUpdateInterval) return;
+    if (eventSource || progressUpdateInterval) return;
     previousQueueLength = 0;
     progressUpdateInterval = setInterval(() => {
         loadQueue();
@@ -899,104 +1317,187 @@ function stopProgressUpdate() {
 
 
 // Загрузка истории
-async function loadHistory() {
-    const response = await fetch('/api/history');
-    const data = await response.json();
+// Курсор следующей страницы истории (null - страниц больше нет)
+let historyNextCursor = null;
+let historySearchTimeout = null;
+// Обновление по событию уже идет / нужно еще одно после него
+let historyRefreshRunning = false;
+let historyRefreshPending = false;
+
+// Адрес страницы истории: обычный список или результаты поиска
+function getHistoryUrl(cursor = null) {
+    const query = historySearchInput.value.trim();
+    const params = new URLSearchParams();
+    if (query) {
+        params.set('q', query);
+    }
+    if (cursor) {
+        params.set('cursor', cursor);
+    }
+    const endpoint = query ? '/api/history/search' : '/api/history';
+    const paramsString = params.toString();
+    return paramsString ? `${endpoint}?${paramsString}` : endpoint;
+}
 
+// minItems - сколько записей загрузить как минимум (страницами), чтобы не потерять уже показанные
+async function loadHistory(minItems = 0) {
+    const query = historySearchInput.value.trim();
+    let items = [];
+    let cursor = null;
+    do {
+        const response = await fetch(getHistoryUrl(cursor));
+        const data = await response.json();
+        // Пока ждали ответ, строка поиска изменилась - результат устарел
+        if (query !== historySearchInput.value.trim()) return;
+        items = items.concat(data.history);
+        cursor = data.next_cursor || null;
+    } while (cursor && items.length < minItems);
+
+    // Список заменяется за один раз - позиция прокрутки сохраняется
+    const fragment = document.createDocumentFragment();
+    items.forEach(item => fragment.appendChild(createHistoryItemElement(item)));
     historyList.innerHTML = '';
 
-    if (data.history.length > 0) {
-        data.history.forEach(item => {
-            const div = document.createElement('div');
-            div.className = 'history-item';
+    if (items.length > 0) {
+        historyList.appendChild(fragment);
+    } else if (query) {
+        historyList.innerHTML = '<p style="color: #718096; text-align: center;">Nothing found</p>';
+    } else {
+        historyList.innerHTML = '<p style="color: #718096; text-align: center;">History is empty</p>';
+    }
+    setHistoryNextCursor(cursor);
+}
 
-            // Thumbnail
-            if (item.thumbnail_path) {
-                const thumbnail = createThumbnailElement(item.thumbnail_path, item.title || 'Thumbnail', 'history-item-thumbnail');
-                if (thumbnail) {
-                    div.appendChild(thumbnail);
-                }
-            }
+// Обновление истории по событию сервера: перезагружаются все показанные
+// страницы, а не только первая (подгруженные через Load more не сбрасываются)
+async function refreshHistory() {
+    if (historyRefreshRunning) {
+        historyRefreshPending = true;
+        return;
+    }
+    historyRefreshRunning = true;
+    try {
+        do {
+            historyRefreshPending = false;
+            await loadHistory(historyList.querySelectorAll('.history-item').length);
+        } while (historyRefreshPending);
+    } finally {
+        historyRefreshRunning = false;
+    }
+}
 
-            const info = document.createElement('div');
-            info.className = 'history-item-info';
+// Поиск по истории по мере ввода
+function handleHistorySearchInput() {
+    clearTimeout(historySearchTimeout);
+    historySearchTimeout = setTimeout(loadHistory, 250);
+}
 
-            const title = document.createElement('div');
-            title.className = 'history-item-title';
-            title.textContent = item.title || item.url;
+// Следующая страница истории
+async function loadMoreHistory() {
+    if (!historyNextCursor) return;
+    historyLoadMoreBtn.disabled = true;
+    try {
+        const response = await fetch(getHistoryUrl(historyNextCursor));
+        const data = await response.json();
+        data.history.forEach(item => historyList.appendChild(createHistoryItemElement(item)));
+        setHistoryNextCursor(data.next_cursor);
+    } finally {
+        historyLoadMoreBtn.disabled = false;
+    }
+}
 
-            const details = document.createElement('div');
-            details.className = 'history-item-details';
-            
-            // Показываем формат вместо времени
-            let formatText = '';
-            if (item.audio_only) {
-                formatText = 'Audio only';
-            } else if (item.format_label) {
-                formatText = item.format_label;
-            } else if (item.format_id) {
-                formatText = item.format_id;
-            } else {
-                formatText = 'Unknown format';
-            }
-            
-            // Показываем статус только для ошибок и отмененных
-            if (item.status === 'finished') {
-                details.textContent = formatText;
-            } else {
-                const statusText = item.status === 'error' ? 'Error' : 'Cancelled';
-                details.textContent = `${statusText} | ${formatText}`;
-            }
+function setHistoryNextCursor(cursor) {
+    historyNextCursor = cursor || null;
+    historyLoadMoreBtn.style.display = historyNextCursor ? 'block' : 'none';
+}
 
-            info.appendChild(title);
-            info.appendChild(details);
-            div.appendChild(info);
-            
-            const buttonsDiv = document.createElement('div');
-            buttonsDiv.className = 'history-item-buttons';
-            
-            const copyUrlBtn = document.createElement('button');
-            copyUrlBtn.className = 'action-btn';
-            copyUrlBtn.textContent = '🔗';
-            copyUrlBtn.title = 'Copy URL';
-            copyUrlBtn.onclick = (e) => {
-                e.stopPropagation();
-                copyHistoryUrl(item.url);
-            };
-            buttonsDiv.appendChild(copyUrlBtn);
-            
-            if (item.status === 'finished' && item.file_path) {
-                // Делаем элемент истории кликабельным для открытия файла
-                div.classList.add('history-item-clickable');
-                div.onclick = () => openHistoryFile(item.id);
-                
-                const openFolderBtn = document.createElement('button');
-                openFolderBtn.className = 'action-btn';
-                openFolderBtn.textContent = '📁';
-                openFolderBtn.title = 'Open folder';
-                openFolderBtn.onclick = (e) => {
-                    e.stopPropagation();
-                    openHistoryFolder(item.id);
-                };
-                buttonsDiv.appendChild(openFolderBtn);
-            }
-            
-            const deleteBtn = document.createElement('button');
-            deleteBtn.className = 'delete-btn';
-            deleteBtn.textContent = '×';
-            deleteBtn.title = 'Delete';
-            deleteBtn.onclick = (e) => {
-                e.stopPropagation();
-                showDeleteModal(item.id);
-            };
-            buttonsDiv.appendChild(deleteBtn);
-            
-            div.appendChild(buttonsDiv);
-            historyList.appendChild(div);
-        });
+function createHistoryItemElement(item) {
+    const div = document.createElement('div');
+    div.className = 'history-item';
+
+    // Thumbnail
+    if (item.thumbnail_path) {
+        const thumbnail = createThumbnailElement(item.thumbnail_path, item.title || 'Thumbnail', 'history-item-thumbnail');
+        if (thumbnail) {
+            div.appendChild(thumbnail);
+        }
+    }
+
+    const info = document.createElement('div');
+    info.className = 'history-item-info';
+
+    const title = document.createElement('div');
+    title.className = 'history-item-title';
+    title.textContent = item.title || item.url;
+
+    const details = document.createElement('div');
+    details.className = 'history-item-details';
+    
+    // Показываем формат вместо времени
+    let formatText = '';
+    if (item.audio_only) {
+        formatText = 'Audio only';
+    } else if (item.format_label) {
+        formatText = item.format_label;
+    } else if (item.format_id) {
+        formatText = item.format_id;
     } else {
-        historyList.innerHTML = '<p style="color: #718096; text-align: center;">History is empty</p>';
+        formatText = 'Unknown format';
     }
+    
+    // Показываем статус только для ошибок и отмененных
+    if (item.status === 'finished') {
+        details.textContent = formatText;
+    } else {
+        const statusText = item.status === 'error' ? 'Error' : 'Cancelled';
+        details.textContent = `${statusText} | ${formatText}`;
+    }
+
+    info.appendChild(title);
+    info.appendChild(details);
+    div.appendChild(info);
+    
+    const buttonsDiv = document.createElement('div');
+    buttonsDiv.className = 'history-item-buttons';
+    
+    const copyUrlBtn = document.createElement('button');
+    copyUrlBtn.className = 'action-btn';
+    copyUrlBtn.textContent = '🔗';
+    copyUrlBtn.title = 'Copy URL';
+    copyUrlBtn.onclick = (e) => {
+        e.stopPropagation();
+        copyHistoryUrl(item.url);
+    };
+    buttonsDiv.appendChild(copyUrlBtn);
+    
+    if (item.status === 'finished' && item.file_path) {
+        // Делаем элемент истории кликабельным для открытия файла
+        div.classList.add('history-item-clickable');
+        div.onclick = () => openHistoryFile(item.id);
+        
+        const openFolderBtn = document.createElement('button');
+        openFolderBtn.className = 'action-btn';
+        openFolderBtn.textContent = '📁';
+        openFolderBtn.title = 'Open folder';
+        openFolderBtn.onclick = (e) => {
+            e.stopPropagation();
+            openHistoryFolder(item.id);
+        };
+        buttonsDiv.appendChild(openFolderBtn);
+    }
+    
+    const deleteBtn = document.createElement('button');
+    deleteBtn.className = 'delete-btn';
+    deleteBtn.textContent = '×';
+    deleteBtn.title = 'Delete';
+    deleteBtn.onclick = (e) => {
+        e.stopPropagation();
+        showDeleteModal(item.id);
+    };
+    buttonsDiv.appendChild(deleteBtn);
+    
+    div.appendChild(buttonsDiv);
+    return div;
 }
 
 // Удаление элемента из очереди
@@ -1074,7 +1575,7 @@ async function deleteHistoryItem(historyId, deleteFile) {
         body: JSON.stringify({ delete_file: deleteFile })
     });
     hideDeleteModal();
-    loadHistory();
+    refreshHistory();
 }
 
 
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import time
+
+from logger import log_info, log_warning
+from video_downloader import THUMBNAIL_NAME_RE
+
+# Как часто обслуживать папку thumbnails
+THUMBNAIL_GC_INTERVAL = 30 * 60  # секунды
+
+# Thumbnail, скачанный при получении форматов, попадает в очередь позже -
+# файлы моложе этого возраста не считаются осиротевшими
+THUMBNAIL_GC_GRACE = 60 * 60  # секунды
+
+# Ограничение суммарного размера папки по умолчанию (0 - без ограничения)
+DEFAULT_THUMBNAIL_CACHE_LIMIT_MB = 256
+
+
+class ThumbnailJanitor:
+    """
+    Фоновое обслуживание папки thumbnails
+
+    Удаляет файлы, на которые не ссылается ни одна запись очереди или истории
+    (в том числе скрытой - ее файл может вернуться), и, если папка больше
+    лимита, вытесняет сначала файлы без ссылок (еще не старше grace), затем
+    давно не открывавшиеся thumbnails (LRU). У записей, ссылающихся на
+    удаленный файл, thumbnail_path очищается.
+
+    Время последнего обращения копится в памяти (touch вызывается при отдаче
+    файла) и записывается в thumbnails.accessed_at при обслуживании, а не на
+    каждый запрос.
+    """
+    def __init__(self, db, folder, get_max_bytes=None, interval=THUMBNAIL_GC_INTERVAL, grace=THUMBNAIL_GC_GRACE,
+                 on_change=None):
+        """
+        Args:
+            db: Database
+            folder: Папка thumbnails
+            get_max_bytes: Функция без аргументов, возвращающая лимит размера папки в байтах (0 - без лимита)
+            interval: Секунды между проходами
+            grace: Минимальный возраст файла, который можно удалить как осиротевший
+            on_change: Функция без аргументов, вызываемая после удаления файлов (у записей мог пропасть thumbnail)
+        """
+        self.db = db
+        self.folder = folder
+        self.get_max_bytes = get_max_bytes
+        self.interval = interval
+        self.grace = grace
+        self.on_change = on_change
+        self._touched = {}  # имя файла -> время последней отдачи
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """Запускает фоновое обслуживание (первый проход - сразу)"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        while True:
+            try:
+                self.collect()
+            except Exception as e:
+                log_warning(f"Thumbnail maintenance failed: {e}")
+            time.sleep(self.interval)
+
+    def touch(self, filename):
+        """Отмечает обращение к файлу thumbnail"""
+        with self._lock:
+            self._touched[filename] = time.time()
+
+    def _flush_touched(self):
+        with self._lock:
+            touched, self._touched = self._touched, {}
+        if touched:
+            self.db.touch_thumbnails(touched)
+        return touched
+
+    def _scan(self):
+        """Файлы папки: имя -> (размер, mtime)"""
+        files = {}
+        try:
+            entries = list(os.scandir(self.folder))
+        except OSError:
+            return files
+        for entry in entries:
+            try:
+                if entry.is_file():
+                    stat = entry.stat()
+                    files[entry.name] = (stat.st_size, stat.st_mtime)
+            except OSError:
+                continue
+        return files
+
+    def _referenced(self):
+        """Имена файлов и хэши, на которые ссылаются очередь и история"""
+        names = set()
+        digests = set()
+        for thumbnail_path in self.db.get_thumbnail_references():
+            name = os.path.basename(thumbnail_path)
+            names.add(name)
+            match = THUMBNAIL_NAME_RE.match(name)
+            if match:
+                # Оригинал живет вместе со своим уменьшенным вариантом
+                digests.add(match.group(1))
+        return names, digests
+
+    def _delete(self, name):
+        try:
+            os.remove(os.path.join(self.folder, name))
+            return True
+        except FileNotFoundError:
+            return True
+        except OSError as e:
+            log_warning(f"Cannot delete thumbnail {name}: {e}")
+            return False
+
+    def collect(self):
+        """Один проход; возвращает (удалено осиротевших, вытеснено по лимиту)"""
+        touched = self._flush_touched()
+        files = self._scan()
+        if not files:
+            return 0, 0
+        names, digests = self._referenced()
+        now = time.time()
+
+        orphans = []
+        kept = []
+        young = []
+        for name, (size, mtime) in files.items():
+            match = THUMBNAIL_NAME_RE.match(name)
+            referenced = name in names or (match is not None and match.group(1) in digests)
+            if referenced:
+                kept.append(name)
+            elif now - mtime >= self.grace:
+                orphans.append(name)
+            else:
+                young.append(name)
+        removed = [name for name in orphans if self._delete(name)]
+
+        evicted = []
+        max_bytes = self.get_max_bytes() if self.get_max_bytes else 0
+        total = sum(files[name][0] for name in kept + young)
+        if max_bytes and total > max_bytes:
+            accessed = self.db.get_thumbnail_access_times()
+            accessed.update(touched)
+
+            def last_access(name):
+                return max(accessed.get(name, 0), files[name][1])
+
+            # Сначала файлы без ссылок, затем используемые - по давности обращения
+            for name in sorted(young, key=last_access) + sorted(kept, key=last_access):
+                if total <= max_bytes:
+                    break
+                if self._delete(name):
+                    evicted.append(name)
+                    total -= files[name][0]
+
+        for name in removed + evicted:
+            self.db.delete_thumbnail_records(name)
+        if removed or evicted:
+            # Файла больше нет - записи показывают заглушку, а не битую ссылку
+            self.db.clear_thumbnail_files(removed + evicted)
+            if self.on_change:
+                self.on_change()
+            log_info(f"Thumbnail maintenance: {len(removed)} orphaned, {len(evicted)} evicted, {total} bytes kept")
+        return len(removed), len(evicted)
@@ -2,11 +2,23 @@
 # -*- coding: utf-8 -*-
 
 import yt_dlp
+from yt_dlp.postprocessor import FFmpegMergerPP, FFmpegExtractAudioPP
 import os
 import platform
 import subprocess
 import re
 import time
+import base64
+import copy
+import hashlib
+import http.client
+import io
+import json
+import zlib
+import sqlite3
+import threading
+import urllib.request
+from urllib.parse import urlsplit, urlunsplit, urljoin, parse_qsl, urlencode, unquote
 
 # Импортируем logger только если он доступен (для совместимости с tkinter версией)
 try:
@@ -18,6 +30,56 @@ except ImportError:
     def log_warning(msg): print(f"[WARNING] {msg}")
     def log_debug(msg): print(f"[DEBUG] {msg}")
 
+# Pillow необязателен: без него thumbnails сохраняются в исходном виде
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+# Кэш результатов extract_info (лежит рядом с downloads.db)
+INFO_CACHE_PATH = 'info_cache.db'
+INFO_CACHE_TTL = 60 * 60  # секунды
+INFO_CACHE_MAX_BYTES = 64 * 1024 * 1024  # суммарный размер сжатых записей
+
+# Подписанные URL форматов живут ограниченное время (YouTube - около 6 часов)
+INFO_URL_MAX_AGE = 4 * 60 * 60  # секунды с момента извлечения
+INFO_URL_EXPIRY_MARGIN = 5 * 60  # запас до истечения expire=
+
+# Тяжелые ключи info_dict, которые не нужны для скачивания
+TRIMMED_INFO_KEYS = (
+    'automatic_captions', 'subtitles', 'requested_subtitles', 'heatmap',
+    'thumbnails', 'description', 'comments', 'requested_formats',
+    'requested_downloads', 'filepath', '_filename', 'filename'
+)
+
+# Параметры URL, которые не влияют на содержимое страницы
+TRACKING_QUERY_PARAMS = {'si', 'feature', 'fbclid', 'gclid', 'igshid', 'ref_src'}
+
+# Минимальный интервал между обновлениями прогресса одной загрузки
+PROGRESS_UPDATE_INTERVAL = 0.25  # секунды
+
+# Параметры отложенной постобработки
+MERGE_OUTPUT_FORMAT = 'mp4'
+AUDIO_CODEC = 'mp3'
+AUDIO_QUALITY = '192'
+
+# Thumbnails хранятся по хэшу содержимого: <sha256>.<ext> - оригинал,
+# <sha256>.w<ширина>.jpg - уменьшенный вариант для списков
+THUMBNAIL_TIMEOUT = 10  # секунды на соединение и на каждое чтение
+THUMBNAIL_MAX_BYTES = 10 * 1024 * 1024
+THUMBNAIL_MAX_REDIRECTS = 5
+THUMBNAIL_NAME_RE = re.compile(r'^([0-9a-f]{64})(\.w\d+)?\.(jpg|png|webp)$')
+THUMBNAIL_EXTENSIONS = ('jpg', 'png', 'webp')
+
+# Вариант для списков: миниатюры показываются в 120x90, храним с запасом для HiDPI
+THUMBNAIL_LIST_SIZE = (240, 180)
+THUMBNAIL_JPEG_QUALITY = 80
+THUMBNAIL_KEEP_ORIGINAL = False
+
+# Незавершенные файлы yt-dlp, по которым загрузка продолжается после перезапуска
+PARTIAL_FILE_SUFFIXES = ('.part', '.ytdl')
+
 
 def get_default_download_dir():
     """Определяет папку загрузки по умолчанию в зависимости от ОС"""
@@ -49,15 +111,6 @@ def check_ffmpeg():
         return False
 
 
-def get_video_id(info=None, url=None):
-    """Извлекает video_id из info или генерирует из URL"""
-    if info:
-        return info.get('id') or info.get('display_id') or (str(hash(url)) if url else None)
-    if url:
-        return str(hash(url))
-    return None
-
-
 def open_file_path(file_path):
     """Открывает файл в системном приложении"""
     system = platform.system()
@@ -89,6 +142,35 @@ def safe_delete_thumbnail(thumbnail_path):
             log_error(f"Error deleting thumbnail {thumbnail_path}: {e}")
 
 
+class DownloadPaused(Exception):
+    """Загрузка остановлена паузой; .part файлы сохранены для продолжения"""
+    def __init__(self, message="Download paused by user."):
+        super().__init__(message)
+
+
+def is_paused_error(error):
+    """Проверяет, вызвана ли ошибка паузой (yt-dlp может обернуть исключение из hook)"""
+    return isinstance(error, DownloadPaused) or 'paused by user' in str(error).lower()
+
+
+def find_partial_files(download_folder, title):
+    """Ищет незавершенные файлы (.part/.ytdl/.part-FragN) загрузки с заголовком title"""
+    if not title or not download_folder or not os.path.isdir(download_folder):
+        return []
+    # Имя файла строится из шаблона %(title)s.%(ext)s
+    prefix = yt_dlp.utils.sanitize_filename(title)
+    partial_files = []
+    try:
+        for name in os.listdir(download_folder):
+            if not name.startswith(prefix):
+                continue
+            if name.endswith(PARTIAL_FILE_SUFFIXES) or '.part-Frag' in name:
+                partial_files.append(os.path.join(download_folder, name))
+    except OSError as e:
+        log_warning(f"Error scanning {download_folder} for partial files: {e}")
+    return partial_files
+
+
 def get_flag_value(flag):
     """Получает значение флага (поддерживает dict и callable)"""
     if isinstance(flag, dict):
@@ -192,80 +274,555 @@ class CustomLogger:
         self.messages.append(("ERROR", msg))
 
 
-def get_video_info(url):
-    """Получает информацию о видео без скачивания"""
+def normalize_url(url):
+    """
+    Приводит URL к каноническому виду для использования в качестве ключа кэша
+    
+    Схема и хост переводятся в нижний регистр, трекинговые параметры
+    (utm_*, si, feature, ...) отбрасываются, параметры запроса сортируются.
+    Фрагмент сохраняется только если похож на маршрут SPA (#/... или #!...).
+    """
+    url = (url or '').strip()
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        return url
+    if not parts.scheme or not parts.netloc:
+        return url
+    
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    # Убираем порт по умолчанию
+    if (scheme == 'http' and netloc.endswith(':80')) or (scheme == 'https' and netloc.endswith(':443')):
+        netloc = netloc.rsplit(':', 1)[0]
+    
+    query = [
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not key.lower().startswith('utm_') and key.lower() not in TRACKING_QUERY_PARAMS
+    ]
+    query.sort()
+    
+    fragment = parts.fragment if parts.fragment.startswith(('/', '!')) else ''
+    return urlunsplit((scheme, netloc, parts.path or '/', urlencode(query), fragment))
+
+
+class InfoCache:
+    """
+    Персистентный кэш результатов extract_info в SQLite
+    
+    Записи хранятся сжатыми (JSON + zlib), ключ - нормализованный URL.
+    Устаревшие по TTL записи считаются промахом и удаляются при чтении,
+    при превышении max_bytes вытесняются записи с самым давним обращением.
+    """
+    def __init__(self, path=INFO_CACHE_PATH, ttl=INFO_CACHE_TTL, max_bytes=INFO_CACHE_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._lock = threading.Lock()
+    
+    def _get_conn(self):
+        """Открывает соединение при первом обращении (вызывать под self._lock)"""
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS info_cache (
+                    url_key TEXT PRIMARY KEY,
+                    data BLOB,
+                    size INTEGER,
+                    created_at REAL,
+                    accessed_at REAL
+                )
+            ''')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS idx_info_cache_accessed ON info_cache(accessed_at)')
+            self._conn.commit()
+        return self._conn
+    
+    def get(self, url):
+        """Возвращает закэшированный info_dict или None"""
+        key = normalize_url(url)
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._get_conn()
+                row = conn.execute('SELECT data, created_at FROM info_cache WHERE url_key = ?', (key,)).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+                data, created_at = row
+                if now - created_at > self.ttl:
+                    conn.execute('DELETE FROM info_cache WHERE url_key = ?', (key,))
+                    conn.commit()
+                    self.misses += 1
+                    return None
+                conn.execute('UPDATE info_cache SET accessed_at = ? WHERE url_key = ?', (now, key))
+                conn.commit()
+                self.hits += 1
+            return json.loads(zlib.decompress(data).decode('utf-8'))
+        except Exception as e:
+            log_warning(f"Info cache read error for {url}: {e}")
+            return None
+    
+    def put(self, url, info):
+        """Сохраняет info_dict в кэш"""
+        key = normalize_url(url)
+        now = time.time()
+        try:
+            data = zlib.compress(json.dumps(yt_dlp.YoutubeDL.sanitize_info(info)).encode('utf-8'))
+            with self._lock:
+                conn = self._get_conn()
+                conn.execute(
+                    'INSERT OR REPLACE INTO info_cache (url_key, data, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)',
+                    (key, data, len(data), now, now)
+                )
+                self._evict(conn)
+                conn.commit()
+        except Exception as e:
+            log_warning(f"Info cache write error for {url}: {e}")
+    
+    def invalidate(self, url):
+        """Удаляет запись для URL"""
+        try:
+            with self._lock:
+                conn = self._get_conn()
+                conn.execute('DELETE FROM info_cache WHERE url_key = ?', (normalize_url(url),))
+                conn.commit()
+        except Exception as e:
+            log_warning(f"Info cache invalidate error for {url}: {e}")
+    
+    def _evict(self, conn):
+        """Удаляет просроченные записи и вытесняет давно не используемые при превышении размера"""
+        conn.execute('DELETE FROM info_cache WHERE created_at < ?', (time.time() - self.ttl,))
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM info_cache').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = conn.execute('SELECT url_key, size FROM info_cache ORDER BY accessed_at').fetchall()
+        for url_key, size in rows:
+            if total <= self.max_bytes:
+                break
+            conn.execute('DELETE FROM info_cache WHERE url_key = ?', (url_key,))
+            total -= size
+    
+    def stats(self):
+        """Счетчики попаданий/промахов и текущий размер кэша"""
+        entries, size = 0, 0
+        with self._lock:
+            # Счетчики и размер - один согласованный снимок
+            hits, misses = self.hits, self.misses
+            try:
+                conn = self._get_conn()
+                entries, size = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM info_cache').fetchone()
+            except Exception as e:
+                log_warning(f"Info cache stats error: {e}")
+        return {
+            'hits': hits,
+            'misses': misses,
+            'entries': entries,
+            'size_bytes': size,
+            'max_bytes': self.max_bytes,
+            'ttl': self.ttl
+        }
+
+
+# Общий кэш для всех вызовов get_video_info
+info_cache = InfoCache()
+
+
+def extract_metadata(info):
+    """Основные сведения о видео (без форматов) из info_dict, в том числе необработанного"""
+    thumbnail_url = info.get('thumbnail')
+    if not thumbnail_url:
+        # До обработки есть только список thumbnails (последний - самый предпочтительный)
+        thumbnails = [t for t in info.get('thumbnails') or [] if t.get('url')]
+        thumbnail_url = thumbnails[-1]['url'] if thumbnails else None
+    return {
+        'title': info.get('title'),
+        'thumbnail_url': thumbnail_url,
+        'duration': info.get('duration'),
+        'uploader': info.get('uploader') or info.get('channel'),
+    }
+
+
+def get_video_info(url, use_cache=True, on_metadata=None):
+    """
+    Получает информацию о видео без скачивания
+    
+    Args:
+        url: URL видео
+        use_cache: Читать результат из кэша (при False кэш только обновляется)
+        on_metadata: Функция on_metadata(metadata), вызываемая сразу после работы
+            экстрактора, до обработки форматов (см. extract_metadata); при
+            попадании в кэш не вызывается
+    """
+    if use_cache:
+        info = info_cache.get(url)
+        if info is not None:
+            log_debug(f"Info cache hit: {url}")
+            return info
     try:
         with yt_dlp.YoutubeDL({"quiet": True}) as ydl:
-            info = ydl.extract_info(url, download=False)
-        return info
+            if on_metadata is None:
+                info = ydl.extract_info(url, download=False)
+            else:
+                # То же, что extract_info(download=False), но в два шага: метаданные
+                # доступны до выбора и проверки форматов
+                info = ydl.extract_info(url, download=False, process=False)
+                if info.get('_type', 'video') == 'video' and info.get('title'):
+                    try:
+                        on_metadata(extract_metadata(info))
+                    except Exception as e:
+                        log_warning(f"Error in metadata callback for {url}: {e}")
+                info = ydl.process_ie_result(info, download=False)
     except Exception as e:
         raise Exception(f"Ошибка получения информации о видео: {e}")
+    info_cache.put(url, info)
+    return info
 
 
-def download_thumbnail(url, thumbnail_folder, video_id=None, info=None):
+def trim_info(info, format_id=None, audio_only=False):
     """
-    Скачивает thumbnail для видео
+    Уменьшает info_dict до того, что нужно для скачивания через process_ie_result
     
     Args:
-        url: URL видео
-        thumbnail_folder: Папка для сохранения thumbnails
-        video_id: ID видео для имени файла (опционально)
-        info: Уже полученная информация о видео (опционально, для избежания повторного вызова)
+        info: info_dict от extract_info
+        format_id: Выбранный формат (остальные видеоформаты отбрасываются)
+        audio_only: Оставить только аудиоформаты
     
     Returns:
-        Путь к скачанному thumbnail или None
+        Новый info_dict, пригодный для сериализации в JSON
     """
+    trimmed = {k: v for k, v in info.items() if k not in TRIMMED_INFO_KEYS}
+    formats = info.get('formats') or []
+    
+    def is_audio_only(fmt):
+        return fmt.get('vcodec') == 'none' and fmt.get('acodec') not in (None, 'none')
+    
+    if audio_only:
+        kept = [f for f in formats if is_audio_only(f)]
+    elif format_id:
+        format_id_str = str(format_id)
+        kept = [f for f in formats if str(f.get('format_id')) == format_id_str or is_audio_only(f)]
+        if not any(str(f.get('format_id')) == format_id_str for f in kept):
+            kept = []
+    else:
+        kept = []
+    # Если нужных форматов не нашлось, оставляем все - пусть выбирает yt-dlp
+    trimmed['formats'] = kept or formats
+    return yt_dlp.YoutubeDL.sanitize_info(trimmed)
+
+
+def info_urls_expired(info):
+    """Проверяет, не истекли ли подписанные URL форматов в info_dict"""
+    now = time.time()
+    epoch = info.get('epoch')
+    if epoch and now - epoch > INFO_URL_MAX_AGE:
+        return True
+    for fmt in info.get('formats') or []:
+        m = re.search(r'[?&/]expire[=/](\d+)', fmt.get('url') or '')
+        if m and int(m.group(1)) - INFO_URL_EXPIRY_MARGIN < now:
+            return True
+    return False
+
+
+def detect_image_extension(data, thumbnail_url=''):
+    """Расширение изображения по сигнатуре (или по URL, если сигнатура неизвестна)"""
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'jpg'
+    if data.startswith(b'\x89PNG'):
+        return 'png'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    ext = urlsplit(thumbnail_url).path.rsplit('.', 1)[-1].lower()
+    return 'png' if ext == 'png' else 'webp' if ext == 'webp' else 'jpg'
+
+
+def make_list_thumbnail(data, size=THUMBNAIL_LIST_SIZE):
+    """
+    Уменьшенный JPEG для списков очереди и истории
+    
+    Изображение уменьшается так, чтобы покрыть size (в списках оно обрезается
+    через object-fit: cover). Возвращает bytes или None, если Pillow не
+    установлен или изображение не читается.
+    """
+    if Image is None:
+        return None
     try:
-        os.makedirs(thumbnail_folder, exist_ok=True)
-        
-        # Используем переданную информацию или получаем заново
-        if info is None:
-            with yt_dlp.YoutubeDL({"quiet": True}) as ydl:
-                info = ydl.extract_info(url, download=False)
-        
-        thumbnail_url = info.get('thumbnail')
-        
-        if not thumbnail_url:
-            return None
+        with Image.open(io.BytesIO(data)) as image:
+            # JPEG декодируется сразу в уменьшенном масштабе
+            image.draft('RGB', size)
+            if image.mode in ('RGBA', 'LA', 'P'):
+                image = image.convert('RGBA')
+                background = Image.new('RGB', image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel('A'))
+                image = background
+            else:
+                image = image.convert('RGB')
+            scale = max(size[0] / image.width, size[1] / image.height)
+            if scale < 1:
+                image = image.resize(
+                    (max(1, round(image.width * scale)), max(1, round(image.height * scale))),
+                    Image.LANCZOS
+                )
+            output = io.BytesIO()
+            image.save(output, 'JPEG', quality=THUMBNAIL_JPEG_QUALITY, optimize=True, progressive=True)
+            return output.getvalue()
+    except Exception as e:
+        log_warning(f"Cannot downscale thumbnail: {e}")
+        return None
+
+
+def write_thumbnail_file(data, thumbnail_path):
+    """Записывает файл хранилища, если его еще нет (имя определяется содержимым)"""
+    if os.path.exists(thumbnail_path):
+        return
+    # Пишем во временный файл, чтобы файл с этим именем всегда был целым
+    tmp_path = f"{thumbnail_path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, thumbnail_path)
+
+
+def store_thumbnail(data, thumbnail_folder, thumbnail_url='', keep_original=THUMBNAIL_KEEP_ORIGINAL):
+    """
+    Сохраняет thumbnail в хранилище по хэшу содержимого
+    
+    Одинаковые изображения (одно видео в истории несколько раз, общие заглушки
+    сайтов) хранятся одним файлом. Если доступен Pillow, основным файлом
+    становится уменьшенный JPEG, а оригинал сохраняется только при keep_original.
+    
+    Returns:
+        (путь к основному файлу, sha256 оригинала, суммарный размер файлов)
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    original_path = os.path.join(thumbnail_folder, f"{digest}.{detect_image_extension(data, thumbnail_url)}")
+    variant = make_list_thumbnail(data)
+    if variant is None:
+        write_thumbnail_file(data, original_path)
+        return original_path, digest, len(data)
+    
+    thumbnail_path = os.path.join(thumbnail_folder, f"{digest}.w{THUMBNAIL_LIST_SIZE[0]}.jpg")
+    write_thumbnail_file(variant, thumbnail_path)
+    size = len(variant)
+    if keep_original:
+        write_thumbnail_file(data, original_path)
+        size += len(data)
+    return thumbnail_path, digest, size
+
+
+def find_original_thumbnail(thumbnail_folder, filename):
+    """Имя сохраненного оригинала для файла хранилища (или само filename, если оригинала нет)"""
+    match = THUMBNAIL_NAME_RE.match(filename)
+    if not match or not match.group(2):
+        return filename
+    for ext in THUMBNAIL_EXTENSIONS:
+        original = f"{match.group(1)}.{ext}"
+        if os.path.exists(os.path.join(thumbnail_folder, original)):
+            return original
+    return filename
+
+
+# Keep-alive соединения для скачивания thumbnails: у каждого потока свои,
+# ключ - (схема, хост), значение - (соединение, заголовки для прокси)
+_http_local = threading.local()
+
+
+def _get_proxy(scheme, netloc):
+    """Прокси для схемы из настроек системы (HTTP_PROXY, HTTPS_PROXY, NO_PROXY) или None"""
+    proxy = urllib.request.getproxies().get(scheme)
+    if not proxy or urllib.request.proxy_bypass(urlsplit('//' + netloc).hostname or netloc):
+        return None
+    if '://' not in proxy:
+        proxy = 'http://' + proxy
+    return urlsplit(proxy)
+
+
+def _proxy_auth_headers(proxy):
+    if proxy.username is None:
+        return {}
+    credentials = f"{unquote(proxy.username)}:{unquote(proxy.password or '')}"
+    return {'Proxy-Authorization': 'Basic ' + base64.b64encode(credentials.encode('utf-8')).decode('ascii')}
+
+
+def _create_http_connection(scheme, netloc, timeout):
+    """
+    Новое соединение с хостом, при необходимости - через прокси
+    
+    Returns:
+        (соединение, заголовки, которые нужно добавить к запросу через HTTP-прокси,
+        или None, если запрос идет к хосту напрямую или через туннель CONNECT)
+    """
+    proxy = _get_proxy(scheme, netloc)
+    if proxy is None:
+        conn_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        return conn_class(netloc, timeout=timeout), None
+    proxy_netloc = proxy.netloc.rpartition('@')[2]
+    if scheme == 'https':
+        # HTTPS - через туннель CONNECT, TLS устанавливается с самим хостом
+        conn = http.client.HTTPSConnection(proxy_netloc, timeout=timeout)
+        conn.set_tunnel(netloc, headers=_proxy_auth_headers(proxy))
+        return conn, None
+    conn_class = http.client.HTTPSConnection if proxy.scheme == 'https' else http.client.HTTPConnection
+    return conn_class(proxy_netloc, timeout=timeout), _proxy_auth_headers(proxy)
+
+
+def _get_http_connection(scheme, netloc, timeout):
+    """Соединение потока с хостом: (соединение, заголовки прокси или None, переиспользовано ли)"""
+    connections = getattr(_http_local, 'connections', None)
+    if connections is None:
+        connections = _http_local.connections = {}
+    if (scheme, netloc) not in connections:
+        connections[(scheme, netloc)] = _create_http_connection(scheme, netloc, timeout)
+    conn, proxy_headers = connections[(scheme, netloc)]
+    conn.timeout = timeout
+    if conn.sock is not None:
+        conn.sock.settimeout(timeout)
+    return conn, proxy_headers, conn.sock is not None
+
+
+def _drop_http_connection(scheme, netloc):
+    entry = getattr(_http_local, 'connections', {}).pop((scheme, netloc), None)
+    if entry is not None:
+        entry[0].close()
+
+
+def fetch_url_bytes(url, timeout=THUMBNAIL_TIMEOUT, max_bytes=THUMBNAIL_MAX_BYTES):
+    """
+    Скачивает небольшой файл (thumbnail) по HTTP(S)
+    
+    Соединения с хостом переиспользуются в пределах потока, таймаут действует
+    на подключение и на каждое чтение. Следует перенаправлениям. Учитывает
+    системные настройки прокси, как urllib.
+    
+    Raises:
+        Exception: Ошибка сети, HTTP-статус не 200 или файл больше max_bytes
+    """
+    for _ in range(THUMBNAIL_MAX_REDIRECTS + 1):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError(f"Unsupported thumbnail URL: {url}")
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
         
-        # Используем video_id или генерируем из URL
-        if not video_id:
-            video_id = get_video_id(info, url)
+        for attempt in range(2):
+            conn, proxy_headers, reused = _get_http_connection(parts.scheme, parts.netloc, timeout)
+            headers = {'User-Agent': 'Mozilla/5.0', 'Accept': 'image/*'}
+            target = path
+            if proxy_headers is not None:
+                # HTTP-прокси получает абсолютный URL
+                headers.update(proxy_headers)
+                target = urlunsplit((parts.scheme, parts.netloc, parts.path or '/', parts.query, ''))
+            try:
+                conn.request('GET', target, headers=headers)
+                response = conn.getresponse()
+                data = response.read(max_bytes + 1)
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                _drop_http_connection(parts.scheme, parts.netloc)
+                # Сервер закрыл простаивавшее соединение - повторяем один раз на новом
+                if not reused or attempt:
+                    raise
+            except Exception:
+                _drop_http_connection(parts.scheme, parts.netloc)
+                raise
         
-        # Определяем расширение из URL или используем jpg по умолчанию
-        ext = 'jpg'
-        if '.' in thumbnail_url:
-            ext = thumbnail_url.split('.')[-1].split('?')[0]
-            if ext not in ['jpg', 'jpeg', 'png', 'webp']:
-                ext = 'jpg'
+        if response.will_close or len(data) > max_bytes:
+            _drop_http_connection(parts.scheme, parts.netloc)
+        if response.status in (301, 302, 303, 307, 308) and response.getheader('Location'):
+            url = urljoin(url, response.getheader('Location'))
+            continue
+        if response.status != 200:
+            raise Exception(f"HTTP {response.status} for {url}")
+        if len(data) > max_bytes:
+            raise Exception(f"Thumbnail is larger than {max_bytes} bytes: {url}")
+        return data
+    raise Exception(f"Too many redirects for {url}")
+
+
+def fetch_thumbnail(thumbnail_url, thumbnail_folder, thumbnail_index=None, keep_original=THUMBNAIL_KEEP_ORIGINAL):
+    """
+    Скачивает изображение thumbnail_url в хранилище thumbnails
+    
+    Args:
+        thumbnail_url: URL изображения
+        thumbnail_folder: Папка для сохранения thumbnails
+        thumbnail_index: Индекс уже скачанных thumbnails (см. download_thumbnail)
+        keep_original: Сохранять ли оригинал рядом с уменьшенным вариантом
+    
+    Returns:
+        Путь к thumbnail или None
+    """
+    if not thumbnail_url:
+        return None
+    try:
+        os.makedirs(thumbnail_folder, exist_ok=True)
         
-        thumbnail_filename = f"{video_id}.{ext}"
-        thumbnail_path = os.path.join(thumbnail_folder, thumbnail_filename)
+        # Это изображение уже скачано
+        if thumbnail_index is not None:
+            filename = thumbnail_index.get_thumbnail(thumbnail_url)
+            if filename and os.path.exists(os.path.join(thumbnail_folder, filename)):
+                return os.path.join(thumbnail_folder, filename)
         
-        # Скачиваем thumbnail
-        import urllib.request
-        urllib.request.urlretrieve(thumbnail_url, thumbnail_path)
+        data = fetch_url_bytes(thumbnail_url)
+        thumbnail_path, digest, size = store_thumbnail(data, thumbnail_folder, thumbnail_url, keep_original)
+        if thumbnail_index is not None:
+            thumbnail_index.add_thumbnail(thumbnail_url, os.path.basename(thumbnail_path), digest, size)
         
         log_info(f"Thumbnail downloaded: {thumbnail_path}")
         return thumbnail_path
+    except Exception as e:
+        log_error(f"Error downloading thumbnail {thumbnail_url}: {e}")
+        return None
+
+
+def download_thumbnail(url, thumbnail_folder, info=None, thumbnail_index=None, keep_original=THUMBNAIL_KEEP_ORIGINAL):
+    """
+    Скачивает thumbnail для видео в хранилище по хэшу содержимого
+    
+    Args:
+        url: URL видео
+        thumbnail_folder: Папка для сохранения thumbnails
+        info: Уже полученная информация о видео (опционально, для избежания повторного вызова)
+        thumbnail_index: Индекс уже скачанных thumbnails (например, Database) с методами
+            get_thumbnail(source_url) -> имя файла или None и
+            add_thumbnail(source_url, filename, sha256, size); повторная загрузка
+            того же изображения пропускается
+        keep_original: Сохранять ли оригинал рядом с уменьшенным вариантом
+    
+    Returns:
+        Путь к скачанному thumbnail или None
+    """
+    try:
+        # Используем переданную информацию или берем из кэша
+        if info is None:
+            info = get_video_info(url)
+        return fetch_thumbnail(info.get('thumbnail'), thumbnail_folder, thumbnail_index, keep_original)
     except Exception as e:
         log_error(f"Error downloading thumbnail for {url}: {e}")
         return None
 
 
-def get_formats(url, thumbnail_folder=None):
+def get_formats(url, thumbnail_folder=None, thumbnail_index=None, keep_original=THUMBNAIL_KEEP_ORIGINAL,
+                on_metadata=None):
     """
     Получает список доступных форматов для видео с фильтрацией
     
     Args:
         url: URL видео
         thumbnail_folder: Папка для сохранения thumbnails (опционально)
+        thumbnail_index: Индекс уже скачанных thumbnails (см. download_thumbnail)
+        keep_original: Сохранять ли оригинал thumbnail рядом с уменьшенным вариантом
+        on_metadata: Функция on_metadata(metadata) для показа названия до получения форматов
+            (см. get_video_info)
     
     Returns:
-        Словарь с title, formats и thumbnail_path (если thumbnail_folder указан)
+        Словарь с title, formats, thumbnail_url и thumbnail_path (если thumbnail_folder указан;
+        без папки thumbnail не скачивается и его можно получить позже через fetch_thumbnail)
     """
     try:
-        info = get_video_info(url)
+        info = get_video_info(url, on_metadata=on_metadata)
         video_title = info.get("title", "video")
         fetched_formats = info.get("formats", [])
         
@@ -422,14 +979,15 @@ def get_formats(url, thumbnail_folder=None):
         
         result = {
             "title": video_title,
-            "formats": filtered_formats
+            "formats": filtered_formats,
+            "thumbnail_url": info.get("thumbnail")
         }
         
         # Скачиваем thumbnail если указана папка
         if thumbnail_folder:
             try:
-                video_id = get_video_id(info, url)
-                thumbnail_path = download_thumbnail(url, thumbnail_folder, video_id, info=info)
+                thumbnail_path = download_thumbnail(url, thumbnail_folder, info=info, thumbnail_index=thumbnail_index,
+                                                    keep_original=keep_original)
                 result["thumbnail_path"] = thumbnail_path
             except Exception as e:
                 log_error(f"Error downloading thumbnail in get_formats: {e}")
@@ -441,50 +999,110 @@ def get_formats(url, thumbnail_folder=None):
         raise Exception(f"Ошибка получения форматов: {e}")
 
 
-def create_progress_hook(progress_callback, paused_flag, cancelled_flag, final_file_callback):
-    """Создает функцию progress_hook для yt-dlp"""
+def build_progress(d):
+    """Числовой прогресс из словаря progress hook yt-dlp"""
+    downloaded = d.get('downloaded_bytes') or 0
+    total = d.get('total_bytes') or d.get('total_bytes_estimate')
+    if total:
+        percent = min(100.0, downloaded * 100.0 / total)
+    elif d.get('fragment_count'):
+        # Фрагментированные загрузки без известного размера
+        percent = min(100.0, (d.get('fragment_index') or 0) * 100.0 / d['fragment_count'])
+    else:
+        percent = None
+    return {
+        'percent': percent,
+        'downloaded_bytes': downloaded,
+        'total_bytes': total,
+        'speed': d.get('speed'),
+        'eta': d.get('eta')
+    }
+
+
+def create_progress_hook(progress_callback, paused_flag, cancelled_flag, final_file_callback, rate_limiter=None,
+                         min_interval=PROGRESS_UPDATE_INTERVAL):
+    """
+    Создает функцию progress_hook для yt-dlp
+    
+    progress_callback получает dict из build_progress не чаще раза в min_interval
+    (завершение файла передается всегда).
+    """
+    # Сколько байт каждого файла уже учтено в общем ограничении скорости
+    counted_bytes = {}
+    last_update = [0.0]
+    
     def progress_hook(d):
         if get_flag_value(cancelled_flag):
             raise Exception("Download cancelled by user.")
         
-        while get_flag_value(paused_flag):
-            time.sleep(0.1)
+        # Пауза обрывает загрузку и освобождает соединение; .part файл остается,
+        # и при повторном запуске yt-dlp продолжит его с нужного байта (Range-запрос)
+        if get_flag_value(paused_flag):
+            raise DownloadPaused()
 
         status = d.get('status', '').lower()
         if status == 'downloading':
-            percent = d.get('_percent_str', '').strip()
+            if rate_limiter:
+                key = d.get('tmpfilename') or d.get('filename')
+                downloaded = d.get('downloaded_bytes') or 0
+                # Первое значение - базовая линия: при продолжении .part файла
+                # downloaded_bytes сразу равен уже скачанному ранее объему
+                previous = counted_bytes.get(key, downloaded)
+                counted_bytes[key] = downloaded
+                # Счетчик мог начаться заново (повторная попытка) - тогда учитываем все заново
+                rate_limiter.consume(downloaded - previous if downloaded >= previous else downloaded)
             if progress_callback:
-                # Извлекаем процент из строки
-                m = re.search(r"([\d.]+)%", percent)
-                if m:
-                    progress_callback(float(m.group(1)))
+                now = time.monotonic()
+                if now - last_update[0] >= min_interval:
+                    last_update[0] = now
+                    progress_callback(build_progress(d))
         elif status == 'finished':
             filename = d.get('filename')
             if filename and final_file_callback:
                 final_file_callback(filename)
             if progress_callback:
-                progress_callback(100.0)
+                progress = build_progress(d)
+                progress['percent'] = 100.0
+                progress['eta'] = 0
+                progress_callback(progress)
     
     return progress_hook
 
 
 def download_video(url, format_id, download_folder, audio_only=False, 
                    progress_callback=None, logger=None, paused_flag=None, 
-                   cancelled_flag=None, final_file_callback=None, retry_status_callback=None):
+                   cancelled_flag=None, final_file_callback=None, retry_status_callback=None,
+                   info=None, error_callback=None, rate_limiter=None,
+                   postprocess=True):
     """
     Скачивает видео с указанными параметрами
     
+    Если передан info (или он есть в кэше), скачивание идет через
+    YoutubeDL.process_ie_result без повторного извлечения страницы.
+    
+    При postprocess=False ffmpeg не запускается: видео и аудио скачиваются
+    отдельными файлами, а функция возвращает план постобработки для
+    run_postprocessing, чтобы выполнить ее вне сетевого слота.
+    
     Args:
         url: URL видео
         format_id: ID формата (None если audio_only)
         download_folder: Папка для сохранения
         audio_only: Только аудио (mp3)
-        progress_callback: Функция для обновления прогресса (принимает процент)
+        progress_callback: Функция для обновления прогресса (принимает dict: percent, downloaded_bytes,
+            total_bytes, speed, eta; вызывается не чаще PROGRESS_UPDATE_INTERVAL)
         logger: CustomLogger для логирования
-        paused_flag: dict с флагом паузы {'value': bool}
+        paused_flag: dict с флагом паузы {'value': bool} (при паузе выбрасывается DownloadPaused)
         cancelled_flag: dict с флагом отмены {'value': bool}
         final_file_callback: Функция для сохранения пути к финальному файлу
         retry_status_callback: Функция для обновления статуса повторных попыток (принимает строку или None)
+        info: Уже полученный info_dict (например, сохраненный в очереди через trim_info)
+        error_callback: Функция, вызываемая при каждой сетевой (повторяемой) ошибке (принимает исключение)
+        rate_limiter: Общий ограничитель скорости с методом consume(nbytes) (например, BandwidthLimiter)
+        postprocess: Выполнить слияние/конвертацию сразу (иначе вернуть план постобработки)
+    
+    Returns:
+        dict: План постобработки (только при postprocess=False, если она нужна), иначе None
     """
     if paused_flag is None:
         paused_flag = {"value": False}
@@ -496,34 +1114,74 @@ def download_video(url, format_id, download_folder, audio_only=False,
         progress_callback,
         paused_flag,
         cancelled_flag,
-        final_file_callback
+        final_file_callback,
+        rate_limiter
     )
     
+    # Файлы, которые yt-dlp сохранил на диск (нужны для отложенной постобработки)
+    downloaded_files = []
+    
+    def downloaded_files_hook(d):
+        filename = d.get('filename')
+        if d.get('status') != 'finished' or not filename:
+            return
+        if any(f['filepath'] == filename for f in downloaded_files):
+            return
+        fmt = d.get('info_dict') or {}
+        downloaded_files.append({
+            'filepath': filename,
+            'vcodec': fmt.get('vcodec'),
+            'acodec': fmt.get('acodec'),
+            'protocol': fmt.get('protocol') or ''
+        })
+    
     ffmpeg_available = check_ffmpeg()
+    postprocess_type = None
+    
+    # Информация о видео: переданная заранее или из кэша
+    if info is not None and info_urls_expired(info):
+        log_info(f"Stored video info expired, re-extracting: {url}")
+        info = None
+    if info is None:
+        try:
+            info = get_video_info(url)
+            if info_urls_expired(info):
+                info = get_video_info(url, use_cache=False)
+        except Exception as e:
+            log_warning(f"Could not get video info before download, falling back to URL: {e}")
+            info = None
+    # Плейлисты скачиваем по URL
+    if info is not None and info.get('_type', 'video') != 'video':
+        info = None
+    if info is not None:
+        info = trim_info(info, format_id, audio_only)
     
     if audio_only:
         ydl_opts = {
             'outtmpl': os.path.join(download_folder, "%(title)s.%(ext)s"),
             'format': 'bestaudio',
+            'continuedl': True,
             'logger': logger,
-            'progress_hooks': [progress_hook_func],
-            'postprocessors': [{
+            'progress_hooks': [progress_hook_func, downloaded_files_hook]
+        }
+        if postprocess:
+            ydl_opts['postprocessors'] = [{
                 'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192'
+                'preferredcodec': AUDIO_CODEC,
+                'preferredquality': AUDIO_QUALITY
             }]
-        }
+        else:
+            postprocess_type = 'extract_audio'
     else:
         ydl_opts = {
             'outtmpl': os.path.join(download_folder, "%(title)s.%(ext)s"),
             'format': format_id,
+            'continuedl': True,
             'logger': logger,
-            'progress_hooks': [progress_hook_func]
+            'progress_hooks': [progress_hook_func, downloaded_files_hook]
         }
         # Проверяем, нужна ли конвертация (видео без аудио)
-        # Для этого нужно получить информацию о формате
-        try:
-            info = get_video_info(url)
+        if info is not None:
             formats = info.get("formats", [])
             # Приводим format_id к строке для сравнения, т.к. в YouTube API format_id может быть и строкой и числом
             format_id_str = str(format_id) if format_id else None
@@ -533,11 +1191,14 @@ def download_video(url, format_id, download_folder, audio_only=False,
                     selected_format.get("vcodec", "none") != "none"
                     and selected_format.get("acodec", "none") == "none"
                 )
-                if ffmpeg_available and needs_conversion:
+                if ffmpeg_available and needs_conversion and postprocess:
                     ydl_opts['format'] = f"{format_id}+bestaudio"
-                    ydl_opts['merge_output_format'] = 'mp4'
-        except Exception:
-            pass
+                    ydl_opts['merge_output_format'] = MERGE_OUTPUT_FORMAT
+                elif ffmpeg_available and needs_conversion:
+                    # Видео и аудио скачиваются отдельными файлами, слияние - в пуле постобработки
+                    ydl_opts['format'] = f"{format_id},bestaudio"
+                    ydl_opts['outtmpl'] = os.path.join(download_folder, "%(title)s.f%(format_id)s.%(ext)s")
+                    postprocess_type = 'merge'
     
     # Повторные попытки при таймаутах и сетевых ошибках
     max_retries = 3
@@ -556,14 +1217,27 @@ def download_video(url, format_id, download_folder, audio_only=False,
                     retry_status_callback("Initializing download...")
             
             with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                ydl.download([url])
+                if info is not None:
+                    # Повторно используем уже извлеченную информацию
+                    ydl.process_ie_result(copy.deepcopy(info), download=True)
+                else:
+                    ydl.download([url])
             log_info(f"Download completed successfully: {url}")
             if retry_status_callback:
                 retry_status_callback(None)  # Очищаем статус при успехе
-            return True
+            if postprocess_type:
+                return build_postprocess_plan(postprocess_type, downloaded_files, format_id)
+            return None
         except Exception as e:
             error_str = str(e).lower()
             
+            # Пауза - не повторяем, загрузка будет продолжена при возобновлении
+            if is_paused_error(e):
+                log_info(f"Download paused by user: {url}")
+                if retry_status_callback:
+                    retry_status_callback(None)
+                raise DownloadPaused()
+            
             # Проверяем на отмену пользователем - не повторяем
             if "cancelled" in error_str:
                 log_info(f"Download cancelled by user: {url}")
@@ -578,6 +1252,16 @@ def download_video(url, format_id, download_folder, audio_only=False,
                 'unable to download video data'
             ])
             
+            # Подписанные URL из сохраненной информации могли протухнуть - извлекаем заново
+            if info is not None and any(keyword in error_str for keyword in ['403', 'forbidden', '410', 'expired']):
+                log_warning(f"Stored video info looks stale, re-extracting on next attempt: {url}")
+                info_cache.invalidate(url)
+                info = None
+                is_retryable = True
+            
+            if is_retryable and error_callback:
+                error_callback(e)
+            
             if is_retryable and attempt < max_retries:
                 retry_msg = f"Connection timeout, retrying ({attempt}/{max_retries})..."
                 log_warning(f"Download error (attempt {attempt}/{max_retries}): {e}")
@@ -599,3 +1283,84 @@ def download_video(url, format_id, download_folder, audio_only=False,
                     retry_status_callback(None)
                 raise e
 
+
+def build_postprocess_plan(postprocess_type, downloaded_files, format_id=None):
+    """
+    Составляет план отложенной постобработки по скачанным файлам
+    
+    План - JSON-совместимый dict (сохраняется в очереди, чтобы постобработку
+    можно было продолжить после перезапуска):
+        type: 'merge' или 'extract_audio'
+        files: входные файлы с кодеками и протоколом (для merge - сначала видео, затем аудио)
+        output: итоговый файл
+    """
+    if not downloaded_files:
+        raise Exception("Download finished without output files")
+    
+    if postprocess_type == 'merge':
+        video_marker = f".f{format_id}."
+        video_file = next((f for f in downloaded_files if video_marker in os.path.basename(f['filepath'])), None)
+        audio_file = next((f for f in downloaded_files if f is not video_file), None)
+        if not video_file or not audio_file:
+            raise Exception(f"Cannot merge formats, unexpected downloaded files: "
+                            f"{[f['filepath'] for f in downloaded_files]}")
+        base = video_file['filepath'][:video_file['filepath'].rfind(video_marker)]
+        return {
+            'type': 'merge',
+            'files': [video_file, audio_file],
+            'output': f"{base}.{MERGE_OUTPUT_FORMAT}"
+        }
+    
+    audio_file = downloaded_files[-1]
+    return {
+        'type': 'extract_audio',
+        'files': [audio_file],
+        'output': f"{os.path.splitext(audio_file['filepath'])[0]}.{AUDIO_CODEC}",
+        'codec': AUDIO_CODEC,
+        'quality': AUDIO_QUALITY
+    }
+
+
+def run_postprocessing(plan, logger=None):
+    """
+    Выполняет постобработку (слияние через ffmpeg или конвертацию в mp3) по плану build_postprocess_plan
+    
+    Returns:
+        str: Путь к итоговому файлу
+    """
+    files = [f['filepath'] for f in plan['files']]
+    output = plan['output']
+    missing = [path for path in files if not os.path.exists(path)]
+    if missing:
+        if os.path.exists(output):
+            # Постобработка уже была выполнена (например, до перезапуска приложения)
+            return output
+        raise Exception(f"Files for post-processing not found: {', '.join(missing)}")
+    
+    log_info(f"Post-processing ({plan['type']}): {output}")
+    ydl_opts = {'logger': logger} if logger else {'quiet': True}
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        if plan['type'] == 'merge':
+            pp = FFmpegMergerPP(ydl)
+            info = {
+                'filepath': output,
+                '__files_to_merge': files,
+                'requested_formats': plan['files']
+            }
+        else:
+            pp = FFmpegExtractAudioPP(ydl, preferredcodec=plan.get('codec', AUDIO_CODEC),
+                                      preferredquality=plan.get('quality', AUDIO_QUALITY))
+            info = {'filepath': files[0], 'ext': os.path.splitext(files[0])[1].lstrip('.')}
+        if not pp.available:
+            raise Exception("ffmpeg is required for post-processing but was not found")
+        files_to_delete, info = pp.run(info)
+    
+    # Промежуточные файлы больше не нужны
+    for path in files_to_delete:
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+        except OSError as e:
+            log_warning(f"Could not delete intermediate file {path}: {e}")
+    log_info(f"Post-processing completed: {info['filepath']}")
+    return info['filepath']